@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+
+# How long a course's available set is used before its version is checked in MongoDB
+AVAILABILITY_REFRESH_SECONDS = float(os.getenv('AVAILABILITY_REFRESH_SECONDS', 5))
+
+
+class AvailabilityIndex:
+    """
+    In-memory set of the documents available to the assistant, per course.
+
+    The sets are persisted in the course_availability collection with a
+    version counter that is incremented on every change. Searches apply the
+    set as a document_id filter, so granting or revoking access never
+    rewrites vectors. Changes made by other processes are picked up once the
+    version in MongoDB differs, checked at most every AVAILABILITY_REFRESH_SECONDS.
+    """
+
+    def __init__(self, mongodb, refresh_seconds=AVAILABILITY_REFRESH_SECONDS):
+        self.mongodb = mongodb
+        self.refresh_seconds = refresh_seconds
+        self._courses = {}
+        self._lock = threading.Lock()
+
+    def get(self, course_id):
+        """Returns the ids of the available documents of a course, as a frozenset."""
+        return self._entry(course_id)[0]
+
+    def version(self, course_id):
+        """Version of the course's available set; changes whenever access is granted or revoked."""
+        return self._entry(course_id)[1]
+
+    def _entry(self, course_id):
+        with self._lock:
+            entry = self._courses.get(course_id)
+        now = time.monotonic()
+        if entry is not None and now - entry[2] < self.refresh_seconds:
+            return entry
+
+        if entry is not None and self.mongodb.get_course_availability_version(course_id) == entry[1]:
+            entry = (entry[0], entry[1], now)
+        else:
+            document_ids, version = self.mongodb.get_course_availability(course_id)
+            entry = (frozenset(document_ids), version, now)
+        with self._lock:
+            self._courses[course_id] = entry
+        return entry
+
+    def set_available(self, course_id, course_summary, file_ids, value):
+        """
+        Grants (value=True) or revokes access to any number of files of a course
+        in one operation. Returns False if none of the files was found.
+        """
+        availability = self.mongodb.set_files_available(course_id, course_summary, list(file_ids), value)
+        if availability is None:
+            return False
+        document_ids, version = availability
+        with self._lock:
+            self._courses[course_id] = (frozenset(document_ids), version, time.monotonic())
+        return True
+
+    def restore(self, course_id, document_ids, version):
+        """
+        Sets the available set of a course as saved elsewhere, e.g. in a
+        snapshot. It is written to MongoDB if the course has no set there yet;
+        otherwise the set in MongoDB is kept.
+        """
+        document_ids, version = self.mongodb.restore_course_availability(course_id, document_ids, version)
+        with self._lock:
+            self._courses[course_id] = (frozenset(document_ids), version, time.monotonic())
+
+    def forget(self, course_id):
+        with self._lock:
+            self._courses.pop(course_id, None)
+
+
+availability_index = None
+_availability_index_lock = threading.Lock()
+
+
+def get_availability_index(mongodb):
+    """Returns the availability index shared by all sessions of this process."""
+    global availability_index
+    with _availability_index_lock:
+        if availability_index is None:
+            availability_index = AvailabilityIndex(mongodb)
+    return availability_index
@@ -0,0 +1,185 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from data.lexical_index import BM25Index, query_terms, LEXICAL_REFRESH_SECONDS
+
+# Questions on courses with more available documents than this first pick the
+# documents to search by their summaries
+ROUTING_MIN_DOCUMENTS = int(os.getenv('ROUTING_MIN_DOCUMENTS', 20))
+# Number of documents whose chunks are then searched
+ROUTING_TOP_DOCUMENTS = int(os.getenv('ROUTING_TOP_DOCUMENTS', 8))
+# Summary fields a document is routed by, besides its file name
+ROUTING_SUMMARY_FIELDS = ('Summary', 'Keywords', 'Quiz', 'Homework/Assignments')
+
+
+def summary_text(file_name, summary):
+    """
+    Text a document is routed by: its file name and the fields of the JSON
+    summary written by GroqCorseSummarizer. A summary that is not valid JSON
+    is used as it is; '' if the document has no summary.
+    """
+    summary = str(summary or '').strip()
+    if not summary or summary == 'None':
+        return ''
+    start, end = summary.find('{'), summary.rfind('}')
+    try:
+        fields = json.loads(summary[start:end + 1])
+    except ValueError:
+        return f"{file_name}\n{summary}"
+    if not isinstance(fields, dict):
+        return f"{file_name}\n{summary}"
+    parts = [file_name]
+    for field in ROUTING_SUMMARY_FIELDS:
+        value = fields.get(field)
+        if isinstance(value, list):
+            value = ", ".join(str(item) for item in value)
+        if value and value != 'None':
+            parts.append(str(value))
+    return "\n".join(parts)
+
+
+class CourseRoutes:
+    """Summary embeddings and BM25 index of the summaries of one course."""
+
+    def __init__(self):
+        self.clear()
+        self.version = None
+        self.synced = 0.0
+        # Collection of the course index the summaries were embedded for
+        self.generation = None
+        self.lock = threading.Lock()
+
+    def clear(self):
+        self.ids = []
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.lexical = BM25Index()
+        # Completed documents without a summary, which are always searched
+        self.unrouted = set()
+
+    def known(self):
+        return set(self.ids) | self.unrouted
+
+    def remove(self, document_ids):
+        document_ids = set(document_ids)
+        keep = [row for row, document_id in enumerate(self.ids) if document_id not in document_ids]
+        self.ids = [self.ids[row] for row in keep]
+        self.vectors = self.vectors[keep]
+        for document_id in document_ids:
+            self.lexical.remove_document(document_id)
+        self.unrouted -= document_ids
+
+    def add(self, document_ids, texts, embeddings):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        self.vectors = np.vstack([self.vectors, vectors]) if len(self.ids) else vectors
+        self.ids.extend(document_ids)
+        for document_id, text in zip(document_ids, texts):
+            self.lexical.add_document(document_id, [text])
+
+
+class DocumentRouter:
+    """
+    First stage of retrieval on large courses: ranks a course's documents by
+    their summaries, so that chunk search is restricted to the best ones.
+
+    Documents are ranked by the cosine similarity of the query with their
+    embedded summary, fused with BM25 over the summary keywords. Summaries
+    are embedded with the course's embedding backend (through the embedding
+    cache) when a course is first searched and when files complete; like the
+    lexical index, a course is synced with MongoDB when its vector version
+    changes or after LEXICAL_REFRESH_SECONDS.
+    """
+
+    def __init__(self, mongodb, chroma_db_manager, refresh_seconds=LEXICAL_REFRESH_SECONDS):
+        self.mongodb = mongodb
+        self.chroma_db_manager = chroma_db_manager
+        self.refresh_seconds = refresh_seconds
+        self._courses = {}
+        self._lock = threading.Lock()
+
+    def _course(self, course_id):
+        with self._lock:
+            course = self._courses.setdefault(course_id, CourseRoutes())
+        version = self.chroma_db_manager.vector_stores.version(course_id)
+        if course.version == version and time.monotonic() - course.synced < self.refresh_seconds:
+            return course
+        with course.lock:
+            if course.version != version or time.monotonic() - course.synced >= self.refresh_seconds:
+                generation = self.chroma_db_manager.index_generation(course_id)
+                if course.generation != generation:
+                    # Summaries are embedded with the backend of the active index
+                    course.clear()
+                    course.generation = generation
+                self._sync(course_id, course)
+                course.version = version
+                course.synced = time.monotonic()
+        return course
+
+    def _sync(self, course_id, course):
+        completed = self.mongodb.get_completed_file_ids(course_id)
+        course.remove(course.known() - completed)
+        new_ids = completed - course.known()
+        if not new_ids:
+            return
+        texts = {document_id: summary_text(file_name, summary)
+                 for document_id, (file_name, summary) in self.mongodb.get_document_summaries(course_id, new_ids).items()}
+        routed = sorted(document_id for document_id, text in texts.items() if text)
+        course.unrouted.update(document_id for document_id, text in texts.items() if not text)
+        if routed:
+            embeddings = self.chroma_db_manager.embed_chunks([texts[document_id] for document_id in routed], course_id)
+            course.add(routed, [texts[document_id] for document_id in routed], embeddings)
+
+    def route(self, course_id, query_text, query_embedding, document_ids, top=ROUTING_TOP_DOCUMENTS):
+        """
+        The documents to search for a query: the top ranked of document_ids
+        plus those that cannot be ranked (no summary yet). Returns document_ids
+        itself if they are ROUTING_MIN_DOCUMENTS or fewer.
+        """
+        if len(document_ids) <= ROUTING_MIN_DOCUMENTS:
+            return document_ids
+        course = self._course(course_id)
+        document_ids = {str(document_id) for document_id in document_ids}
+        with course.lock:
+            rows = [row for row, document_id in enumerate(course.ids) if document_id in document_ids]
+            unranked = document_ids - set(course.ids)
+            if not rows:
+                return frozenset(document_ids)
+            query = np.asarray(query_embedding, dtype=np.float32)
+            scores = course.vectors[rows] @ (query / max(np.linalg.norm(query), 1e-12))
+            by_summary = [course.ids[rows[index]] for index in np.argsort(-scores)[:top]]
+            by_keywords = [course.lexical.chunks[row][0]
+                           for row, _, _ in course.lexical.search(query_terms(query_text), top, document_ids)]
+        fused = {}
+        for ranking in (by_summary, by_keywords):
+            for rank, document_id in enumerate(ranking, start=1):
+                fused[document_id] = fused.get(document_id, 0.0) + 1 / (60 + rank)
+        return frozenset(sorted(fused, key=fused.get, reverse=True)[:top]) | unranked
+
+    def forget(self, course_id):
+        with self._lock:
+            self._courses.pop(course_id, None)
+
+    def stats(self):
+        with self._lock:
+            courses = dict(self._courses)
+        return {course_id: {'documents': len(course.ids), 'unrouted': len(course.unrouted)}
+                for course_id, course in courses.items()}
+
+
+document_router = None
+_document_router_lock = threading.Lock()
+
+
+def get_document_router(mongodb, chroma_db_manager):
+    """Returns the document router shared by all sessions of this process, or None if routing is disabled."""
+    global document_router
+    if ROUTING_TOP_DOCUMENTS <= 0:
+        return None
+    with _document_router_lock:
+        if document_router is None:
+            document_router = DocumentRouter(mongodb, chroma_db_manager)
+    return document_router
@@ -0,0 +1,160 @@
+import importlib.util
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+
+# Backend of new course indexes: "openai", "local" or "local-int8"
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'openai')
+OPENAI_EMBEDDING_MODEL = os.getenv('OPENAI_EMBEDDING_MODEL', 'text-embedding-ada-002')
+
+# Local backend: a sentence-transformers model run on the CPU, either with
+# torch or ONNX Runtime ("torch" or "onnx", which needs optimum[onnxruntime]), by
+# LOCAL_EMBEDDING_WORKERS processes
+LOCAL_EMBEDDING_MODEL = os.getenv('LOCAL_EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+LOCAL_EMBEDDING_RUNTIME = os.getenv('LOCAL_EMBEDDING_RUNTIME', 'torch')
+LOCAL_EMBEDDING_WORKERS = int(os.getenv('LOCAL_EMBEDDING_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+LOCAL_EMBEDDING_BATCH = int(os.getenv('LOCAL_EMBEDDING_BATCH', 64))
+# Quantized ONNX file used by local-int8 with the ONNX runtime
+LOCAL_EMBEDDING_ONNX_INT8_FILE = os.getenv('LOCAL_EMBEDDING_ONNX_INT8_FILE', 'onnx/model_qint8_avx512.onnx')
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+# Model of a local embedding worker process, loaded by its initializer
+_worker_model = None
+
+
+def _check_runtime(runtime):
+    """Raises if a local runtime is unknown or its packages are not installed."""
+    if runtime not in ('torch', 'onnx'):
+        raise ValueError(f"Unknown local embedding runtime {runtime!r}, expected 'torch' or 'onnx'")
+    if runtime == 'onnx':
+        missing = [name for name in ('optimum', 'onnxruntime') if importlib.util.find_spec(name) is None]
+        if missing:
+            raise RuntimeError(f"The onnx local embedding runtime needs optimum[onnxruntime], missing: "
+                               f"{', '.join(missing)}. Install it or set LOCAL_EMBEDDING_RUNTIME=torch.")
+
+
+def _load_local_model(model_name, runtime, quantize):
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError as e:
+        raise RuntimeError(f"The local embedding backend needs sentence-transformers: {e}")
+
+    if runtime == 'onnx':
+        model_kwargs = {'file_name': LOCAL_EMBEDDING_ONNX_INT8_FILE} if quantize else None
+        return SentenceTransformer(model_name, device='cpu', backend='onnx', model_kwargs=model_kwargs)
+
+    model = SentenceTransformer(model_name, device='cpu')
+    if quantize:
+        import torch
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def _init_worker(model_name, runtime, quantize):
+    global _worker_model
+    import torch
+    # Every worker gets its own core instead of competing for all of them
+    torch.set_num_threads(1)
+    _worker_model = _load_local_model(model_name, runtime, quantize)
+
+
+def _embed_batch(texts):
+    return _worker_model.encode(texts, batch_size=len(texts), normalize_embeddings=True).tolist()
+
+
+class LocalEmbeddings(Embeddings):
+    """
+    sentence-transformers embeddings computed on this machine, usable wherever
+    OpenAIEmbeddings is (Chroma, the embedding batcher and cache).
+
+    Documents are split into batches of batch_size texts and encoded on a
+    pool of worker processes, each with its own copy of the model. Queries
+    are encoded in this process, which avoids the round trip to the pool.
+    """
+
+    # Local models have no API rate limits; the pool is the concurrency limit
+    rate_limited = False
+
+    def __init__(self, model_name=LOCAL_EMBEDDING_MODEL, quantize=False, runtime=LOCAL_EMBEDDING_RUNTIME,
+                 workers=LOCAL_EMBEDDING_WORKERS, batch_size=LOCAL_EMBEDDING_BATCH):
+        _check_runtime(runtime)
+        self.model_name = model_name
+        self.quantize = quantize
+        self.runtime = runtime
+        self.workers = workers
+        self.batch_size = batch_size
+        self.model = f"local{'-int8' if quantize else ''}:{model_name}"
+        self._model = None
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _local_model(self):
+        with self._lock:
+            if self._model is None:
+                self._model = _load_local_model(self.model_name, self.runtime, self.quantize)
+        return self._model
+
+    def _worker_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=get_context('spawn'),
+                    initializer=_init_worker,
+                    initargs=(self.model_name, self.runtime, self.quantize)
+                )
+        return self._pool
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        if self.workers <= 1 or len(texts) <= self.batch_size:
+            return self._local_model().encode(texts, batch_size=self.batch_size, normalize_embeddings=True).tolist()
+        batches = [texts[start:start + self.batch_size] for start in range(0, len(texts), self.batch_size)]
+        return [embedding for batch in self._worker_pool().map(_embed_batch, batches) for embedding in batch]
+
+    def embed_query(self, text):
+        return self._local_model().encode([text], normalize_embeddings=True)[0].tolist()
+
+    @property
+    def max_tokens(self):
+        """Input size of the model; longer texts are truncated."""
+        return self._local_model().max_seq_length
+
+    def count_tokens(self, texts):
+        """Number of model tokens in the texts, special tokens included."""
+        return sum(len(ids) for ids in self._local_model().tokenizer(list(texts))['input_ids'])
+
+
+def resolve_backend(backend=None):
+    """
+    Canonical id of an embedding backend, stored with each course index:
+    "openai" becomes "openai:<model>", "local" and "local-int8" become
+    "local:<model>" and "local-int8:<model>". Ids are returned unchanged.
+    """
+    backend = backend or EMBEDDING_BACKEND
+    if backend == 'openai':
+        return f"openai:{OPENAI_EMBEDDING_MODEL}"
+    if backend in ('local', 'local-int8'):
+        return f"{backend}:{LOCAL_EMBEDDING_MODEL}"
+    return backend
+
+
+def get_embedding_backend(backend=None):
+    """Returns the embeddings object of a backend, shared by this process."""
+    backend_id = resolve_backend(backend)
+    with _backends_lock:
+        if backend_id not in _backends:
+            kind, _, model_name = backend_id.partition(':')
+            if kind == 'openai':
+                _backends[backend_id] = OpenAIEmbeddings(model=model_name)
+            elif kind in ('local', 'local-int8'):
+                _backends[backend_id] = LocalEmbeddings(model_name, quantize=kind == 'local-int8')
+            else:
+                raise ValueError(f"Unknown embedding backend: {backend_id}")
+        return _backends[backend_id]
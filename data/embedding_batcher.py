@@ -0,0 +1,168 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from utils.rate_limiter import RateLimiter
+
+# Texts and (estimated) tokens per embedding request
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 256))
+EMBEDDING_BATCH_TOKENS = int(os.getenv('EMBEDDING_BATCH_TOKENS', 100000))
+# Embedding requests sent at the same time
+EMBEDDING_CONCURRENCY = int(os.getenv('EMBEDDING_CONCURRENCY', 4))
+# How long a batch waits for chunks of other documents before it is sent
+EMBEDDING_BATCH_WAIT_MS = int(os.getenv('EMBEDDING_BATCH_WAIT_MS', 50))
+# Rate limits of the embedding API account
+EMBEDDING_RPM = int(os.getenv('EMBEDDING_RPM', 3000))
+EMBEDDING_TPM = int(os.getenv('EMBEDDING_TPM', 1000000))
+
+
+class _Request:
+    """The texts of one submit() call, possibly split over several batches."""
+
+    def __init__(self, size):
+        self.future = Future()
+        self.embeddings = [None] * size
+        self.remaining = size
+        self._lock = threading.Lock()
+
+    def set_part(self, start, embeddings):
+        with self._lock:
+            self.embeddings[start:start + len(embeddings)] = embeddings
+            self.remaining -= len(embeddings)
+            done = self.remaining == 0
+        if done and not self.future.done():
+            self.future.set_result(self.embeddings)
+
+    def fail(self, error):
+        if not self.future.done():
+            self.future.set_exception(error)
+
+
+class EmbeddingBatcher:
+    """
+    Embeds texts in provider-sized batches on a bounded number of concurrent
+    requests, under the RPM/TPM limits of the account.
+
+    Texts submitted by different callers (e.g. documents ingested at the same
+    time) are merged into shared batches: while all request slots are busy,
+    new texts queue up and are sent together once a slot frees up.
+    """
+
+    def __init__(self, embed_documents, count_tokens, batch_size=EMBEDDING_BATCH_SIZE,
+                 batch_tokens=EMBEDDING_BATCH_TOKENS, concurrency=EMBEDDING_CONCURRENCY,
+                 wait_seconds=EMBEDDING_BATCH_WAIT_MS / 1000, rate_limiter=None):
+        self.embed_documents = embed_documents
+        self.count_tokens = count_tokens
+        self.batch_size = batch_size
+        self.batch_tokens = batch_tokens
+        self.wait_seconds = wait_seconds
+        # False disables rate limiting, e.g. for local models
+        self.rate_limiter = RateLimiter(EMBEDDING_RPM, EMBEDDING_TPM) if rate_limiter is None else rate_limiter
+        self.stats = {'requests': 0, 'texts': 0, 'tokens': 0, 'seconds': 0.0}
+        self._pending = queue.Queue()
+        self._slots = threading.Semaphore(concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='embedding')
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, texts):
+        """Queues texts for embedding. Returns a Future of their embeddings, in order."""
+        texts = list(texts)
+        request = _Request(len(texts))
+        if not texts:
+            request.future.set_result([])
+            return request.future
+        self._ensure_started()
+        for start in range(0, len(texts), self.batch_size):
+            part = texts[start:start + self.batch_size]
+            self._pending.put((request, start, part, self.count_tokens(part)))
+        return request.future
+
+    def embed(self, texts):
+        return self.submit(texts).result()
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._dispatch, name='embedding-batcher', daemon=True)
+                self._thread.start()
+
+    def _dispatch(self):
+        """Groups queued parts into batches and sends each batch once a request slot is free."""
+        carry = None
+        while True:
+            part = carry or self._pending.get()
+            carry = None
+            self._slots.acquire()
+
+            batch = [part]
+            size, tokens = len(part[2]), part[3]
+            deadline = time.monotonic() + self.wait_seconds
+            while size < self.batch_size:
+                try:
+                    part = self._pending.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if size + len(part[2]) > self.batch_size or tokens + part[3] > self.batch_tokens:
+                    carry = part
+                    break
+                batch.append(part)
+                size += len(part[2])
+                tokens += part[3]
+            self._executor.submit(self._send, batch, tokens)
+
+    def _send(self, batch, tokens):
+        try:
+            texts = [text for _, _, part, _ in batch for text in part]
+            if self.rate_limiter:
+                self.rate_limiter.acquire(tokens)
+            started = time.perf_counter()
+            embeddings = self.embed_documents(texts)
+            seconds = time.perf_counter() - started
+            with self._lock:
+                self.stats['requests'] += 1
+                self.stats['texts'] += len(texts)
+                self.stats['tokens'] += tokens
+                self.stats['seconds'] += seconds
+
+            offset = 0
+            for request, start, part, _ in batch:
+                request.set_part(start, embeddings[offset:offset + len(part)])
+                offset += len(part)
+        except Exception as e:
+            for request, _, _, _ in batch:
+                request.fail(e)
+        finally:
+            self._slots.release()
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+def get_embedding_batcher(embeddings_model, count_tokens):
+    """Returns the batcher shared by all users of an embedding model in this process."""
+    key = getattr(embeddings_model, 'model', type(embeddings_model).__name__)
+    with _batchers_lock:
+        if key not in _batchers:
+            if getattr(embeddings_model, 'rate_limited', True):
+                _batchers[key] = EmbeddingBatcher(embeddings_model.embed_documents, count_tokens)
+            else:
+                # Local models: one request at a time, spread over their own worker pool
+                _batchers[key] = EmbeddingBatcher(
+                    embeddings_model.embed_documents, count_tokens, concurrency=1, rate_limiter=False,
+                    batch_size=embeddings_model.batch_size * max(1, embeddings_model.workers)
+                )
+        return _batchers[key]
+
+
+def embedding_batcher_stats():
+    """Request counters of the embedding batchers of this process, per model."""
+    with _batchers_lock:
+        return {key: batcher.get_stats() for key, batcher in _batchers.items()}
@@ -0,0 +1,103 @@
+import hashlib
+import os
+import re
+import threading
+
+import numpy as np
+
+from utils.disk_cache import DiskCache
+
+# On-disk cache of chunk embeddings keyed by model and chunk text hash (0 disables it)
+EMBEDDING_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH', os.path.abspath(
+    os.path.join(os.path.dirname(__file__), 'embedding_cache', 'embedding_cache.sqlite3')))
+EMBEDDING_CACHE_MAX_MB = int(os.getenv('EMBEDDING_CACHE_MAX_MB', 1024))
+# float16 halves the size of the cache, float32 keeps the vectors exact
+EMBEDDING_CACHE_DTYPE = os.getenv('EMBEDDING_CACHE_DTYPE', 'float16')
+
+embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+
+
+def _normalize_chunk(text):
+    """Chunks that only differ in whitespace share their embedding."""
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed store of chunk embeddings on top of DiskCache.
+
+    Vectors are stored as raw float16/float32 arrays under
+    "<model>:<dtype>:<sha256 of the normalized chunk>", so the same chunk is
+    only embedded once per model, whatever course or document it comes from.
+    """
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_bytes=EMBEDDING_CACHE_MAX_MB * 1024 * 1024,
+                 dtype=EMBEDDING_CACHE_DTYPE):
+        self.cache = DiskCache(path, max_bytes)
+        self.dtype = np.dtype(dtype)
+        self.texts_saved = 0
+        self.tokens_saved = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+
+    def key(self, model_id, text):
+        digest = hashlib.sha256(_normalize_chunk(text).encode('utf-8')).hexdigest()
+        return f"{model_id}:{self.dtype.name}:{digest}"
+
+    def get_many(self, model_id, texts, count_tokens=None):
+        """
+        Looks the texts up in the cache.
+
+        Returns:
+            list: The embedding of each text, or None for texts not in the cache.
+        """
+        keys = [self.key(model_id, text) for text in texts]
+        found = self.cache.get_many(keys)
+        embeddings = [
+            np.frombuffer(found[key], dtype=self.dtype).astype(np.float32).tolist() if key in found else None
+            for key in keys
+        ]
+        hits = [text for text, embedding in zip(texts, embeddings) if embedding is not None]
+        if hits:
+            with self._lock:
+                self.texts_saved += len(hits)
+                self.bytes_saved += sum(len(text.encode('utf-8')) for text in hits)
+                if count_tokens is not None:
+                    self.tokens_saved += count_tokens(hits)
+        return embeddings
+
+    def set_many(self, model_id, texts, embeddings):
+        self.cache.set_many({
+            self.key(model_id, text): np.asarray(embedding, dtype=self.dtype).tobytes()
+            for text, embedding in zip(texts, embeddings)
+        })
+
+    def stats(self):
+        """
+        Hit ratio and size of the cache, and what the hits saved: chunks and
+        tokens not sent to the embedding API, and their size in bytes.
+        """
+        stats = self.cache.stats()
+        stats.update({
+            'dtype': self.dtype.name,
+            'texts_saved': self.texts_saved,
+            'tokens_saved': self.tokens_saved,
+            'bytes_saved': self.bytes_saved
+        })
+        return stats
+
+
+def get_embedding_cache():
+    """Returns the shared embedding cache, or None when it is disabled."""
+    global embedding_cache
+    with _embedding_cache_lock:
+        if embedding_cache is None and EMBEDDING_CACHE_MAX_MB > 0:
+            embedding_cache = EmbeddingCache()
+    return embedding_cache
+
+
+def embedding_cache_stats():
+    """Returns the hit/miss counters, size and savings of the embedding cache."""
+    cache = get_embedding_cache()
+    return cache.stats() if cache else {}
@@ -1,171 +1,731 @@
-import spacy
-from langchain_openai import OpenAIEmbeddings
-from langchain_chroma import Chroma
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+import json
 import os
-import sqlite3
+import re
+import threading
+import time
+import uuid
 from dotenv import load_dotenv
+from concurrent.futures import Future
+from langchain_core.documents import Document
+from data.embedding_backends import get_embedding_backend
+from data.embedding_batcher import get_embedding_batcher
+from data.embedding_cache import get_embedding_cache
+from data.vector_store import get_vector_stores
+from utils.text_normalizer import split_pages
+from data.vector_index import get_vector_index
+from data.query_cache import get_query_cache, normalize_query
+from data.lexical_index import (get_lexical_index, reciprocal_rank_fusion, LEXICAL_MIN_COVERAGE,
+                                LEXICAL_FUSION_COVERAGE)
+from data.near_duplicates import get_near_duplicate_index, collapse, DEDUP_SEARCH_FACTOR
+from data.document_router import get_document_router
+from data.availability_index import get_availability_index
     
 load_dotenv()
+
+# Maximum number of chunks written to Chroma in one call
+CHROMA_WRITE_BATCH = int(os.getenv('CHROMA_WRITE_BATCH', 500))
+# Tokens per chunk, at most the input size of the embedding model
+CHUNK_TOKENS = int(os.getenv('CHUNK_TOKENS', 400))
+CHUNK_OVERLAP_TOKENS = int(os.getenv('CHUNK_OVERLAP_TOKENS', 50))
+# Pages or slides with fewer tokens are merged with their neighbours
+CHUNK_MIN_TOKENS = int(os.getenv('CHUNK_MIN_TOKENS', 120))
+# Minimum cosine similarity of the best chunk for a question to count as related to
+# the course. Scores depend on the embedding model, so the threshold is per model.
+# The defaults are not measured on course data: ada-002 packs all similarities into
+# about [0.7, 1], unrelated texts scoring around 0.7 to 0.75, so its cutoff sits just
+# above; the other models spread over the whole range, where 0.3 is the usual cutoff
+# for "same topic". Measure them on labelled questions of a course with
+# service/relevance_calibration.py, then set RELEVANCE_THRESHOLDS, a JSON object of
+# model name to threshold, or RELEVANCE_THRESHOLD for all models
+RELEVANCE_THRESHOLD = os.getenv('RELEVANCE_THRESHOLD')
+MODEL_RELEVANCE_THRESHOLDS = {
+    'text-embedding-ada-002': 0.78,
+    'text-embedding-3-small': 0.3,
+    'text-embedding-3-large': 0.3,
+    'sentence-transformers/all-MiniLM-L6-v2': 0.3,
+    **json.loads(os.getenv('RELEVANCE_THRESHOLDS', '{}')),
+}
+DEFAULT_RELEVANCE_THRESHOLD = 0.3
+# Hits are kept while their margin over the threshold is at least this share of the best hit's
+RETRIEVAL_KEEP_RATIO = float(os.getenv('RETRIEVAL_KEEP_RATIO', 0.5))
+
+QUESTION_WORDS = frozenset({'who', 'what', 'why', 'where', 'when', 'how', 'which', 'whose', 'whom', 'explain',
+                            'describe', 'define', 'list', 'solve', 'give', 'want', 'use'})
+
+# Latency of retrieve() by path: lexical fast path, vector only or hybrid, and of each search and of routing
+_retrieval_stats = {}
+_retrieval_stats_lock = threading.Lock()
+
+
+def similarity(distance, space):
+    """
+    Cosine similarity of a Chroma distance in a collection's hnsw:space. The
+    'cosine' and 'ip' distances are 1 - similarity. The 'l2' distance is
+    squared, ||a - b||^2 = 2 - 2 * cos(a, b) for the unit vectors that all
+    embedding backends produce.
+    """
+    return 1 - distance / 2 if space == 'l2' else 1 - distance
+
+
+def _record_latency(path, seconds):
+    with _retrieval_stats_lock:
+        stats = _retrieval_stats.setdefault(path, {'count': 0, 'seconds': 0.0})
+        stats['count'] += 1
+        stats['seconds'] += seconds
+
+
+def retrieval_stats():
+    """Number and average latency of retrievals of this process, per path."""
+    with _retrieval_stats_lock:
+        return {path: {'count': stats['count'], 'avg_ms': round(stats['seconds'] * 1000 / stats['count'], 2)}
+                for path, stats in _retrieval_stats.items()}
+
+
 class ChromaDBManager:
-    def __init__(self, base_dir=None):
-        base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data', 'chroma_db'))
-        self.chroma_base_dir = base_dir
-        self.embeddings_model = OpenAIEmbeddings()
-        self.course_db_map = {}
-        self.nlp = spacy.load("en_core_web_sm")
-        self._initialize_course_db_map()
-
-    def _initialize_course_db_map(self):
-        """Initialize the Chroma databases for each course in the base directory."""
-        if not os.path.exists(self.chroma_base_dir):
-            os.makedirs(self.chroma_base_dir)
-
-        for course_dir in os.listdir(self.chroma_base_dir):
-            course_path = os.path.join(self.chroma_base_dir, course_dir)
-            if os.path.isdir(course_path):
-                try:
-                    chroma_instance = Chroma(embedding_function=self.embeddings_model, persist_directory=course_path)
-                    self.course_db_map[course_dir] = chroma_instance
-                except Exception as e:
-                    raise RuntimeError(e) 
-
-    def create_course_db(self, course_id):
-        """Create a Chroma database for a new course."""
+    def __init__(self, mongodb=None):
+        # Course collections are opened lazily from one client shared by the process
+        self.vector_stores = get_vector_stores()
+        # Memory-mapped copy of the course indexes that searches use, if enabled
+        self.vector_index = get_vector_index()
+        self.query_cache = get_query_cache()
+        # BM25 over the course texts in MongoDB, for hybrid retrieval
+        self.lexical_index = get_lexical_index(mongodb, self) if mongodb is not None else None
+        # MinHash signatures of the course chunks, to reuse the embeddings of repeated chunks
+        self.near_duplicates = get_near_duplicate_index(self)
+        # Document summaries, to search only the chunks of the best documents of large courses
+        self.document_router = get_document_router(mongodb, self) if mongodb is not None else None
+        # Available documents of the courses; chunks do not carry their availability
+        self.availability = get_availability_index(mongodb) if mongodb is not None else None
+        self._encoding = None
+
+    def create_course_db(self, course_id, embedding_backend=None):
+        """Create the Chroma collection of a new course, embedded with the given backend."""
         try:
-            course_dir = os.path.join(self.chroma_base_dir, f"chroma_course_{course_id}")
-            if not os.path.exists(course_dir):
-                os.makedirs(course_dir)
-            
-            chroma_store = Chroma(embedding_function=self.embeddings_model, persist_directory=course_dir)
-            return chroma_store
+            return self.vector_stores.get(course_id, backend=embedding_backend,
+                                          metadata={'chunker': self.chunker_config()})
         except Exception as e:
             raise RuntimeError(e) 
 
+    def get_embeddings_model(self, course_id=None):
+        """Embedding backend of a course index, or the default backend."""
+        if course_id is None:
+            return get_embedding_backend()
+        return get_embedding_backend(self.vector_stores.backend_of(course_id))
+
+    def embedding_model_id(self, embeddings_model):
+        """Model id used in embedding cache keys, including the vector size if it is reduced."""
+        model_id = getattr(embeddings_model, 'model', type(embeddings_model).__name__)
+        if getattr(embeddings_model, 'dimensions', None):
+            model_id += f"@{embeddings_model.dimensions}"
+        return model_id
+
     def get_course_db(self, course_id):
-        """Fetch the Chroma DB instance for a given course."""
-        course_db_name = f"chroma_course_{course_id}"
-        if course_db_name not in self.course_db_map:
-            db_path = os.path.join("data", "chroma_db", course_db_name, "chroma.sqlite3")
-            self.course_db_map[course_db_name] = sqlite3.connect(db_path)
-        return self.course_db_map[course_db_name]
-
-    def get_chunks(self, text, document_id, chunk_size=1000, chunk_overlap=128):
-        """Split text into chunks and create metadata for each chunk."""
-        text = str(text)
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        """Fetch the Chroma DB instance for a given course, opening it on first use."""
+        return self.vector_stores.get(course_id)
+
+    def remove_course_db(self, course_id):
+        """Drop the Chroma collection of a course."""
         try:
-            chunks = text_splitter.split_text(text)
-            metadata = [{"available": False, "document_id": document_id} for _ in chunks]
+            self.vector_stores.delete(course_id)
+            if self.vector_index is not None:
+                self.vector_index.drop(course_id)
+            if self.lexical_index is not None:
+                self.lexical_index.forget(course_id)
+            if self.near_duplicates is not None:
+                self.near_duplicates.forget(course_id)
+            if self.document_router is not None:
+                self.document_router.forget(course_id)
+        except Exception as e:
+            raise RuntimeError(e)
+
+    def index_changed(self, course_id, document_ids=None):
+        """
+        Called after the vectors of a course changed, of the given documents if
+        known: gives them a new version, which rebuilds the search index and
+        bypasses cached results.
+        """
+        self.vector_stores.mark_changed(course_id, document_ids=document_ids)
+
+    def _load_course_vectors(self, course_id):
+        results = self.get_course_db(course_id).get(include=["documents", "embeddings", "metadatas"])
+        return results['documents'], results['embeddings'], results['metadatas']
+
+    def add_lexical_document(self, course_id, document_id, extracted_text, extracted_pages=None):
+        """Adds the text of a newly ingested document to the course's BM25 index."""
+        if self.lexical_index is not None:
+            self.lexical_index.add_document(course_id, document_id, extracted_text, extracted_pages)
+
+    def relevance_threshold(self, course_id):
+        """Relevance threshold of the embedding model of a course index."""
+        if RELEVANCE_THRESHOLD:
+            return float(RELEVANCE_THRESHOLD)
+        model_name = self.vector_stores.backend_of(course_id).partition(':')[2]
+        return MODEL_RELEVANCE_THRESHOLDS.get(model_name, DEFAULT_RELEVANCE_THRESHOLD)
+
+    def get_chunks(self, text, document_id, course_id=None):
+        """
+        Split a document's text (a list of lines or a string) into chunks and
+        create metadata for each chunk. The text is one unit without page
+        numbers; iter_chunks chunks by page.
+        """
+        try:
+            chunks, metadata = [], []
+            for batch_chunks, batch_metadata in self.iter_chunks(split_pages(text), document_id, course_id):
+                chunks.extend(batch_chunks)
+                metadata.extend(batch_metadata)
             return chunks, metadata
         except Exception as e:
             raise RuntimeError(e) 
 
-    def create_embeddings(self, chunks, metadatas, course_db):
+    def chunk_tokens(self, course_id=None, embeddings_model=None):
+        """Token budget of a chunk for the embedding model of a course: CHUNK_TOKENS, at most its input size."""
+        if embeddings_model is None:
+            embeddings_model = self.get_embeddings_model(course_id)
+        return min(CHUNK_TOKENS, getattr(embeddings_model, 'max_tokens', CHUNK_TOKENS))
+
+    def chunker_config(self):
+        """Chunking parameters of new indexes, recorded on their collection."""
+        return f"tokens={CHUNK_TOKENS},overlap={CHUNK_OVERLAP_TOKENS},min={CHUNK_MIN_TOKENS}"
+
+    def iter_chunks(self, pages, document_id, course_id=None, batch_size=64, embeddings_model=None):
+        """
+        Splits pages or slides into chunks as they arrive and yields
+        (chunks, metadata) batches of up to batch_size chunks.
+
+        pages yields (page_number, lines) tuples. Chunks are sized in tokens of
+        the course's embedding model (see chunk_tokens): a page that fits
+        becomes one chunk, pages under CHUNK_MIN_TOKENS are merged with their
+        neighbours and longer pages are split with CHUNK_OVERLAP_TOKENS of
+        overlap. The metadata of a chunk records its first and last page.
+        embeddings_model replaces the course's model, e.g. for a rebuild.
+        """
+        try:
+            batch = []
+            for chunk in self._page_chunks(pages, course_id, embeddings_model):
+                batch.append(chunk)
+                if len(batch) >= batch_size:
+                    yield self._chunk_batch(batch, document_id)
+                    batch = []
+            if batch:
+                yield self._chunk_batch(batch, document_id)
+        except Exception as e:
+            raise RuntimeError(e)
+
+    def _page_chunks(self, pages, course_id, embeddings_model=None):
+        """Yields (text, first_page, last_page) chunks, see iter_chunks."""
+        if embeddings_model is None:
+            embeddings_model = self.get_embeddings_model(course_id)
+        budget = self.chunk_tokens(course_id, embeddings_model)
+
+        def count(text):
+            return self.count_tokens([text], embeddings_model)
+
+        def merged(group):
+            return "\n".join(text for _, text in group), group[0][0], group[-1][0]
+
+        splitter = RecursiveCharacterTextSplitter(chunk_size=budget, chunk_overlap=min(CHUNK_OVERLAP_TOKENS, budget // 4),
+                                                  length_function=count)
+        # The previous group of pages is held back, so a small last group can still join it
+        held = None
+        group, group_tokens = [], 0
+        for page_number, lines in pages:
+            text = "\n".join(line for line in lines if line)
+            if not text:
+                continue
+            tokens = count(text)
+            units = [(part, count(part)) for part in splitter.split_text(text)] if tokens > budget else [(text, tokens)]
+            for unit, unit_tokens in units:
+                if group and (group_tokens >= CHUNK_MIN_TOKENS or group_tokens + unit_tokens > budget):
+                    if held is not None:
+                        yield merged(held[0])
+                    held = (group, group_tokens)
+                    group, group_tokens = [], 0
+                group.append((page_number, unit))
+                group_tokens += unit_tokens
+
+        if group and held is not None and group_tokens < CHUNK_MIN_TOKENS and held[1] + group_tokens <= budget:
+            held = (held[0] + group, held[1] + group_tokens)
+            group = []
+        if held is not None:
+            yield merged(held[0])
+        if group:
+            yield merged(group)
+
+    def _chunk_batch(self, batch, document_id):
+        chunks = [text for text, _, _ in batch]
+        metadatas = self._chunk_metadata(chunks, document_id)
+        for metadata, (_, first_page, last_page) in zip(metadatas, batch):
+            if first_page is not None:
+                metadata['page'] = first_page
+                metadata['last_page'] = last_page
+        return chunks, metadatas
+
+    def _chunk_metadata(self, chunks, document_id):
+        return [{"available": False, "document_id": document_id} for _ in chunks]
+
+    def count_tokens(self, chunks, embeddings_model=None):
+        """
+        Number of tokens in the chunks: by the tokenizer of the given embedding
+        model if it has one, otherwise by OpenAI's cl100k_base, estimated from
+        their length if tiktoken is missing.
+        """
+        if embeddings_model is not None and hasattr(embeddings_model, 'count_tokens'):
+            return embeddings_model.count_tokens(chunks)
+        if self._encoding is None:
+            try:
+                import tiktoken
+                self._encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception:
+                self._encoding = False
+        if not self._encoding:
+            return sum(len(chunk) for chunk in chunks) // 4
+        return sum(len(tokens) for tokens in self._encoding.encode_batch(chunks, disallowed_special=()))
+
+    def new_chunk_id(self):
+        return str(uuid.uuid4())
+
+    def deduplicate(self, course_id, document_id, chunks, metadatas):
+        """
+        Drops the chunks that repeat earlier chunks of the document and links
+        those that repeat chunks of other documents of the course, see
+        NearDuplicateIndex.deduplicate.
+
+        Returns:
+            tuple: (chunks, metadatas, ids, dropped); ids is None if deduplication is disabled.
+        """
+        if self.near_duplicates is None:
+            return chunks, metadatas, None, 0
+        return self.near_duplicates.deduplicate(course_id, document_id, chunks, metadatas)
+
+    def embed_unique_chunks_async(self, chunks, metadatas, course_id=None):
+        """
+        Like embed_chunks_async, for chunks returned by deduplicate: chunks
+        linked to another one with metadata['duplicate_of'] are not embedded,
+        their embeddings are None until linked_embeddings fills them in.
+        """
+        unique = [index for index, metadata in enumerate(metadatas) if 'duplicate_of' not in metadata]
+        if len(unique) == len(chunks):
+            return self.embed_chunks_async(chunks, course_id)
+        future = Future()
+        if not unique:
+            future.set_result([None] * len(chunks))
+            return future
+
+        def link(request):
+            try:
+                embeddings = [None] * len(chunks)
+                for index, embedding in zip(unique, request.result()):
+                    embeddings[index] = embedding
+                future.set_result(embeddings)
+            except Exception as e:
+                future.set_exception(e)
+
+        self.embed_chunks_async([chunks[index] for index in unique], course_id).add_done_callback(link)
+        return future
+
+    def linked_embeddings(self, course_id, course_db, chunks, metadatas, embeddings, ids):
+        """
+        Fills in the embeddings of linked chunks with those of the chunks they
+        repeat, from the same batch or from the collection. A chunk whose
+        original was deleted in the meantime is embedded after all.
+        """
+        missing = [index for index, embedding in enumerate(embeddings) if embedding is None]
+        if not missing:
+            return embeddings
+        embeddings = list(embeddings)
+        known = {chunk_id: embedding for chunk_id, embedding in zip(ids, embeddings) if embedding is not None}
+        stored_ids = sorted({metadatas[index]['duplicate_of'] for index in missing} - set(known))
+        if stored_ids:
+            stored = course_db._collection.get(ids=stored_ids, include=["embeddings"])
+            known.update(zip(stored['ids'], stored['embeddings']))
+        orphans = []
+        for index in missing:
+            embedding = known.get(metadatas[index]['duplicate_of'])
+            if embedding is None:
+                orphans.append(index)
+                metadatas[index].pop('duplicate_of')
+            embeddings[index] = embedding
+        if orphans:
+            for index, embedding in zip(orphans, self.embed_chunks([chunks[index] for index in orphans], course_id)):
+                embeddings[index] = embedding
+        return embeddings
+
+    def chunks_written(self, course_id, ids):
+        if self.near_duplicates is not None and ids is not None:
+            self.near_duplicates.written(course_id, ids)
+
+    def embed_chunks(self, chunks, course_id=None, embeddings_model=None):
+        """Generate embeddings for a list of chunks, in batched requests."""
+        try:
+            return self.embed_chunks_async(chunks, course_id, embeddings_model).result()
+        except Exception as e:
+            raise RuntimeError(e)
+
+    def embed_chunks_async(self, chunks, course_id=None, embeddings_model=None):
+        """
+        Returns a Future of the embeddings of the chunks, computed by the
+        embedding backend of the course, or embeddings_model. Chunks found in
+        the embedding cache are not embedded again; the others are queued on
+        the embedding batcher and added to the cache once embedded.
+        """
+        if embeddings_model is None:
+            embeddings_model = self.get_embeddings_model(course_id)
+        batcher = get_embedding_batcher(embeddings_model, self.count_tokens)
+        model_id = self.embedding_model_id(embeddings_model)
+        cache = get_embedding_cache()
+        if cache is None:
+            return batcher.submit(chunks)
+
+        embeddings = cache.get_many(model_id, chunks, self.count_tokens)
+        missing = [index for index, embedding in enumerate(embeddings) if embedding is None]
+        future = Future()
+        if not missing:
+            future.set_result(embeddings)
+            return future
+
+        missing_chunks = [chunks[index] for index in missing]
+
+        def fill(request):
+            try:
+                new_embeddings = request.result()
+                cache.set_many(model_id, missing_chunks, new_embeddings)
+                for index, embedding in zip(missing, new_embeddings):
+                    embeddings[index] = embedding
+                future.set_result(embeddings)
+            except Exception as e:
+                future.set_exception(e)
+
+        batcher.submit(missing_chunks).add_done_callback(fill)
+        return future
+
+    def add_embeddings(self, course_db, chunks, metadatas, embeddings, ids=None):
+        """
+        Save chunks with precomputed embeddings to the Chroma database.
+
+        Writes to the underlying collection directly, since Chroma.add_texts
+        would embed the chunks a second time, in sub-batches of at most
+        CHROMA_WRITE_BATCH chunks to bound the size of each write.
+        """
+        try:
+            if ids is None:
+                ids = [self.new_chunk_id() for _ in chunks]
+            for start in range(0, len(chunks), CHROMA_WRITE_BATCH):
+                end = start + CHROMA_WRITE_BATCH
+                course_db._collection.add(
+                    ids=ids[start:end],
+                    embeddings=embeddings[start:end],
+                    documents=chunks[start:end],
+                    metadatas=metadatas[start:end]
+                )
+        except Exception as e:
+            raise RuntimeError(e)
+
+    def create_embeddings(self, chunks, metadatas, course_db, course_id=None):
         """Generate embeddings and save them to the Chroma database."""
         try:
-            embeddings = [self.embeddings_model.embed_query(chunk) for chunk in chunks]
-            course_db.add_texts(texts=chunks, metadatas=metadatas, embeddings=embeddings)
+            if course_id is None or not chunks:
+                self.add_embeddings(course_db, chunks, metadatas, self.embed_chunks(chunks, course_id))
+                return
+            document_id = metadatas[0]['document_id']
+            chunks, metadatas, ids, _ = self.deduplicate(course_id, document_id, chunks, metadatas)
+            embeddings = self.embed_unique_chunks_async(chunks, metadatas, course_id).result()
+            embeddings = self.linked_embeddings(course_id, course_db, chunks, metadatas, embeddings, ids)
+            self.add_embeddings(course_db, chunks, metadatas, embeddings, ids)
+            self.chunks_written(course_id, ids)
+            self.index_changed(course_id, [document_id])
         except Exception as e:
             raise RuntimeError(e)
 
+    def index_generation(self, course_id):
+        """Collection name of the active generation of a course index."""
+        return self.vector_stores.active(course_id)
+
+    def index_status(self, course_id):
+        """
+        The generations of a course index with the embedding backend and
+        chunker each was built with, and whether the active one is built with
+        the configured chunker ('current').
+        """
+        generations = self.vector_stores.generations(course_id)
+
+        def describe(name):
+            metadata = self.vector_stores.generation_metadata(name) or {}
+            return {'collection': name, 'embedding_backend': metadata.get('embedding_backend'),
+                    'chunker': metadata.get('chunker')}
+
+        active = describe(generations['active'])
+        return {
+            'active': active,
+            'previous': [describe(name) for name in generations['previous']],
+            'building': generations.get('building'),
+            'chunker': self.chunker_config(),
+            'current': active['chunker'] == self.chunker_config()
+        }
+
+    def rebuild_document(self, store, embeddings_model, document_id, extracted_text, extracted_pages=None,
+                         batch_size=64):
+        """
+        Chunks and embeds a document's stored text into a generation being
+        built, with that generation's embedding model. Returns the number of chunks.
+        """
+        try:
+            count = 0
+            pages = split_pages(extracted_text, extracted_pages)
+            for chunks, metadatas in self.iter_chunks(pages, str(document_id), batch_size=batch_size,
+                                                      embeddings_model=embeddings_model):
+                self.add_embeddings(store, chunks, metadatas, self.embed_chunks(chunks, embeddings_model=embeddings_model))
+                count += len(chunks)
+            return count
+        except Exception as e:
+            raise RuntimeError(e)
+
+    def reindex_document(self, course_id, document_id, extracted_text, extracted_pages=None):
+        """
+        Chunks and embeds a document's stored text again into the active index
+        of its course, e.g. when the index was swapped while it was ingested.
+        """
+        course_db = self.get_course_db(course_id)
+        self.remove_stored_document(course_db, document_id)
+        chunks = self.rebuild_document(course_db, self.get_embeddings_model(course_id), document_id, extracted_text,
+                                       extracted_pages)
+        self.index_changed(course_id, [document_id])
+        return chunks
+
+    def stored_document_ids(self, store):
+        """Ids of the documents that have chunks in a store."""
+        results = store._collection.get(include=["metadatas"])
+        return {str(metadata.get('document_id')) for metadata in results['metadatas'] if metadata}
+
+    def remove_stored_document(self, store, document_id):
+        """Removes the chunks of a document from a store other than an active course index."""
+        store._collection.delete(where={"document_id": str(document_id)})
+
     def store_vector(self, course_id, document_id, extracted_text):
         """Store extracted text as embeddings in the course-specific Chroma database."""
         try:
             course_db = self.get_course_db(course_id)
-            chunks, metadata = self.get_chunks(extracted_text, document_id)
-            self.create_embeddings(chunks, metadata, course_db)
+            chunks, metadata = self.get_chunks(extracted_text, document_id, course_id)
+            self.create_embeddings(chunks, metadata, course_db, course_id)
             print("Embeddings are created successfully.")
         except Exception as e:
             raise RuntimeError(e)
         
-    def change_availability(self, course_id, document_id, available):
+    def availability_filter(self, document_ids):
         """
-        Change the availability of a document in the Chroma database using langchain_chroma.
-        
+        Chroma filter restricting a search to the given documents, used in place
+        of the 'available' metadata flag. See data/availability_index.py.
+        """
+        return {"document_id": {"$in": sorted(document_ids)}}
+
+    def available_documents(self, course_id, document_ids=None):
+        """document_ids, or the available documents of the course if None and the availability index is known."""
+        if document_ids is None and self.availability is not None:
+            return self.availability.get(str(course_id))
+        return document_ids
+
+    def is_question(self, query_text):
+        """Whether the query looks like a question: a question word or a trailing question mark."""
+        return bool(QUESTION_WORDS.intersection(re.findall(r"\w+", query_text.lower()))) or query_text.endswith('?')
+
+    def embed_query(self, course_id, query_text):
+        """
+        Embedding of a query by the backend of a course. It is cached by
+        normalized text, but the query is embedded as the student wrote it,
+        since case and punctuation carry meaning for the embedding models.
+        """
+        embeddings_model = self.get_embeddings_model(course_id)
+        key = (self.embedding_model_id(embeddings_model), normalize_query(query_text))
+        embedding = self.query_cache.embeddings.get(key)
+        if embedding is None:
+            embedding = embeddings_model.embed_query(query_text)
+            self.query_cache.embeddings.set(key, embedding)
+        return embedding
+
+    def scored_search(self, course_id, query_text, k, document_ids=None):
+        """
+        Embeds the query once and returns the k most similar chunks as Documents,
+        best first, with their cosine similarity in metadata['score'].
+        When document_ids is given, only these documents are searched.
+
+        Near-duplicates of a better hit are left out. Results are cached until
+        the course's vectors change or a different set of documents is searched;
+        results of a search index still being rebuilt are not cached.
+        """
+        if document_ids is not None and not document_ids:
+            return []
+        course_id = str(course_id)
+        version = self.vector_stores.version(course_id)
+        searched = frozenset(document_ids) if document_ids is not None else None
+        key = (course_id, normalize_query(query_text), k, searched, version)
+        hits = self.query_cache.results.get(key)
+        if hits is None:
+            # Near-duplicate chunks of revised uploads would crowd out the others
+            hits, current = self._scored_search(course_id, query_text, k * DEDUP_SEARCH_FACTOR, document_ids,
+                                                version)
+            hits = collapse(hits)[:k]
+            if current:
+                self.query_cache.results.set(key, hits)
+        return list(hits)
+
+    def _scored_search(self, course_id, query_text, k, document_ids, version):
+        """(hits, current); current is False if they come from an older version of the search index."""
+        query_embedding = self.embed_query(course_id, query_text)
+        if self.vector_index is not None and document_ids is not None:
+            index = self.vector_index.get(course_id, version, lambda: self._load_course_vectors(course_id))
+            return [Document(page_content=text, metadata={"document_id": document_id, "score": score})
+                    for text, document_id, score in self.vector_index.search(index, query_embedding, k, document_ids)
+                    ], index.version == version
+
+        filters = self.availability_filter(document_ids) if document_ids is not None else None
+        course_db = self.get_course_db(course_id)
+        space = (course_db._collection.metadata or {}).get('hnsw:space', 'l2')
+        # Despite its name this returns distances
+        results = course_db.similarity_search_by_vector_with_relevance_scores(query_embedding, k=k, filter=filters)
+        hits = []
+        for document, distance in results:
+            document.metadata['score'] = similarity(distance, space)
+            hits.append(document)
+        return hits, True
+
+    def retrieve(self, course_id, query_text, k=3, document_ids=None, threshold=None):
+        """
+        Finds the chunks to answer a student's query from, with at most one
+        embedding and one scored vector search.
+
+        On courses with many available documents, the vector search is
+        restricted to the documents whose summaries match the question best
+        (see DocumentRouter); BM25 still searches all of them.
+
+        With the lexical index and a document_ids filter, keyword-shaped queries
+        ("np.linalg.norm", "homework 3") are answered from BM25 alone, without
+        an embedding. Questions run both searches and fuse their hits with
+        reciprocal-rank fusion; a question is related if either search finds a
+        good enough chunk, so exact course terms are not missed.
+
         Args:
-            course_id (str): The ID of the course
-            document_id (str): The ID of the document to update
-            available (bool): The new availability status
+            k (int): Maximum number of chunks.
+            document_ids (set): Documents to search, the available documents of the course by default.
+            threshold (float): Relevance threshold, the model's calibrated one by default.
+
+        Returns:
+            tuple: (hits, related). related is False if the query is not a question
+            or no chunk is relevant enough; hits are then empty. Otherwise hits are
+            the best chunks, with metadata['score'] for vector hits, without
+            those much weaker than the best one (see RETRIEVAL_KEEP_RATIO).
         """
-        try:
-            course_db = self.get_course_db(course_id)
-            # Get all entries matching the document_id
-            results = course_db.get(where={"document_id": document_id})
-            
-            if not results or not results['ids']:
-                print(f"Document ID {document_id} not found in Chroma DB for course ID {course_id}.")
-                return
-            
-            # Delete existing entries
-            course_db.delete(ids=results['ids'])
-            
-            # Recreate entries with updated metadata
-            texts = results['documents']
-            embeddings = results['embeddings']
-            updated_metadata = [{
-                "available": available,
-                "document_id": document_id
-            } for _ in texts]
-            
-            # Add texts back with updated metadata
-            course_db.add_texts(
-                texts=texts,
-                metadatas=updated_metadata,
-                embeddings=embeddings
-            )
-            
-            print(f"Availability of document ID {document_id} changed successfully.")
-        except Exception as e:
-            raise RuntimeError(f"Error changing availability: {e}")
+        started = time.perf_counter()
+        query_text = str(query_text)
+        document_ids = self.available_documents(course_id, document_ids)
+        is_question = self.is_question(query_text)
+        lexical = self.lexical_index is not None and document_ids is not None
+        if lexical and not is_question and self.lexical_index.is_keyword_query(query_text):
+            hits = self.lexical_index.search(course_id, query_text, k * DEDUP_SEARCH_FACTOR, document_ids)
+            hits = collapse([hit for hit in hits if hit.metadata['coverage'] >= LEXICAL_FUSION_COVERAGE])[:k]
+            related = bool(hits) and hits[0].metadata['coverage'] >= LEXICAL_MIN_COVERAGE
+            _record_latency('lexical', time.perf_counter() - started)
+            return (hits, True) if related else ([], False)
+        if not is_question:
+            return [], False
+
+        searched = document_ids
+        if self.document_router is not None and document_ids is not None:
+            routing_started = time.perf_counter()
+            searched = self.document_router.route(course_id, query_text, self.embed_query(course_id, query_text),
+                                                  document_ids)
+            _record_latency('routing', time.perf_counter() - routing_started)
+        hits = self.scored_search(course_id, query_text, k, document_ids=searched)
+        _record_latency('vector_search', time.perf_counter() - started)
+        if threshold is None:
+            threshold = self.relevance_threshold(course_id)
+        related = bool(hits) and hits[0].metadata['score'] >= threshold
+        if related:
+            cutoff = threshold + RETRIEVAL_KEEP_RATIO * (hits[0].metadata['score'] - threshold)
+            hits = [hit for hit in hits if hit.metadata['score'] >= cutoff]
+        else:
+            hits = []
+        if not lexical:
+            _record_latency('vector', time.perf_counter() - started)
+            return hits, related
 
-    def is_question_related(self, query_text, course_id, similarity_threshold=0.2):
+        lexical_started = time.perf_counter()
+        lexical_hits = self.lexical_index.search(course_id, query_text, k, document_ids)
+        lexical_hits = [hit for hit in lexical_hits if hit.metadata['coverage'] >= LEXICAL_FUSION_COVERAGE]
+        _record_latency('lexical_search', time.perf_counter() - lexical_started)
+        related = related or (bool(lexical_hits) and lexical_hits[0].metadata['coverage'] >= LEXICAL_MIN_COVERAGE)
+        hits = collapse(reciprocal_rank_fusion([hits, lexical_hits]))[:k] if related else []
+        _record_latency('hybrid', time.perf_counter() - started)
+        return hits, related
+
+    def is_question_related(self, query_text, course_id, similarity_threshold=None, document_ids=None):
         """
         Determine if a query is both a valid question and related to the course PPTs.
+        Use retrieve() to get the matching chunks from the same search.
 
         Args:
             query_text (str): The user's query.
             course_id (str): The course ID to search in the Chroma DB.
             similarity_threshold (float): Threshold for determining relevance.
+            document_ids (set): Documents to compare with, the available documents of the course by default.
 
         Returns:
             bool: True if the query is valid and related, False otherwise.
         """
         try:
-            # Step 1: Check if the query is a question
-            question_words = {'who', 'what', 'why', 'where', 'when', 'how', 'which', 'whose', 'whom', 'explain', 'describe', 'define', 'list', 'solve', 'give', 'want', 'use'}
-            doc = self.nlp(query_text)
-            
-            # Check for common question patterns
-            is_question = any(token.text.lower() in question_words for token in doc) or query_text.endswith('?')
+            return self.retrieve(course_id, query_text, 1, document_ids, similarity_threshold)[1]
+        except Exception as e:
+            raise RuntimeError(f"Error in determining if query is valid and related: {e}")
+        
+    def copy_document(self, source_course_id, source_document_id, course_id, document_id, batch_size=256):
+        """
+        Copies the chunks and embeddings of a document to another course,
+        e.g. for a file uploaded to several courses, without embedding it again.
 
-            if not is_question:
-                return False  # Not a valid question
+        Returns:
+            int: The number of chunks copied.
+        """
+        try:
+            if self.vector_stores.backend_of(source_course_id) != self.vector_stores.backend_of(course_id):
+                print(f"Courses {source_course_id} and {course_id} use different embedding backends.")
+                return 0
+            source_db = self.get_course_db(source_course_id)
+            results = source_db.get(where={"document_id": source_document_id},
+                                    include=["documents", "embeddings", "metadatas"])
+            if not results or not results['ids']:
+                return 0
 
-            # Step 2: Perform a semantic relevance check with Chroma DB
             course_db = self.get_course_db(course_id)
-            results = course_db.similarity_search(query_text, k=1, filter={"available": True})
-
-            if results and len(results) > 0:
-                top_result = results[0]
-                similarity_score = top_result.metadata.get("similarity_score", 1)
-                if similarity_score >= similarity_threshold:
-                    return True  # Question is related
-
-            return False  # Question is not related
+            chunks = results['documents']
+            embeddings = results['embeddings']
+            # Keep the page numbers of the chunks; links to chunks of the source course do not apply
+            metadatas = [{key: value for key, value in (metadata or {}).items() if key != 'duplicate_of'}
+                         for metadata in results['metadatas']]
+            for metadata in metadatas:
+                metadata.update({"available": False, "document_id": document_id})
+            for start in range(0, len(chunks), batch_size):
+                end = start + batch_size
+                self.add_embeddings(course_db, chunks[start:end], metadatas[start:end], embeddings[start:end])
+            self.index_changed(course_id, [document_id])
+            return len(chunks)
         except Exception as e:
-            raise RuntimeError(f"Error in determining if query is valid and related: {e}")
-        
-    def search_vector(self, course_id, query_text, k=3, filters={"available": True}):
-        """Search for similar vectors in the Chroma database based on the query text."""
+            raise RuntimeError(e)
+
+    def search_vector(self, course_id, query_text, k=3, document_ids=None):
+        """
+        Search for similar vectors in the Chroma database based on the query text.
+        Only the given documents are searched, by default the available ones,
+        and BM25 hits are fused in if the lexical index is enabled.
+        """
         try:
-            query_text = str(query_text)
-            if not self.is_question_related(query_text,course_id):
+            document_ids = self.available_documents(course_id, document_ids)
+            if document_ids is not None and not document_ids:
+                print("No documents available to the assistant.")
+                return "No Context"
+            hits, related = self.retrieve(course_id, query_text, k, document_ids)
+            if not related:
                 print("Unrelated question.")
                 return "No Context"
-            course_db = self.get_course_db(course_id)
-            results = course_db.similarity_search(query_text, k, filter=filters)
-            return [result.page_content.split('\n') for result in results]
+            return [hit.page_content.split('\n') for hit in hits]
         except Exception as e:
             raise RuntimeError(e)
         
@@ -182,8 +742,13 @@ class ChromaDBManager:
                 ids_to_delete = []
 
             # Delete the embeddings if any IDs were found
+            if self.lexical_index is not None:
+                self.lexical_index.remove_document(course_id, document_id)
+            if self.near_duplicates is not None:
+                self.near_duplicates.remove_document(course_id, document_id)
             if ids_to_delete:
                 course_db.delete(ids=ids_to_delete)
+                self.index_changed(course_id, [document_id])
                 print(f"Embeddings for document_id {document_id} removed from Chroma DB.")
                 remaining_embeddings = course_db.get( where={"document_id": document_id})
                 if 'ids' in remaining_embeddings and not remaining_embeddings['ids']:
@@ -208,11 +773,7 @@ class ChromaDBManager:
             list: relevant results based on the document_ids.
         """
         try:
-            query_text = str(query_text)
-            course_db = self.get_course_db(course_id)
-
-            results = course_db.similarity_search(query_text, k=k, filter={"document_id": {"$in": document_ids}})
-            return results
+            return self.scored_search(course_id, str(query_text), k, document_ids=document_ids)
         except Exception as e:
             raise RuntimeError(f"Error searching vectors by document_id: {e}")
 
@@ -220,8 +781,7 @@ class ChromaDBManager:
 # extracted_text = "The quick brown fox jumps over the lazy dog."
 #db.create_course_db(3)
 #db.store_vector(3, 1, extracted_text)
-# db.change_availability(3, 1, True)
-# result = db.search_vector(3, "over", k=5,filters={"available": True})
+# result = db.search_vector(3, "over", k=5)
 # for i, item in enumerate(result, start=1):
 #      print(f"Result {i}:")
 #      print(f"Content Snippet:\n{item}\n")
@@ -0,0 +1,173 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from langchain_core.documents import Document
+
+# Courses searched at the same time by all the federated searches of this process
+FEDERATED_CONCURRENCY = int(os.getenv('FEDERATED_CONCURRENCY', 8))
+# A federated search returns after this many seconds with the courses answered so far
+FEDERATED_BUDGET_SECONDS = float(os.getenv('FEDERATED_BUDGET_SECONDS', 2.0))
+# Hits a single course may contribute to a federated search
+FEDERATED_COURSE_QUOTA = int(os.getenv('FEDERATED_COURSE_QUOTA', 3))
+
+
+class FederatedSearch:
+    """
+    Searches all the courses a student is enrolled in with one query.
+
+    Every course is searched in parallel with ChromaDBManager.retrieve,
+    restricted to its own available documents and judged against its own
+    relevance threshold, so only related courses contribute. The query is
+    embedded once per embedding backend before the fan-out. Courses that did
+    not answer within the latency budget are left out of the results and
+    reported. All searches share one pool of FEDERATED_CONCURRENCY threads:
+    on timeout the courses not started yet are dropped, and those already
+    running finish in the background and fill the query cache. Until such a
+    search ends, its course is not searched again but reported as timed out
+    at once, so that a slow course holds at most one thread however often it
+    is asked.
+
+    The hits of the related courses are interleaved by rank, each course
+    contributing at most its quota: first every course's best hit, the
+    course whose best hit is furthest above its threshold first, then every
+    course's second hit, and so on. Scores of different courses are not
+    compared directly, since their embedding models may differ.
+    """
+
+    def __init__(self, mongodb, chroma_db_manager, availability, concurrency=FEDERATED_CONCURRENCY):
+        self.mongodb = mongodb
+        self.chroma_db_manager = chroma_db_manager
+        self.availability = availability
+        self._executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='federated-search')
+        # Courses whose search outlived the budget of its federated search and still runs
+        self._overdue = set()
+        self.stats = {'searches': 0, 'courses': 0, 'timed_out': 0, 'failed': 0, 'seconds': 0.0}
+        self._lock = threading.Lock()
+
+    def _search_course(self, course_id, query_text, k, embedded, budget):
+        if embedded is not None:
+            # Embedded for another course of the same backend; the query cache holds it. If that
+            # is late or failed, retrieve embeds the query itself
+            wait([embedded], timeout=budget)
+        document_ids = self.availability.get(course_id)
+        if not document_ids:
+            return [], False
+        return self.chroma_db_manager.retrieve(course_id, query_text, k, document_ids=document_ids)
+
+    def search(self, course_ids, query_text, k=5, quota=FEDERATED_COURSE_QUOTA, budget=FEDERATED_BUDGET_SECONDS):
+        """
+        Searches the given courses for a query.
+
+        Returns:
+            tuple: (hits, report). hits are at most k Documents with
+            metadata['course_id']. report lists the courses 'searched', those
+            'related' to the query, those that 'timed_out' and those that
+            'failed' (with the error), and the latency in 'ms'.
+        """
+        started = time.perf_counter()
+        course_ids = list(dict.fromkeys(str(course_id) for course_id in course_ids))
+        query_text = str(query_text)
+        with self._lock:
+            overdue = [course_id for course_id in course_ids if course_id in self._overdue]
+        free = [course_id for course_id in course_ids if course_id not in overdue]
+
+        embedded = {}
+        if free and self.chroma_db_manager.is_question(query_text):
+            by_backend = {}
+            # Submitted first, so that they are running before the searches waiting for them
+            for course_id in free:
+                backend = self.chroma_db_manager.vector_stores.backend_of(course_id)
+                if backend not in by_backend:
+                    by_backend[backend] = self._executor.submit(self.chroma_db_manager.embed_query, course_id,
+                                                                query_text)
+                embedded[course_id] = by_backend[backend]
+        futures = {
+            self._executor.submit(self._search_course, course_id, query_text, min(k, quota),
+                                  embedded.get(course_id), budget): course_id
+            for course_id in free
+        }
+        done, not_done = wait(futures, timeout=budget)
+        # Drops the work not started yet; running searches end on their own
+        for future in embedded.values():
+            future.cancel()
+        for future in not_done:
+            if not future.cancel():
+                self._mark_overdue(futures[future], future)
+
+        results = {}
+        failed = {}
+        for future in done:
+            course_id = futures[future]
+            try:
+                hits, related = future.result()
+            except Exception as e:
+                failed[course_id] = str(e)
+                continue
+            if related and hits:
+                results[course_id] = hits[:quota]
+
+        def strength(course_id):
+            best = results[course_id][0].metadata
+            if 'score' in best:
+                return best['score'] - self.chroma_db_manager.relevance_threshold(course_id)
+            return 0.0
+
+        ranked_courses = sorted(results, key=strength, reverse=True)
+        hits = []
+        for rank in range(quota):
+            for course_id in ranked_courses:
+                if rank < len(results[course_id]):
+                    hit = results[course_id][rank]
+                    # Hits are shared with the query cache
+                    hits.append(Document(page_content=hit.page_content,
+                                         metadata={**hit.metadata, 'course_id': course_id}))
+        hits = hits[:k]
+
+        seconds = time.perf_counter() - started
+        timed_out = sorted(overdue + [futures[future] for future in not_done])
+        with self._lock:
+            self.stats['searches'] += 1
+            self.stats['courses'] += len(course_ids)
+            self.stats['timed_out'] += len(timed_out)
+            self.stats['failed'] += len(failed)
+            self.stats['seconds'] += seconds
+        return hits, {'searched': course_ids, 'related': ranked_courses, 'timed_out': timed_out, 'failed': failed,
+                      'ms': round(seconds * 1000, 2)}
+
+    def _mark_overdue(self, course_id, future):
+        with self._lock:
+            self._overdue.add(course_id)
+
+        def release(_):
+            with self._lock:
+                self._overdue.discard(course_id)
+
+        # Runs at once if the search has just ended
+        future.add_done_callback(release)
+
+    def search_enrolled(self, student_id, query_text, k=5):
+        """Searches all the courses a student is enrolled in, see search()."""
+        return self.search(self.mongodb.get_student_course_ids(student_id), query_text, k)
+
+    def search_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        searches = stats['searches']
+        return {**stats, 'avg_ms': round(stats['seconds'] * 1000 / searches, 2) if searches else 0.0}
+
+
+federated_search = None
+_federated_search_lock = threading.Lock()
+
+
+def get_federated_search(mongodb, chroma_db_manager, availability):
+    """Returns the federated search shared by all sessions of this process, or None if it is disabled."""
+    global federated_search
+    if FEDERATED_CONCURRENCY <= 0:
+        return None
+    with _federated_search_lock:
+        if federated_search is None:
+            federated_search = FederatedSearch(mongodb, chroma_db_manager, availability)
+    return federated_search
@@ -0,0 +1,299 @@
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+from langchain_core.documents import Document
+
+from utils.text_normalizer import split_pages
+
+# Hybrid retrieval: BM25 over the course texts next to the vector search
+LEXICAL_SEARCH = os.getenv('LEXICAL_SEARCH', 'true').lower() == 'true'
+BM25_K1 = float(os.getenv('BM25_K1', 1.5))
+BM25_B = float(os.getenv('BM25_B', 0.75))
+# How long a course index is used before MongoDB is checked for ingested or deleted files
+LEXICAL_REFRESH_SECONDS = float(os.getenv('LEXICAL_REFRESH_SECONDS', 30))
+# Queries of at most this many terms that are not questions are answered from BM25 alone
+LEXICAL_FAST_PATH_TERMS = int(os.getenv('LEXICAL_FAST_PATH_TERMS', 3))
+# Share of the query terms a chunk must contain to make a query related on its own,
+# and to be fused with the vector hits
+LEXICAL_MIN_COVERAGE = float(os.getenv('LEXICAL_MIN_COVERAGE', 0.75))
+LEXICAL_FUSION_COVERAGE = float(os.getenv('LEXICAL_FUSION_COVERAGE', 0.5))
+
+STOPWORDS = frozenset("""
+a an and are as at be but by can could did do does for from had has have how i if in into is it its
+me my of on or our should so than that the their them then there these they this to was we were what
+when where which who whom whose why will with would you your explain describe define tell about give
+""".split())
+
+_TOKEN = re.compile(r"\w+(?:[.\-:]\w+)*")
+
+
+def _stem(word):
+    # Plurals only: "sequences" matches "sequence", "class" stays "class"
+    if len(word) > 3 and word.endswith('s') and not word.endswith('ss') and word.isalpha():
+        return word[:-1]
+    return word
+
+
+def tokenize(text, stopwords=()):
+    """
+    Lowercase terms of a text. Dotted or hyphenated names (np.linalg.norm,
+    theorem 3.2, k-means) are kept whole and also split into their parts.
+    """
+    terms = []
+    for token in _TOKEN.findall(str(text).lower()):
+        if token in stopwords:
+            continue
+        terms.append(_stem(token))
+        parts = re.split(r"[.\-:]", token)
+        if len(parts) > 1:
+            terms.extend(_stem(part) for part in parts if part)
+    return terms
+
+
+def query_terms(text):
+    """Distinct terms of a query, without stopwords."""
+    return list(dict.fromkeys(tokenize(text, STOPWORDS)))
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Merges ranked lists of Documents, scoring each by sum(1 / (k + rank)) over
+    the lists it appears in. Documents are matched by document id and text.
+    """
+    scores = {}
+    documents = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            key = (document.metadata.get('document_id'), document.page_content)
+            scores[key] = scores.get(key, 0.0) + 1 / (k + rank)
+            if key in documents:
+                documents[key].metadata.update(document.metadata)
+            else:
+                documents[key] = Document(page_content=document.page_content, metadata=dict(document.metadata))
+    fused = sorted(scores, key=scores.get, reverse=True)
+    for key in fused:
+        documents[key].metadata['rrf'] = scores[key]
+    return [documents[key] for key in fused]
+
+
+class BM25Index:
+    """Inverted index of the chunks of one course, with documents added and removed in place."""
+
+    def __init__(self):
+        self.chunks = []
+        self.lengths = []
+        self.postings = {}
+        self.documents = {}
+        self.total_length = 0
+        self.live_chunks = 0
+
+    def add_document(self, document_id, chunks):
+        self.remove_document(document_id)
+        rows = []
+        for text in chunks:
+            row = len(self.chunks)
+            terms = Counter(tokenize(text))
+            self.chunks.append((document_id, text))
+            self.lengths.append(sum(terms.values()))
+            for term, count in terms.items():
+                self.postings.setdefault(term, {})[row] = count
+            self.total_length += self.lengths[row]
+            rows.append(row)
+        self.documents[document_id] = rows
+        self.live_chunks += len(rows)
+
+    def remove_document(self, document_id):
+        rows = self.documents.pop(document_id, None)
+        if not rows:
+            return
+        for row in rows:
+            _, text = self.chunks[row]
+            for term in set(tokenize(text)):
+                postings = self.postings.get(term)
+                if postings is not None:
+                    postings.pop(row, None)
+                    if not postings:
+                        del self.postings[term]
+            self.total_length -= self.lengths[row]
+            self.chunks[row] = None
+        self.live_chunks -= len(rows)
+        if len(self.chunks) > 2 * self.live_chunks + 1000:
+            self._compact()
+
+    def _compact(self):
+        """Renumbers the chunks once most rows belong to removed documents."""
+        documents = {document_id: [self.chunks[row][1] for row in rows] for document_id, rows in self.documents.items()}
+        self.__init__()
+        for document_id, chunks in documents.items():
+            self.add_document(document_id, chunks)
+
+    def search(self, terms, k, document_ids=None):
+        """
+        The k best chunks for the query terms, as (row, score, coverage) tuples;
+        coverage is the share of the terms the chunk contains.
+        """
+        if not terms or not self.live_chunks:
+            return []
+        allowed = None
+        if document_ids is not None:
+            allowed = {row for document_id in document_ids for row in self.documents.get(str(document_id), ())}
+        average_length = self.total_length / self.live_chunks
+        scores = {}
+        matched = Counter()
+        for term in terms:
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (self.live_chunks - len(postings) + 0.5) / (len(postings) + 0.5))
+            for row, count in postings.items():
+                if allowed is not None and row not in allowed:
+                    continue
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[row] / average_length)
+                scores[row] = scores.get(row, 0.0) + idf * count * (BM25_K1 + 1) / (count + norm)
+                matched[row] += 1
+        best = sorted(scores, key=scores.get, reverse=True)[:k]
+        return [(row, scores[row], matched[row] / len(terms)) for row in best]
+
+
+class LexicalIndex:
+    """
+    BM25 indexes of the courses, built from the extracted text of their
+    completed files in course_material_metadata, split into the same chunks
+    as ingestion does (by page, see ChromaDBManager.iter_chunks) so that
+    lexical and vector hits can be fused.
+
+    Documents are added or removed as they are ingested or deleted in this
+    process. Changes made by other processes (e.g. the ingestion worker) are
+    picked up when the course's vector version changes, or at the latest
+    after LEXICAL_REFRESH_SECONDS; only new files' texts are then loaded,
+    unless the course index was rebuilt.
+    """
+
+    def __init__(self, mongodb, chroma_db_manager, refresh_seconds=LEXICAL_REFRESH_SECONDS):
+        self.mongodb = mongodb
+        self.chroma_db_manager = chroma_db_manager
+        self.refresh_seconds = refresh_seconds
+        self._courses = {}
+        self._lock = threading.Lock()
+
+    def _chunks(self, course_id, document_id, extracted_text, extracted_pages=None):
+        pages = split_pages(extracted_text, extracted_pages)
+        return [chunk for chunks, _ in self.chroma_db_manager.iter_chunks(pages, document_id, course_id)
+                for chunk in chunks]
+
+    def _course(self, course_id):
+        """Returns the course's entry {index, version, synced, lock}, synced with MongoDB if it is out of date."""
+        with self._lock:
+            entry = self._courses.setdefault(course_id, {'index': BM25Index(), 'version': None, 'synced': 0.0,
+                                                         'generation': None, 'lock': threading.Lock()})
+        version = self.chroma_db_manager.vector_stores.version(course_id)
+        if entry['version'] == version and time.monotonic() - entry['synced'] < self.refresh_seconds:
+            return entry
+        with entry['lock']:
+            if entry['version'] != version or time.monotonic() - entry['synced'] >= self.refresh_seconds:
+                generation = self.chroma_db_manager.index_generation(course_id)
+                if entry['generation'] != generation:
+                    # A rebuilt index may chunk differently
+                    entry['index'] = BM25Index()
+                    entry['generation'] = generation
+                self._sync(course_id, entry['index'])
+                entry['version'] = version
+                entry['synced'] = time.monotonic()
+        return entry
+
+    def _sync(self, course_id, index):
+        completed = self.mongodb.get_completed_file_ids(course_id)
+        for document_id in set(index.documents) - completed:
+            index.remove_document(document_id)
+        new_ids = completed - set(index.documents)
+        if new_ids:
+            texts = self.mongodb.get_extracted_texts(course_id, new_ids)
+            for document_id, (extracted_text, extracted_pages) in texts.items():
+                index.add_document(document_id, self._chunks(course_id, document_id, extracted_text, extracted_pages))
+
+    def add_document(self, course_id, document_id, extracted_text, extracted_pages=None):
+        """Indexes the text of a file that was just ingested, if the course is loaded."""
+        with self._lock:
+            entry = self._courses.get(course_id)
+        if entry is not None:
+            chunks = self._chunks(course_id, document_id, extracted_text, extracted_pages)
+            with entry['lock']:
+                entry['index'].add_document(str(document_id), chunks)
+
+    def remove_document(self, course_id, document_id):
+        with self._lock:
+            entry = self._courses.get(course_id)
+        if entry is not None:
+            with entry['lock']:
+                entry['index'].remove_document(str(document_id))
+
+    def forget(self, course_id):
+        with self._lock:
+            self._courses.pop(course_id, None)
+
+    def documents(self, course_id):
+        """The chunks of the indexed documents of a course, by document id, synced with MongoDB first."""
+        entry = self._course(course_id)
+        with entry['lock']:
+            index = entry['index']
+            return {document_id: [index.chunks[row][1] for row in rows] for document_id, rows in index.documents.items()}
+
+    def restore(self, course_id, documents):
+        """
+        Indexes the chunks of a course's documents, by document id, as saved
+        by documents(), for the course's current vectors. Files ingested or
+        deleted since are synced with MongoDB after LEXICAL_REFRESH_SECONDS.
+        """
+        index = BM25Index()
+        for document_id, chunks in documents.items():
+            index.add_document(str(document_id), chunks)
+        entry = {'index': index, 'version': self.chroma_db_manager.vector_stores.version(course_id),
+                 'synced': time.monotonic(), 'generation': self.chroma_db_manager.index_generation(course_id),
+                 'lock': threading.Lock()}
+        with self._lock:
+            self._courses[course_id] = entry
+
+    def is_keyword_query(self, query_text):
+        """Whether a query is a few terms rather than a sentence, e.g. "np.linalg.norm" or "homework 3"."""
+        words = [word for word in _TOKEN.findall(str(query_text).lower()) if word not in STOPWORDS]
+        return 0 < len(words) <= LEXICAL_FAST_PATH_TERMS and not query_text.strip().endswith('?')
+
+    def search(self, course_id, query_text, k, document_ids=None):
+        """
+        BM25 search of a course's chunks. Returns Documents, best first, with
+        metadata 'bm25' and 'coverage' (the share of query terms they contain).
+        """
+        entry = self._course(course_id)
+        terms = query_terms(query_text)
+        with entry['lock']:
+            index = entry['index']
+            results = index.search(terms, k, document_ids)
+            return [Document(page_content=index.chunks[row][1],
+                             metadata={'document_id': index.chunks[row][0], 'bm25': score, 'coverage': coverage})
+                    for row, score, coverage in results]
+
+    def stats(self):
+        with self._lock:
+            courses = dict(self._courses)
+        return {course_id: {'documents': len(entry['index'].documents), 'chunks': entry['index'].live_chunks,
+                            'terms': len(entry['index'].postings)}
+                for course_id, entry in courses.items()}
+
+
+lexical_index = None
+_lexical_index_lock = threading.Lock()
+
+
+def get_lexical_index(mongodb, chroma_db_manager):
+    """Returns the lexical index shared by all sessions of this process, or None if it is disabled."""
+    global lexical_index
+    if not LEXICAL_SEARCH:
+        return None
+    with _lexical_index_lock:
+        if lexical_index is None:
+            lexical_index = LexicalIndex(mongodb, chroma_db_manager)
+    return lexical_index
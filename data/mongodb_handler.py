@@ -1,4 +1,4 @@
-from pymongo import MongoClient, ASCENDING
+from pymongo import MongoClient, ASCENDING, ReturnDocument
 import gridfs
 import os
 from bson.binary import Binary
@@ -7,10 +7,23 @@ from bson.objectid import ObjectId
 import bcrypt
 from pymongo.errors import DuplicateKeyError
 import re
+from datetime import datetime, timedelta, timezone
 
 load_dotenv()
 
+# Indexes the queries of this module rely on, created at startup on existing
+# databases too: (collection, keys, unique)
+INDEXES = [
+    ('course_material_metadata', [("content_hash", ASCENDING), ("course_id", ASCENDING)], False),
+    ('ingestion_jobs', [("file_id", ASCENDING)], True),
+    ('ingestion_jobs', [("status", ASCENDING), ("next_run_at", ASCENDING)], False),
+    ('course_availability', [("course_id", ASCENDING)], True),
+]
+
 class MongoDBHandler:
+    # Whether this process already made sure the INDEXES exist
+    _indexes_ensured = False
+
     def __init__(self):
         uri = os.getenv('MONGODB_URI')
         db_name = os.getenv('MONGODB_DB_NAME')
@@ -19,6 +32,17 @@ class MongoDBHandler:
         self.client = MongoClient(uri)
         self.db = self.client[db_name]
         self.fs = gridfs.GridFS(self.db)
+        if not MongoDBHandler._indexes_ensured:
+            self.ensure_indexes()
+            MongoDBHandler._indexes_ensured = True
+
+    def ensure_indexes(self):
+        """Creates the INDEXES that do not exist yet; creating an existing index is a no-op."""
+        for collection, keys, unique in INDEXES:
+            try:
+                self.db[collection].create_index(keys, unique=unique)
+            except Exception as e:
+                print(f"Error creating index {keys} on {collection}: {e}")
 
     # functions to create collections
     def create_users_collection(self):
@@ -46,6 +70,14 @@ class MongoDBHandler:
         self.db.conversations.create_index([("conversation_id", ASCENDING)], unique=True)
         print("Conversations collection created successfully with indexes.")
 
+    def create_ingestion_jobs_collection(self):
+        self.db.create_collection("ingestion_jobs")
+        print("Ingestion jobs collection created successfully with indexes.")
+
+    def create_course_availability_collection(self):
+        self.db.create_collection("course_availability")
+        print("Course availability collection created successfully with indexes.")
+
     # initialize all collections
     def initialize_collections(self):
         self.create_users_collection()
@@ -54,6 +86,9 @@ class MongoDBHandler:
         self.create_professor_courses_collection()
         self.create_course_material_metadata_collection()
         self.create_conversations_collection()
+        self.create_ingestion_jobs_collection()
+        self.create_course_availability_collection()
+        self.ensure_indexes()
 
     def update_file(self, file_id, contents):
         try:
@@ -91,11 +126,13 @@ class MongoDBHandler:
             return False
 
     # function to save file and their extracted text to db
-    def save_file(self, file_content, course_id):
+    def save_file(self, file_content, course_id, content_hash=None):
         try:
             course_material_metadata = {
                 'course_id': course_id,
                 'file_name': file_content.name,
+                'file_type': file_content.type,
+                'content_hash': content_hash,
                 'actual_file': Binary(file_content.getvalue()),
                 'extracted_text': '',
                 'status': 'Processing',
@@ -109,6 +146,206 @@ class MongoDBHandler:
         except Exception as e:
             raise Exception(f"Error saving file: {e}")
     
+    def get_file(self, file_id):
+        try:
+            return self.db.course_material_metadata.find_one({'_id': file_id})
+        except Exception as e:
+            raise Exception(f"Error retrieving file: {e}")
+
+    def find_file_by_hash(self, content_hash, course_id=None, exclude_course_id=None, statuses=None):
+        """
+        Finds an uploaded file with the same content hash, without its content.
+
+        Args:
+            content_hash (str): SHA-256 of the file content.
+            course_id (str): Only look in this course.
+            exclude_course_id (str): Only look in other courses than this one.
+            statuses (list): Only files with one of these statuses.
+        """
+        try:
+            query = {'content_hash': content_hash}
+            if course_id is not None:
+                query['course_id'] = course_id
+            if exclude_course_id is not None:
+                query['course_id'] = {'$ne': exclude_course_id}
+            if statuses is not None:
+                query['status'] = {'$in': statuses}
+            return self.db.course_material_metadata.find_one(query, {'actual_file': 0})
+        except Exception as e:
+            raise Exception(f"Error finding file by hash: {e}")
+
+    def copy_ingested_file(self, file_id, source):
+        """Copies the extracted text, summary and classification of an ingested file to file_id."""
+        try:
+            self.db.course_material_metadata.update_one(
+                {'_id': file_id},
+                {'$set': {
+                    'extracted_text': source['extracted_text'],
+                    'extracted_pages': source.get('extracted_pages', []),
+                    'summary': source.get('summary', 'None'),
+                    'is_homework': source.get('is_homework', False),
+                    'reused_from': source['_id']
+                }}
+            )
+        except Exception as e:
+            raise Exception(f"Error copying ingested file: {e}")
+
+    def get_file_progress(self, file_id):
+        try:
+            return self.db.course_material_metadata.find_one(
+                {'_id': file_id},
+                {'status': 1, 'progress': 1, 'progress_percent': 1, 'progress_stage': 1}
+            )
+        except Exception as e:
+            raise Exception(f"Error retrieving file progress: {e}")
+
+    def save_extracted_text(self, file_id, extracted_text, extracted_pages=None):
+        """Saves the cleaned lines of a file and the [page_number, line_count] of its pages."""
+        try:
+            self.db.course_material_metadata.update_one(
+                {'_id': file_id},
+                {'$set': {'extracted_text': extracted_text, 'extracted_pages': extracted_pages or []}}
+            )
+        except Exception as e:
+            raise Exception(f"Error saving extracted text: {e}")
+
+    def update_ingestion_progress(self, file_id, stages, percent, current_stage):
+        """Stores the per-stage timings and counts of a file being ingested, see IngestionProgress."""
+        try:
+            self.db.course_material_metadata.update_one(
+                {'_id': file_id},
+                {'$set': {
+                    'progress': stages,
+                    'progress_percent': percent,
+                    'progress_stage': current_stage
+                }}
+            )
+        except Exception as e:
+            print(f"Error updating ingestion progress: {e}")
+
+    # functions for the durable ingestion job queue
+    def enqueue_ingestion_job(self, file_id, course_id):
+        """Queues a file for ingestion. A file has at most one job, enqueueing it again is a no-op."""
+        try:
+            now = datetime.now(timezone.utc)
+            self.db.ingestion_jobs.update_one(
+                {'file_id': file_id},
+                {'$setOnInsert': {
+                    'file_id': file_id,
+                    'course_id': course_id,
+                    'status': 'queued',
+                    'attempts': 0,
+                    'next_run_at': now,
+                    'lease_owner': None,
+                    'lease_expires_at': None,
+                    'checkpoints': {},
+                    'error': None,
+                    'created_at': now
+                }},
+                upsert=True
+            )
+            print("Ingestion job queued successfully.")
+        except Exception as e:
+            raise Exception(f"Error queueing ingestion job: {e}")
+
+    def lease_ingestion_job(self, worker_id, lease_seconds):
+        """
+        Atomically takes the next runnable job: a queued job whose retry time
+        has come, or a running job whose worker stopped renewing its lease.
+        """
+        try:
+            now = datetime.now(timezone.utc)
+            return self.db.ingestion_jobs.find_one_and_update(
+                {'$or': [
+                    {'status': 'queued', 'next_run_at': {'$lte': now}},
+                    {'status': 'running', 'lease_expires_at': {'$lt': now}}
+                ]},
+                {
+                    '$set': {
+                        'status': 'running',
+                        'lease_owner': worker_id,
+                        'lease_expires_at': now + timedelta(seconds=lease_seconds),
+                        'started_at': now
+                    },
+                    '$inc': {'attempts': 1}
+                },
+                sort=[('next_run_at', ASCENDING)],
+                return_document=ReturnDocument.AFTER
+            )
+        except Exception as e:
+            raise Exception(f"Error leasing ingestion job: {e}")
+
+    def renew_ingestion_lease(self, job_id, worker_id, lease_seconds):
+        """Extends the lease of a running job. Returns False if the worker no longer owns it."""
+        try:
+            result = self.db.ingestion_jobs.update_one(
+                {'_id': job_id, 'status': 'running', 'lease_owner': worker_id},
+                {'$set': {'lease_expires_at': datetime.now(timezone.utc) + timedelta(seconds=lease_seconds)}}
+            )
+            return result.matched_count > 0
+        except Exception as e:
+            print(f"Error renewing ingestion lease: {e}")
+            return False
+
+    def checkpoint_ingestion_job(self, job_id, stage, value=True):
+        try:
+            self.db.ingestion_jobs.update_one(
+                {'_id': job_id},
+                {'$set': {f'checkpoints.{stage}': value}}
+            )
+        except Exception as e:
+            raise Exception(f"Error saving ingestion checkpoint: {e}")
+
+    def complete_ingestion_job(self, job_id, worker_id):
+        """Marks a job completed. Returns False if the worker no longer owns it, e.g. after its lease expired."""
+        try:
+            result = self.db.ingestion_jobs.update_one(
+                {'_id': job_id, 'status': 'running', 'lease_owner': worker_id},
+                {'$set': {
+                    'status': 'completed',
+                    'lease_owner': None,
+                    'lease_expires_at': None,
+                    'finished_at': datetime.now(timezone.utc)
+                }}
+            )
+            return result.matched_count > 0
+        except Exception as e:
+            raise Exception(f"Error completing ingestion job: {e}")
+
+    def fail_ingestion_job(self, job_id, worker_id, error, retry_in_seconds=None):
+        """
+        Marks a job failed, or queues it again after retry_in_seconds. Returns
+        False if the worker no longer owns it.
+        """
+        try:
+            now = datetime.now(timezone.utc)
+            update = {'error': str(error), 'lease_owner': None, 'lease_expires_at': None}
+            if retry_in_seconds is None:
+                update.update({'status': 'failed', 'finished_at': now})
+            else:
+                update.update({'status': 'queued', 'next_run_at': now + timedelta(seconds=retry_in_seconds)})
+            result = self.db.ingestion_jobs.update_one(
+                {'_id': job_id, 'status': 'running', 'lease_owner': worker_id}, {'$set': update})
+            return result.matched_count > 0
+        except Exception as e:
+            raise Exception(f"Error failing ingestion job: {e}")
+
+    def enqueue_unfinished_files(self):
+        """Queues files left in 'Processing' without a job, e.g. uploads interrupted by a restart."""
+        try:
+            files = self.db.course_material_metadata.find({'status': 'Processing'}, {'_id': 1, 'course_id': 1})
+            count = 0
+            for file in files:
+                if not self.db.ingestion_jobs.find_one({'file_id': file['_id']}, {'_id': 1}):
+                    self.enqueue_ingestion_job(file['_id'], file['course_id'])
+                    count += 1
+            if count:
+                print(f"Queued {count} unfinished files for ingestion.")
+            return count
+        except Exception as e:
+            print(f"Error queueing unfinished files: {e}")
+            return 0
+
     def hash_password(self, password):
         """
         Hashes a password using bcrypt.
@@ -143,6 +380,45 @@ class MongoDBHandler:
         except Exception as e:
             raise Exception(f"Error retrieving files: {e}")
     
+    def get_completed_file_ids(self, course_id):
+        """Ids of the files of a course whose ingestion completed, as strings."""
+        try:
+            files = self.db.course_material_metadata.find({'course_id': course_id, 'status': 'Completed'}, {'_id': 1})
+            return {str(file['_id']) for file in files}
+        except Exception as e:
+            raise Exception(f"Error retrieving completed files: {e}")
+
+    def get_course_file_ids(self, course_id):
+        """Ids of all files of a course, whatever their status, as strings."""
+        try:
+            files = self.db.course_material_metadata.find({'course_id': course_id}, {'_id': 1})
+            return {str(file['_id']) for file in files}
+        except Exception as e:
+            raise Exception(f"Error retrieving course files: {e}")
+
+    def get_extracted_texts(self, course_id, file_ids):
+        """(extracted text, extracted pages) of the given files of a course, by file id string."""
+        try:
+            files = self.db.course_material_metadata.find(
+                {'course_id': course_id, '_id': {'$in': [ObjectId(file_id) for file_id in file_ids]}},
+                {'extracted_text': 1, 'extracted_pages': 1}
+            )
+            return {str(file['_id']): (file.get('extracted_text') or '', file.get('extracted_pages'))
+                    for file in files}
+        except Exception as e:
+            raise Exception(f"Error retrieving extracted texts: {e}")
+
+    def get_document_summaries(self, course_id, file_ids):
+        """(file name, summary) of the given files of a course, by file id string."""
+        try:
+            files = self.db.course_material_metadata.find(
+                {'course_id': course_id, '_id': {'$in': [ObjectId(file_id) for file_id in file_ids]}},
+                {'file_name': 1, 'summary': 1}
+            )
+            return {str(file['_id']): (file.get('file_name') or '', file.get('summary') or '') for file in files}
+        except Exception as e:
+            raise Exception(f"Error retrieving document summaries: {e}")
+
     def create_course(self, course_id, course_name, professor_name, description, professor_id):
         try:
             course = self.db.courses.find_one({'course_id': course_id})
@@ -176,6 +452,26 @@ class MongoDBHandler:
             print(f"Error creating course: {e}")
             return False
 
+    def get_course_stopwords(self, course_id):
+        try:
+            course = self.db.courses.find_one({'course_id': course_id}, {'stopwords': 1})
+            return course.get('stopwords', []) if course else []
+        except Exception as e:
+            print(f"Error retrieving course stopwords: {e}")
+            return []
+
+    def set_course_stopwords(self, course_id, stopwords):
+        try:
+            self.db.courses.update_one(
+                {'course_id': course_id},
+                {'$set': {'stopwords': list(stopwords)}}
+            )
+            print("Course stopwords updated successfully.")
+            return True
+        except Exception as e:
+            print(f"Error updating course stopwords: {e}")
+            return False
+
     def create_professor_course(self, professor_id, course_id):
         try:
             professor_course = {
@@ -238,6 +534,16 @@ class MongoDBHandler:
 
         except Exception as e:
             raise Exception(f"Error fetching course details: {e}")
+
+    def get_student_course_ids(self, student_id):
+        """Ids of the courses a student is enrolled in, in enrollment order."""
+        try:
+            course_ids = []
+            for student_course in self.db.student_courses.find({'student_id': student_id}, {'course_id': 1}):
+                course_ids.extend(course_id for course_id in student_course['course_id'].split(',') if course_id)
+            return list(dict.fromkeys(course_ids))
+        except Exception as e:
+            raise Exception(f"Error fetching student course ids: {e}")
     
     # function to save conversation to db
     def save_conversation(self, conversation_data):
@@ -312,6 +618,10 @@ class MongoDBHandler:
                 print("Course not found.")
                 return False
 
+            # Delete pending ingestion jobs and the availability index
+            self.db.ingestion_jobs.delete_many({'course_id': course_id})
+            self.db.course_availability.delete_one({'course_id': course_id})
+
             # Delete course material metadata
             metadata_result = self.db.course_material_metadata.delete_many({'course_id': course_id})
             print(f"Deleted {metadata_result.deleted_count} course material metadata documents.")
@@ -343,28 +653,116 @@ class MongoDBHandler:
         except Exception as e:
             raise Exception(f"Error removing course: {e}")
 
-    def set_assistant_available(self, course_id, course_summary, file_id, document_summary, value):
+    def set_assistant_available(self, course_id, course_summary, file_id, value):
+        return self.set_files_available(course_id, course_summary, [file_id], value) is not None
+
+    # functions for the availability index, see data/availability_index.py
+    def get_course_availability(self, course_id):
+        """
+        Returns the ids of the documents available to the assistant in a course
+        and the version of that set. Courses that predate the index are
+        initialized from the 'available' flag of their files.
+        """
+        try:
+            availability = self.db.course_availability.find_one({'course_id': course_id})
+            if availability is None:
+                files = self.db.course_material_metadata.find({'course_id': course_id, 'available': True}, {'_id': 1})
+                availability = self.db.course_availability.find_one_and_update(
+                    {'course_id': course_id},
+                    {'$setOnInsert': {
+                        'course_id': course_id,
+                        'document_ids': [str(file['_id']) for file in files],
+                        'version': 1
+                    }},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+            return set(availability['document_ids']), availability['version']
+        except Exception as e:
+            raise Exception(f"Error retrieving course availability: {e}")
+
+    def get_course_availability_version(self, course_id):
         try:
-            # Update the availability status for the given file_id
-            result = self.db.course_material_metadata.update_one(
-                {'_id': file_id},
-                {'$set': {'available': value}}
+            availability = self.db.course_availability.find_one({'course_id': course_id}, {'version': 1})
+            return availability['version'] if availability else 0
+        except Exception as e:
+            raise Exception(f"Error retrieving course availability version: {e}")
+
+    def update_course_availability(self, course_id, document_ids, value):
+        """Adds or removes documents from the available set of a course. Returns the new set and version."""
+        try:
+            # Make sure the index of a course is initialized before it is changed
+            self.get_course_availability(course_id)
+            operator = '$addToSet' if value else '$pull'
+            operand = {'$each': document_ids} if value else {'$in': document_ids}
+            availability = self.db.course_availability.find_one_and_update(
+                {'course_id': course_id},
+                {operator: {'document_ids': operand}, '$inc': {'version': 1}},
+                return_document=ReturnDocument.AFTER
             )
-            
-            if result.matched_count == 0:
+            return set(availability['document_ids']), availability['version']
+        except Exception as e:
+            raise Exception(f"Error updating course availability: {e}")
+
+    def restore_course_availability(self, course_id, document_ids, version):
+        """
+        Saves the available set of a course kept elsewhere, e.g. in a snapshot,
+        unless the course already has one. Returns the set and version in effect.
+        """
+        try:
+            availability = self.db.course_availability.find_one_and_update(
+                {'course_id': course_id},
+                {'$setOnInsert': {
+                    'course_id': course_id,
+                    'document_ids': list(document_ids),
+                    'version': version
+                }},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            return set(availability['document_ids']), availability['version']
+        except Exception as e:
+            raise Exception(f"Error restoring course availability: {e}")
+
+    def set_files_available(self, course_id, course_summary, file_ids, value):
+        """
+        Grants or revokes assistant access to several files of a course at
+        once: the files, the course availability index and the course summary
+        are each updated with a single write.
+
+        Returns:
+            tuple: The available document ids and version, or None if no file was found.
+        """
+        try:
+            files = list(self.db.course_material_metadata.find(
+                {'_id': {'$in': file_ids}, 'course_id': course_id},
+                {'summary': 1, 'available': 1}
+            ))
+            if not files:
                 print("File not found.")
-                return False
+                return None
 
-            if value:  # Add document summary
-                updated_summary = course_summary + "\n" + document_summary
-            else:  # Remove document summary
-                updated_summary = course_summary.replace(document_summary, "").strip()
+            self.db.course_material_metadata.update_many(
+                {'_id': {'$in': [file['_id'] for file in files]}},
+                {'$set': {'available': value}}
+            )
+            availability = self.update_course_availability(course_id, [str(file['_id']) for file in files], value)
 
-            # Save the updated course summary
-            self.set_course_summary(course_id, updated_summary)
+            # Only files whose access changes add or remove their summary
+            updated_summary = course_summary
+            for file in files:
+                document_summary = file.get('summary', '')
+                if file.get('available', False) == value or not document_summary:
+                    continue
+                if value:  # Add document summary
+                    updated_summary = updated_summary + "\n" + document_summary
+                else:  # Remove document summary
+                    updated_summary = updated_summary.replace(document_summary, "").strip()
+            if updated_summary != course_summary:
+                self.set_course_summary(course_id, updated_summary)
 
-            print("Availability status updated successfully.")
-            return True
+            print(f"Availability status of {len(files)} files updated successfully.")
+            return availability
         except Exception as e:
             raise Exception(f"Error updating availability status: {e}")
 
@@ -379,6 +777,11 @@ class MongoDBHandler:
             # Delete the file from GridFS
             self.fs.delete(file_id)
             print("File deleted from GridFS.")
+
+            # Drop the ingestion job of the file and its availability
+            self.db.ingestion_jobs.delete_one({'file_id': file_id})
+            if file.get('available'):
+                self.update_course_availability(file['course_id'], [str(file_id)], False)
     
             # Remove the file metadata from the course_material_metadata collection
             result = self.db.course_material_metadata.delete_one({'_id': file_id})
@@ -0,0 +1,256 @@
+import os
+import re
+import threading
+import zlib
+
+import numpy as np
+
+# Near-duplicate chunks (revised uploads of a lecture, combined slide decks) reuse the
+# embedding of the chunk they repeat instead of being embedded again, and are
+# collapsed in search results
+DEDUP_CHUNKS = os.getenv('DEDUP_CHUNKS', 'true').lower() == 'true'
+# Estimated Jaccard similarity of their word shingles above which two chunks are near-duplicates
+DEDUP_THRESHOLD = float(os.getenv('DEDUP_THRESHOLD', 0.9))
+DEDUP_SHINGLE_WORDS = int(os.getenv('DEDUP_SHINGLE_WORDS', 3))
+# MinHash signatures are split into bands of rows for locality-sensitive hashing;
+# chunks sharing a band are compared
+DEDUP_BANDS = int(os.getenv('DEDUP_BANDS', 16))
+DEDUP_ROWS = int(os.getenv('DEDUP_ROWS', 8))
+# Searches fetch this many times k hits, so that k remain once near-duplicates are collapsed
+DEDUP_SEARCH_FACTOR = int(os.getenv('DEDUP_SEARCH_FACTOR', 2))
+# Chunks read from Chroma at once when a course is loaded
+DEDUP_LOAD_BATCH = 1000
+
+# Hash functions a * x + b modulo 2^32, with odd a so that each is a permutation
+_random = np.random.RandomState(20240521)
+_A = _random.randint(0, 2 ** 32, size=(DEDUP_BANDS * DEDUP_ROWS, 1), dtype=np.uint64).astype(np.uint32) | np.uint32(1)
+_B = _random.randint(0, 2 ** 32, size=(DEDUP_BANDS * DEDUP_ROWS, 1), dtype=np.uint64).astype(np.uint32)
+
+
+def signature(text):
+    """
+    MinHash signature of the word shingles of a text, as a uint32 array of
+    DEDUP_BANDS * DEDUP_ROWS values, or None if the text has no words.
+    """
+    words = re.findall(r"\w+", str(text).lower())
+    if not words:
+        return None
+    size = min(DEDUP_SHINGLE_WORDS, len(words))
+    shingles = {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+    hashes = np.fromiter((zlib.crc32(shingle.encode()) for shingle in shingles), dtype=np.uint32,
+                         count=len(shingles))
+    return (_A * hashes + _B).min(axis=1)
+
+
+def similarity(first, second):
+    """Jaccard similarity of two texts estimated from their signatures."""
+    return float(np.mean(first == second))
+
+
+def collapse(hits):
+    """
+    Drops the hits that are near-duplicates of a better one. hits are
+    Documents, best first.
+    """
+    if not DEDUP_CHUNKS or len(hits) < 2:
+        return list(hits)
+    kept = []
+    signatures = []
+    for hit in hits:
+        hit_signature = signature(hit.page_content)
+        if hit_signature is not None and any(similarity(hit_signature, other) >= DEDUP_THRESHOLD
+                                             for other in signatures):
+            continue
+        kept.append(hit)
+        if hit_signature is not None:
+            signatures.append(hit_signature)
+    return kept
+
+
+class CourseDuplicates:
+    """LSH index of the MinHash signatures of the chunks of one course."""
+
+    def __init__(self):
+        # chunk id -> (signature, document id)
+        self.chunks = {}
+        self.buckets = {}
+        self.documents = {}
+        # Chunks registered by an ingestion of this process that are not written to Chroma yet
+        self.pending = set()
+        self.version = None
+        self.lock = threading.Lock()
+
+    def _bands(self, chunk_signature):
+        for band in range(DEDUP_BANDS):
+            yield band, chunk_signature[band * DEDUP_ROWS:(band + 1) * DEDUP_ROWS].tobytes()
+
+    def find(self, chunk_signature, document_id=None):
+        """
+        The id of the most similar chunk at or above DEDUP_THRESHOLD, or None.
+        Chunks of document_id come first, so repeats within a document are found.
+        """
+        candidates = set()
+        for key in self._bands(chunk_signature):
+            candidates.update(self.buckets.get(key, ()))
+        best, best_rank = None, None
+        for chunk_id in candidates:
+            other_signature, other_document_id = self.chunks[chunk_id]
+            chunk_similarity = similarity(chunk_signature, other_signature)
+            rank = (other_document_id == document_id, chunk_similarity)
+            if chunk_similarity >= DEDUP_THRESHOLD and (best_rank is None or rank > best_rank):
+                best, best_rank = chunk_id, rank
+        return best
+
+    def add(self, chunk_id, document_id, chunk_signature):
+        self.chunks[chunk_id] = (chunk_signature, document_id)
+        self.documents.setdefault(document_id, set()).add(chunk_id)
+        for key in self._bands(chunk_signature):
+            self.buckets.setdefault(key, set()).add(chunk_id)
+
+    def remove(self, chunk_id):
+        entry = self.chunks.pop(chunk_id, None)
+        self.pending.discard(chunk_id)
+        if entry is None:
+            return
+        chunk_signature, document_id = entry
+        for key in self._bands(chunk_signature):
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.discard(chunk_id)
+                if not bucket:
+                    del self.buckets[key]
+        chunk_ids = self.documents.get(document_id)
+        if chunk_ids is not None:
+            chunk_ids.discard(chunk_id)
+            if not chunk_ids:
+                del self.documents[document_id]
+
+    def remove_document(self, document_id):
+        for chunk_id in list(self.documents.get(document_id, ())):
+            self.remove(chunk_id)
+
+
+class NearDuplicateIndex:
+    """
+    Finds the chunks of a new document that repeat chunks already in its
+    course, before they are embedded.
+
+    The index of a course is loaded from its Chroma collection on first use,
+    and brought up to date whenever the course's vector version changed, e.g.
+    after another process ingested or deleted a file: only the chunks of the
+    documents changed since are read again, if the course's change log has
+    them (see CourseVectorStores.changed_documents), else all chunk ids are
+    compared.
+    """
+
+    def __init__(self, chroma_db_manager):
+        self.chroma_db_manager = chroma_db_manager
+        self._courses = {}
+        self._lock = threading.Lock()
+
+    def _course(self, course_id):
+        with self._lock:
+            course = self._courses.setdefault(course_id, CourseDuplicates())
+        return course
+
+    def _sync(self, course_id, course):
+        """Adds the chunks written and drops the chunks deleted since the course was last synced. Holds course.lock."""
+        vector_stores = self.chroma_db_manager.vector_stores
+        version = vector_stores.version(course_id)
+        if course.version == version:
+            return
+        collection = self.chroma_db_manager.get_course_db(course_id)._collection
+        changed = vector_stores.changed_documents(course_id, course.version, version) \
+            if course.version is not None else None
+        if changed is None:
+            stored = set(collection.get(include=[])['ids'])
+            known = set(course.chunks)
+        else:
+            stored = set()
+            for document_id in changed:
+                stored.update(collection.get(where={"document_id": document_id}, include=[])['ids'])
+            known = {chunk_id for document_id in changed for chunk_id in course.documents.get(document_id, ())}
+        for chunk_id in known - stored - course.pending:
+            course.remove(chunk_id)
+        new_ids = sorted(stored - set(course.chunks))
+        for start in range(0, len(new_ids), DEDUP_LOAD_BATCH):
+            results = collection.get(ids=new_ids[start:start + DEDUP_LOAD_BATCH], include=["documents", "metadatas"])
+            for chunk_id, text, metadata in zip(results['ids'], results['documents'], results['metadatas']):
+                chunk_signature = signature(text)
+                if chunk_signature is not None:
+                    course.add(chunk_id, str((metadata or {}).get('document_id')), chunk_signature)
+        course.version = version
+
+    def deduplicate(self, course_id, document_id, chunks, metadatas):
+        """
+        Gives the chunks of a document ids and registers them in the course's
+        index, so later chunks and documents are compared with them.
+
+        A chunk that repeats an earlier chunk of the same document is dropped.
+        A chunk that repeats a chunk of another document is kept, since the
+        documents are made available separately, with the id of that chunk in
+        metadata['duplicate_of']: it is stored with that chunk's embedding.
+
+        Returns:
+            tuple: (chunks, metadatas, ids, dropped): the chunks to store, their
+            ids, and the number of chunks dropped.
+        """
+        course = self._course(str(course_id))
+        document_id = str(document_id)
+        kept_chunks, kept_metadatas, ids = [], [], []
+        with course.lock:
+            self._sync(str(course_id), course)
+            for chunk, metadata in zip(chunks, metadatas):
+                chunk_id = self.chroma_db_manager.new_chunk_id()
+                chunk_signature = signature(chunk)
+                if chunk_signature is not None:
+                    match = course.find(chunk_signature, document_id)
+                    if match is not None:
+                        if course.chunks[match][1] == document_id:
+                            continue
+                        metadata = {**metadata, 'duplicate_of': match}
+                    course.add(chunk_id, document_id, chunk_signature)
+                    course.pending.add(chunk_id)
+                kept_chunks.append(chunk)
+                kept_metadatas.append(metadata)
+                ids.append(chunk_id)
+        return kept_chunks, kept_metadatas, ids, len(chunks) - len(kept_chunks)
+
+    def written(self, course_id, ids):
+        """Called once registered chunks are stored in Chroma."""
+        course = self._course(str(course_id))
+        with course.lock:
+            course.pending.difference_update(ids)
+
+    def remove_document(self, course_id, document_id):
+        with self._lock:
+            course = self._courses.get(str(course_id))
+        if course is not None:
+            with course.lock:
+                course.remove_document(str(document_id))
+
+    def forget(self, course_id):
+        with self._lock:
+            self._courses.pop(str(course_id), None)
+
+    def stats(self):
+        with self._lock:
+            courses = dict(self._courses)
+        return {course_id: {'chunks': len(course.chunks), 'documents': len(course.documents),
+                            'buckets': len(course.buckets)}
+                for course_id, course in courses.items()}
+
+
+near_duplicate_index = None
+_near_duplicate_index_lock = threading.Lock()
+
+
+def get_near_duplicate_index(chroma_db_manager):
+    """Returns the near-duplicate index shared by all sessions of this process, or None if it is disabled."""
+    global near_duplicate_index
+    if not DEDUP_CHUNKS:
+        return None
+    with _near_duplicate_index_lock:
+        if near_duplicate_index is None:
+            near_duplicate_index = NearDuplicateIndex(chroma_db_manager)
+    return near_duplicate_index
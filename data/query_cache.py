@@ -0,0 +1,92 @@
+import os
+import threading
+from collections import OrderedDict
+
+# Query embeddings kept in memory, per process
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv('QUERY_EMBEDDING_CACHE_SIZE', 4096))
+# Search results kept in memory, per process
+QUERY_RESULT_CACHE_SIZE = int(os.getenv('QUERY_RESULT_CACHE_SIZE', 2048))
+
+
+def normalize_query(query_text):
+    """Cache key form of a query: lowercase with collapsed whitespace."""
+    return " ".join(str(query_text).lower().split())
+
+
+class LRUCache:
+    """Thread-safe mapping of at most max_size entries; the least recently used one is dropped first."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+
+class QueryCache:
+    """
+    Caches of the query side of retrieval.
+
+    embeddings maps (model id, normalized query) to the query's embedding, so
+    the same text is embedded once however many searches use it.
+
+    results maps (course, normalized query, search parameters, index version,
+    searched documents) to the hits of a search. The index version changes
+    whenever chunks of the course are added or removed, and the searched
+    documents are the course's available set, which the availability index
+    replaces on every grant or revoke; stale entries are never looked up
+    again and age out of the LRU.
+    """
+
+    def __init__(self, embedding_size=QUERY_EMBEDDING_CACHE_SIZE, result_size=QUERY_RESULT_CACHE_SIZE):
+        self.embeddings = LRUCache(embedding_size)
+        self.results = LRUCache(result_size)
+
+    def stats(self):
+        return {'embeddings': self.embeddings.stats(), 'results': self.results.stats()}
+
+
+query_cache = None
+_query_cache_lock = threading.Lock()
+
+
+def get_query_cache():
+    """Returns the query cache shared by all sessions of this process."""
+    global query_cache
+    with _query_cache_lock:
+        if query_cache is None:
+            query_cache = QueryCache()
+    return query_cache
+
+
+def query_cache_stats():
+    """Hit ratios of the query embedding and result caches of this process."""
+    return get_query_cache().stats()
@@ -0,0 +1,410 @@
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+import numpy as np
+
+# Search backend of ChromaDBManager: "chroma", or "mmap" for the quantized index below
+VECTOR_INDEX_BACKEND = os.getenv('VECTOR_INDEX_BACKEND', 'chroma')
+VECTOR_INDEX_DIR = os.getenv('VECTOR_INDEX_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vector_index'))
+# Storage type of the vectors: int8 (one scale per vector), float16 or float32.
+# NumPy converts int8 to float32 much faster than float16
+VECTOR_INDEX_DTYPE = os.getenv('VECTOR_INDEX_DTYPE', 'int8')
+# Leading dimensions kept of each vector, 0 keeps all of them
+VECTOR_INDEX_DIMENSIONS = int(os.getenv('VECTOR_INDEX_DIMENSIONS', 0))
+# Courses with at least this many vectors also get an HNSW graph, if hnswlib is installed
+VECTOR_INDEX_HNSW_MIN_VECTORS = int(os.getenv('VECTOR_INDEX_HNSW_MIN_VECTORS', 50000))
+# Below this share of searchable vectors a filtered search scans them instead of the graph
+VECTOR_INDEX_HNSW_MIN_SHARE = float(os.getenv('VECTOR_INDEX_HNSW_MIN_SHARE', 0.3))
+# Vectors converted to float32 at a time while scoring
+VECTOR_INDEX_BLOCK = int(os.getenv('VECTOR_INDEX_BLOCK', 512))
+
+CURRENT_FILE = 'CURRENT'
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _write_atomic(path, content):
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def quantize(vectors, dtype, dimensions=0):
+    """
+    Truncates float32 vectors to their first dimensions, normalizes them and
+    converts them to dtype. Returns (vectors, scales); scales is only set for
+    int8, where vector i is approximately vectors[i] * scales[i].
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dimensions:
+        vectors = vectors[:, :dimensions]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.maximum(norms, 1e-12)
+    if dtype == 'int8':
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales = np.maximum(scales, 1e-12).astype(np.float32)
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales
+    return vectors.astype(dtype), None
+
+
+class _Generation:
+    """One built index of a course, memory-mapped read-only."""
+
+    def __init__(self, path, version):
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.path = path
+        # Version of the course's vectors the generation was built for
+        self.version = version
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        self.scales = np.load(os.path.join(path, 'scales.npy'), mmap_mode='r') if self.meta['dtype'] == 'int8' else None
+        self.document_codes = np.load(os.path.join(path, 'document_codes.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self.texts = np.memmap(os.path.join(path, 'texts.bin'), dtype=np.uint8, mode='r') if self.offsets[-1] else b''
+        self.document_ids = self.meta['document_ids']
+        self.document_code = {document_id: code for code, document_id in enumerate(self.document_ids)}
+        self.hnsw = None
+        if self.meta.get('hnsw'):
+            self.hnsw = _load_hnsw(os.path.join(path, 'hnsw.bin'), self.vectors.shape[1], len(self.vectors))
+
+    def text(self, row):
+        return bytes(self.texts[self.offsets[row]:self.offsets[row + 1]]).decode('utf-8')
+
+
+def _load_hnsw(path, dimensions, count):
+    try:
+        import hnswlib
+    except ImportError:
+        return None
+    index = hnswlib.Index(space='ip', dim=dimensions)
+    index.load_index(path, max_elements=count)
+    return index
+
+
+class QuantizedVectorIndex:
+    """
+    Read-optimized copy of the course vector stores: per course, a matrix of
+    normalized, optionally truncated float16/int8 vectors, the chunk texts and
+    their document ids, all saved as .npy/.bin files that every process
+    memory-maps, so the operating system keeps one copy in its page cache.
+
+    Searches are exact NumPy dot products over the vectors of the requested
+    documents. Courses of at least VECTOR_INDEX_HNSW_MIN_VECTORS vectors also
+    get an HNSW graph (hnswlib, optional), used unless the document filter
+    leaves only a small share of them.
+
+    Chroma stays the store that ingestion writes to. Every index is built for
+    a version of the course's vectors (CourseVectorStores.version). The first
+    search that sees a newer version starts a rebuild from Chroma in a
+    background thread and is served by the previous generation, as are the
+    following searches until the rebuild is published; only a course without
+    any index is built before its first search. Builds are written to a new
+    generation directory and published by replacing the CURRENT file, so
+    readers never see a partial index.
+    """
+
+    def __init__(self, path=VECTOR_INDEX_DIR, dtype=VECTOR_INDEX_DTYPE, dimensions=VECTOR_INDEX_DIMENSIONS,
+                 hnsw_min_vectors=VECTOR_INDEX_HNSW_MIN_VECTORS):
+        if dtype not in ('float32', 'float16', 'int8'):
+            raise ValueError(f"Unsupported vector index dtype: {dtype}")
+        self.path = path
+        self.dtype = dtype
+        self.dimensions = dimensions
+        self.hnsw_min_vectors = hnsw_min_vectors
+        self.stats = {'searches': 0, 'hnsw_searches': 0, 'builds': 0, 'seconds': 0.0, 'build_seconds': 0.0}
+        self._generations = {}
+        self._lock = threading.Lock()
+        self._build_locks = {}
+        # course id -> (version, load_vectors) of the latest background build requested
+        self._pending_builds = {}
+
+    def course_dir(self, course_id):
+        return os.path.join(self.path, str(course_id))
+
+    def drop(self, course_id):
+        """Deletes the index of a course."""
+        with self._lock:
+            self._generations.pop(str(course_id), None)
+        shutil.rmtree(self.course_dir(course_id), ignore_errors=True)
+
+    def install(self, course_id, version, files):
+        """
+        Publishes a generation of a course's index built elsewhere, e.g. in a
+        snapshot, for the given version of its vectors. files are the
+        (file name, binary file object) pairs of a generation directory.
+        Returns the generation.
+        """
+        course_id = str(course_id)
+        course_dir = self.course_dir(course_id)
+        os.makedirs(course_dir, exist_ok=True)
+        name = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+        tmp_dir = os.path.join(course_dir, name + '.tmp')
+        os.makedirs(tmp_dir)
+        for file_name, source in files:
+            with open(os.path.join(tmp_dir, os.path.basename(file_name)), 'wb') as f:
+                shutil.copyfileobj(source, f)
+        os.rename(tmp_dir, os.path.join(course_dir, name))
+        _write_atomic(os.path.join(course_dir, CURRENT_FILE), f"{name} {version}")
+        self._remove_old_generations(course_dir, name)
+        return self._load(course_id, name, version)
+
+    def _current(self, course_id):
+        """(generation name, version) of the published index of a course, or None."""
+        current = _read(os.path.join(self.course_dir(course_id), CURRENT_FILE))
+        if current is None:
+            return None
+        name, _, version = current.partition(' ')
+        return name, version
+
+    def get(self, course_id, version, load_vectors):
+        """
+        Returns the generation of a course's index for the given version of its
+        vectors. If the published generation is older, it is returned while the
+        new one is built in the background (see refresh); check the returned
+        generation's version. A course without an index is built right away.
+
+        load_vectors() returns the course's (texts, embeddings, metadatas) from
+        Chroma; read the version before calling it, so that a concurrent write
+        leads to a rebuild.
+        """
+        course_id = str(course_id)
+        current = self._current(course_id)
+        if current is not None:
+            if current[1] != version:
+                self.refresh(course_id, version, load_vectors)
+            return self._load(course_id, *current)
+
+        with self._build_lock(course_id):
+            # Another thread may have built it in the meantime
+            current = self._current(course_id)
+            if current is None:
+                current = self._build(course_id, load_vectors, version), version
+            return self._load(course_id, *current)
+
+    def refresh(self, course_id, version, load_vectors):
+        """
+        Builds the index of a course for the given version in a background
+        thread, unless it is published already. Requests made while a build
+        runs are merged: once it is done, the latest one is built.
+        """
+        course_id = str(course_id)
+        with self._lock:
+            building = course_id in self._pending_builds
+            self._pending_builds[course_id] = (version, load_vectors)
+        if not building:
+            threading.Thread(target=self._build_pending, args=(course_id,), name='vector-index-build',
+                             daemon=True).start()
+
+    def _build_pending(self, course_id):
+        while True:
+            with self._lock:
+                version, load_vectors = self._pending_builds[course_id]
+            try:
+                with self._build_lock(course_id):
+                    current = self._current(course_id)
+                    if current is None or current[1] != version:
+                        self._load(course_id, self._build(course_id, load_vectors, version), version)
+            except Exception as e:
+                print(f"Error building the vector index of course {course_id}: {e}")
+            with self._lock:
+                if self._pending_builds[course_id][0] == version:
+                    del self._pending_builds[course_id]
+                    return
+
+    def _build_lock(self, course_id):
+        with self._lock:
+            return self._build_locks.setdefault(course_id, threading.Lock())
+
+    def _load(self, course_id, name, version):
+        with self._lock:
+            generation = self._generations.get(course_id)
+            if generation is not None and os.path.basename(generation.path) == name:
+                return generation
+        generation = _Generation(os.path.join(self.course_dir(course_id), name), version)
+        with self._lock:
+            self._generations[course_id] = generation
+        return generation
+
+    def _build(self, course_id, load_vectors, version):
+        started = time.perf_counter()
+        course_dir = self.course_dir(course_id)
+        os.makedirs(course_dir, exist_ok=True)
+        texts, embeddings, metadatas = load_vectors()
+
+        name = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+        tmp_dir = os.path.join(course_dir, name + '.tmp')
+        os.makedirs(tmp_dir)
+        if len(texts):
+            vectors, scales = quantize(embeddings, self.dtype, self.dimensions)
+        else:
+            vectors = np.zeros((0, self.dimensions or 1), dtype=self.dtype)
+            scales = np.zeros(0, dtype=np.float32) if self.dtype == 'int8' else None
+        document_ids = []
+        document_code = {}
+        codes = np.empty(len(texts), dtype=np.int32)
+        for row, metadata in enumerate(metadatas):
+            document_id = str((metadata or {}).get('document_id'))
+            if document_id not in document_code:
+                document_code[document_id] = len(document_ids)
+                document_ids.append(document_id)
+            codes[row] = document_code[document_id]
+        encoded = [text.encode('utf-8') for text in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(text) for text in encoded])
+
+        np.save(os.path.join(tmp_dir, 'vectors.npy'), vectors)
+        if scales is not None:
+            np.save(os.path.join(tmp_dir, 'scales.npy'), scales)
+        np.save(os.path.join(tmp_dir, 'document_codes.npy'), codes)
+        np.save(os.path.join(tmp_dir, 'offsets.npy'), offsets)
+        with open(os.path.join(tmp_dir, 'texts.bin'), 'wb') as f:
+            f.write(b''.join(encoded))
+        hnsw = len(texts) >= self.hnsw_min_vectors and self._build_hnsw(tmp_dir, vectors, scales)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump({'dtype': self.dtype, 'dimensions': int(vectors.shape[1]), 'vectors': len(texts),
+                       'document_ids': document_ids, 'hnsw': bool(hnsw)}, f)
+
+        os.rename(tmp_dir, os.path.join(course_dir, name))
+        _write_atomic(os.path.join(course_dir, CURRENT_FILE), f"{name} {version}")
+        self._remove_old_generations(course_dir, name)
+
+        seconds = time.perf_counter() - started
+        with self._lock:
+            self.stats['builds'] += 1
+            self.stats['build_seconds'] += seconds
+        print(f"Built vector index of course {course_id}: {len(texts)} vectors in {seconds:.2f}s.")
+        return name
+
+    def _build_hnsw(self, path, vectors, scales):
+        try:
+            import hnswlib
+        except ImportError:
+            return False
+        data = vectors.astype(np.float32)
+        if scales is not None:
+            data *= scales[:, None]
+        index = hnswlib.Index(space='ip', dim=data.shape[1])
+        index.init_index(max_elements=len(data), ef_construction=200, M=16)
+        index.add_items(data, np.arange(len(data)))
+        index.save_index(os.path.join(path, 'hnsw.bin'))
+        return True
+
+    def _remove_old_generations(self, course_dir, current):
+        # Processes still mapping a removed generation keep reading it until they reload
+        current_time = int(current.split('-')[0])
+        for name in os.listdir(course_dir):
+            if name.endswith('.tmp') or not os.path.isdir(os.path.join(course_dir, name)):
+                continue
+            if int(name.split('-')[0]) < current_time:
+                shutil.rmtree(os.path.join(course_dir, name), ignore_errors=True)
+
+    def search(self, generation, query_embedding, k, document_ids=None):
+        """
+        The k vectors most similar to the query embedding, best first.
+
+        Args:
+            generation: The course index, from get().
+            document_ids: Only vectors of these documents are searched.
+
+        Returns:
+            list: (text, document_id, score) tuples; score is the cosine similarity.
+        """
+        started = time.perf_counter()
+        count = len(generation.vectors)
+        query = np.asarray(query_embedding, dtype=np.float32)[:generation.vectors.shape[1]]
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        rows = None
+        if document_ids is not None:
+            codes = [generation.document_code[str(document_id)] for document_id in document_ids
+                     if str(document_id) in generation.document_code]
+            rows = np.flatnonzero(np.isin(generation.document_codes, codes)) if codes else np.zeros(0, dtype=np.int64)
+        searchable = count if rows is None else len(rows)
+        if not searchable or k <= 0:
+            return []
+
+        hnsw = generation.hnsw is not None and searchable >= VECTOR_INDEX_HNSW_MIN_SHARE * count
+        if hnsw:
+            found, scores = self._search_hnsw(generation, query, min(k, searchable), rows)
+        else:
+            found, scores = self._search_exact(generation, query, min(k, searchable), rows)
+        seconds = time.perf_counter() - started
+        # Updated by concurrent searches, e.g. those of a federated search
+        with self._lock:
+            self.stats['hnsw_searches'] += int(hnsw)
+            self.stats['searches'] += 1
+            self.stats['seconds'] += seconds
+        return [(generation.text(row), generation.document_ids[generation.document_codes[row]], float(score))
+                for row, score in zip(found, scores)]
+
+    def _search_exact(self, generation, query, k, rows):
+        count = len(generation.vectors) if rows is None else len(rows)
+        scores = np.empty(count, dtype=np.float32)
+        block = np.empty((min(VECTOR_INDEX_BLOCK, count), len(query)), dtype=np.float32)
+        for start in range(0, count, VECTOR_INDEX_BLOCK):
+            end = min(start + VECTOR_INDEX_BLOCK, count)
+            block_rows = slice(start, end) if rows is None else rows[start:end]
+            block[:end - start] = generation.vectors[block_rows]
+            np.dot(block[:end - start], query, out=scores[start:end])
+            if generation.scales is not None:
+                scores[start:end] *= generation.scales[block_rows]
+
+        top = np.argpartition(-scores, k - 1)[:k] if k < count else np.arange(count)
+        top = top[np.argsort(-scores[top])]
+        found = top if rows is None else rows[top]
+        return found, scores[top]
+
+    def _search_hnsw(self, generation, query, k, rows):
+        generation.hnsw.set_ef(max(64, k * 4))
+        allowed = None
+        if rows is not None:
+            allowed = np.zeros(len(generation.vectors), dtype=bool)
+            allowed[rows] = True
+        labels, distances = generation.hnsw.knn_query(
+            query, k=k, filter=None if allowed is None else (lambda label: bool(allowed[label]))
+        )
+        # hnswlib's inner product distance is 1 - similarity
+        return labels[0], 1 - distances[0]
+
+    def index_stats(self):
+        """Search counters and the size of the indexes loaded by this process."""
+        with self._lock:
+            generations = dict(self._generations)
+            building = sorted(self._pending_builds)
+            stats = dict(self.stats)
+        courses = {
+            course_id: {'vectors': len(generation.vectors), 'version': generation.version,
+                        'dtype': generation.meta['dtype'],
+                        'dimensions': generation.meta['dimensions'], 'hnsw': generation.hnsw is not None,
+                        'mapped_bytes': int(generation.vectors.nbytes + generation.offsets[-1])}
+            for course_id, generation in generations.items()
+        }
+        searches = stats['searches']
+        return {**stats, 'avg_ms': round(stats['seconds'] * 1000 / searches, 3) if searches else 0.0,
+                'building': building, 'courses': courses}
+
+
+vector_index = None
+_vector_index_lock = threading.Lock()
+
+
+def get_vector_index():
+    """Returns the quantized vector index of this process, or None if searches go to Chroma."""
+    global vector_index
+    if VECTOR_INDEX_BACKEND != 'mmap':
+        return None
+    with _vector_index_lock:
+        if vector_index is None:
+            vector_index = QuantizedVectorIndex()
+    return vector_index
@@ -0,0 +1,459 @@
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import chromadb
+from chromadb.config import Settings
+from langchain_chroma import Chroma
+
+from data.embedding_backends import get_embedding_backend, resolve_backend
+
+CHROMA_BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'chroma_db'))
+# Directory of the persistent client shared by all courses
+CHROMA_SHARED_DIR = os.getenv('CHROMA_SHARED_DIR', os.path.join(CHROMA_BASE_DIR, 'shared'))
+# Course collections kept open at the same time, least recently used ones are closed first
+CHROMA_MAX_OPEN_COLLECTIONS = int(os.getenv('CHROMA_MAX_OPEN_COLLECTIONS', 32))
+# Memory budget of the HNSW segments the shared client keeps loaded
+CHROMA_MEMORY_LIMIT_MB = int(os.getenv('CHROMA_MEMORY_LIMIT_MB', 1024))
+
+# Per-course persist directories written before the shared client
+LEGACY_COURSE_DIR = "chroma_course_{course_id}"
+# Copy a course's legacy directory into the shared client when the course is first opened
+CHROMA_MIGRATE_LEGACY = os.getenv('CHROMA_MIGRATE_LEGACY', 'true').lower() == 'true'
+# Version files of the course indexes, one per course, shared by all processes
+CHROMA_VERSIONS_DIR = os.getenv('CHROMA_VERSIONS_DIR', os.path.join(CHROMA_BASE_DIR, 'versions'))
+# Size above which the log of the documents changed by each version of a course is cut in half
+CHROMA_CHANGELOG_BYTES = int(os.getenv('CHROMA_CHANGELOG_BYTES', 256 * 1024))
+# Replaced index generations of a course kept for rollback, older ones are garbage-collected
+INDEX_KEEP_PREVIOUS = int(os.getenv('INDEX_KEEP_PREVIOUS', 1))
+# Distance of new collections, so that search scores are cosine similarities whatever
+# the vector norms. Collections created before are in Chroma's default squared L2
+# space until they are rebuilt (see service/index_rebuild.py)
+COLLECTION_SPACE = {'hnsw:space': 'cosine'}
+
+
+def collection_name(course_id):
+    """Chroma collection name of a course: 3-63 characters of [a-zA-Z0-9._-]."""
+    name = "course_" + re.sub(r"[^a-zA-Z0-9._-]", "_", str(course_id))
+    return name[:63].rstrip("._-") or "course_"
+
+
+class CourseVectorStores:
+    """
+    The vector stores of all courses, as collections of one persistent client.
+
+    Collections are opened on first use and kept in an LRU of at most
+    max_open entries; the client unloads least recently used HNSW segments
+    on its own once memory_limit_bytes is reached. Courses that still have a
+    per-course directory from before are migrated into the shared client when
+    they are first opened (see migrate_legacy_course), or served from it if
+    CHROMA_MIGRATE_LEGACY is off.
+
+    Every collection records the embedding backend it was built with in its
+    metadata and is always opened with that backend. Indexes without one
+    were built with OpenAI embeddings.
+
+    Each course also has a version that changes whenever its vectors do
+    (see mark_changed); caches derived from an index are keyed by it. A log
+    next to the version file records which documents each version changed,
+    so that such caches can catch up document by document (see changed_documents).
+
+    A course index can be rebuilt, e.g. with another embedding model, into a
+    new generation: a collection of its own that is filled while the active
+    one keeps serving, then made active with activate(). The generations of
+    a course are recorded in a JSON file next to its version file, so all
+    processes switch to the new collection on their next get(); replaced
+    generations are kept for rollback() until collect_garbage().
+
+    A generation can also be activated before its vectors are written, e.g.
+    when a course is imported from a snapshot at boot: its vectors are then
+    written by the first get() of the course (see restore_lazily).
+    """
+
+    def __init__(self, path=CHROMA_SHARED_DIR, max_open=CHROMA_MAX_OPEN_COLLECTIONS,
+                 memory_limit_bytes=CHROMA_MEMORY_LIMIT_MB * 1024 * 1024, base_dir=CHROMA_BASE_DIR,
+                 versions_dir=CHROMA_VERSIONS_DIR):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        os.makedirs(versions_dir, exist_ok=True)
+        self.base_dir = base_dir
+        self.versions_dir = versions_dir
+        self.max_open = max_open
+        self.client = chromadb.PersistentClient(path=path, settings=Settings(
+            anonymized_telemetry=False,
+            chroma_segment_cache_policy="LRU",
+            chroma_memory_limit_bytes=memory_limit_bytes
+        ))
+        self.opens = 0
+        self.evictions = 0
+        self.hits = 0
+        self._open = OrderedDict()
+        # course id -> (generation name, fill(store), lock) of generations whose vectors are not written yet
+        self._restores = {}
+        self._lock = threading.Lock()
+        self._migrate_lock = threading.Lock()
+
+    def legacy_dir(self, course_id):
+        return os.path.join(self.base_dir, LEGACY_COURSE_DIR.format(course_id=course_id))
+
+    def get(self, course_id, backend=None, metadata=None):
+        """
+        Returns the langchain Chroma store of a course, opening it if needed.
+
+        Args:
+            backend (str): Embedding backend of the collection if it does not
+                exist yet, EMBEDDING_BACKEND by default.
+            metadata (dict): Further metadata of the collection if it does not exist yet.
+        """
+        course_id = str(course_id)
+        name = self.active(course_id)
+        if CHROMA_MIGRATE_LEGACY and course_id not in self._open and name == collection_name(course_id):
+            self._migrate_if_legacy(course_id, name)
+        with self._lock:
+            if course_id in self._open and self._open[course_id][2] == name:
+                self._open.move_to_end(course_id)
+                self.hits += 1
+                store = self._open[course_id][0]
+            else:
+                backend_id = self._stored_backend(course_id, name) or resolve_backend(backend)
+                store = self._open_store(course_id, name, backend_id, metadata)
+                self._open[course_id] = (store, backend_id, name)
+                self.opens += 1
+                while len(self._open) > self.max_open:
+                    evicted_id, _ = self._open.popitem(last=False)
+                    self.evictions += 1
+                    print(f"Closed vector store of course {evicted_id}.")
+            restore = self._restores.get(course_id)
+        if restore is not None and restore[0] == name:
+            self._restore(course_id, restore, store)
+        return store
+
+    def restore_lazily(self, course_id, name, fill):
+        """
+        Defers writing the vectors of generation name of a course: fill(store)
+        is called by the first get() that returns it, and the callers of get()
+        wait until it returned.
+        """
+        with self._lock:
+            self._restores[str(course_id)] = (name, fill, threading.Lock())
+
+    def _restore(self, course_id, restore, store):
+        with restore[2]:
+            with self._lock:
+                if self._restores.get(course_id) is not restore:
+                    return
+            restore[1](store)
+            with self._lock:
+                if self._restores.get(course_id) is restore:
+                    del self._restores[course_id]
+
+    def pending_restores(self):
+        """Ids of the courses whose active generation is not written yet."""
+        with self._lock:
+            return list(self._restores)
+
+    def backend_of(self, course_id):
+        """Embedding backend id of a course index; the default backend if it does not exist yet."""
+        course_id = str(course_id)
+        name = self.active(course_id)
+        with self._lock:
+            if course_id in self._open and self._open[course_id][2] == name:
+                return self._open[course_id][1]
+        return self._stored_backend(course_id, name) or resolve_backend()
+
+    def _version_path(self, course_id):
+        return os.path.join(self.versions_dir, collection_name(course_id))
+
+    def version(self, course_id):
+        """Version of a course's vectors, '' until they are first changed."""
+        try:
+            with open(self._version_path(course_id), 'r') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return ''
+
+    def mark_changed(self, course_id, version=None, document_ids=None):
+        """
+        Gives a course's vectors a new version, after chunks were added or
+        removed, or the given one, e.g. the version a snapshot was taken at.
+
+        Args:
+            document_ids: The documents whose chunks changed; None if unknown
+                or the whole index changed.
+        """
+        version = version or f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+        # Logged first, so that a reader of the new version finds its entry
+        self._log_change(course_id, version, document_ids)
+        path = self._version_path(course_id)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(version)
+        os.replace(tmp_path, path)
+
+    def _changelog_path(self, course_id):
+        return os.path.join(self.versions_dir, collection_name(course_id) + '.changes')
+
+    def _log_change(self, course_id, version, document_ids):
+        path = self._changelog_path(course_id)
+        changed = '*' if document_ids is None else json.dumps(sorted(str(document_id) for document_id in document_ids))
+        with open(path, 'a') as f:
+            f.write(f"{version} {changed}\n")
+        if os.path.getsize(path) > CHROMA_CHANGELOG_BYTES:
+            # An entry appended meanwhile by another process may be lost; readers then load the whole course
+            with open(path, 'r') as f:
+                lines = f.readlines()
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.writelines(lines[len(lines) // 2:])
+            os.replace(tmp_path, path)
+
+    def changed_documents(self, course_id, since, until):
+        """
+        The ids of the documents whose chunks changed after version since, up
+        to version until, or None if the log cannot tell, e.g. when a version
+        changed the whole index or is no longer logged.
+        """
+        try:
+            with open(self._changelog_path(course_id), 'r') as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return None
+        changed = None
+        for line in lines:
+            version, _, documents = line.partition(' ')
+            if changed is None:
+                if version == since:
+                    changed = set()
+                continue
+            if documents == '*':
+                return None
+            changed.update(json.loads(documents))
+            if version == until:
+                return changed
+        return None
+
+    def _generations_path(self, course_id):
+        return os.path.join(self.versions_dir, collection_name(course_id) + '.json')
+
+    def generations(self, course_id):
+        """
+        The index generations of a course: {'active': collection name,
+        'previous': names of replaced generations, newest first, 'building':
+        name of a generation being built or None}.
+        """
+        try:
+            with open(self._generations_path(course_id), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'active': collection_name(course_id), 'previous': [], 'building': None}
+
+    def _write_generations(self, course_id, generations):
+        path = self._generations_path(course_id)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(generations, f)
+        os.replace(tmp_path, path)
+
+    def active(self, course_id):
+        """Collection name of the active generation of a course index."""
+        return self.generations(course_id)['active']
+
+    def generation_metadata(self, name):
+        """Metadata of a generation's collection (embedding backend, chunker), or None if it does not exist."""
+        collection = self._collection(name)
+        return dict(collection.metadata or {}) if collection is not None else None
+
+    def new_generation(self, course_id, backend_id, metadata=None):
+        """
+        Creates an empty generation of a course index, embedded with
+        backend_id, and returns its (collection name, Chroma store). The
+        active generation is unchanged until activate().
+        """
+        course_id = str(course_id)
+        name = f"{collection_name(course_id)[:54]}-{uuid.uuid4().hex[:8]}"
+        store = Chroma(client=self.client, collection_name=name, embedding_function=get_embedding_backend(backend_id),
+                       collection_metadata={**(metadata or {}), **COLLECTION_SPACE, 'embedding_backend': backend_id})
+        with self._lock:
+            generations = self.generations(course_id)
+            generations['building'] = name
+            self._write_generations(course_id, generations)
+        return name, store
+
+    def activate(self, course_id, name, version=None):
+        """
+        Makes a generation the active index of a course; the replaced one is
+        kept for rollback. The course's vectors get a new version, or the given one.
+        """
+        course_id = str(course_id)
+        with self._lock:
+            generations = self.generations(course_id)
+            if generations['active'] != name:
+                generations['previous'] = [generations['active']] + [previous for previous in generations['previous']
+                                                                     if previous != name]
+            generations['active'] = name
+            if generations.get('building') == name:
+                generations['building'] = None
+            self._write_generations(course_id, generations)
+            self._open.pop(course_id, None)
+            restore = self._restores.get(course_id)
+            if restore is not None and restore[0] != name:
+                del self._restores[course_id]
+        self.mark_changed(course_id, version)
+
+    def rollback(self, course_id):
+        """Makes the last replaced generation active again. Returns its name, or None if there is none."""
+        previous = [name for name in self.generations(course_id)['previous'] if self._collection(name) is not None]
+        if not previous:
+            return None
+        self.activate(course_id, previous[0])
+        return previous[0]
+
+    def collect_garbage(self, course_id, keep=INDEX_KEEP_PREVIOUS, abandoned=False):
+        """
+        Drops the replaced generations of a course beyond the keep newest ones
+        and, if abandoned, an unfinished build. Returns the dropped names.
+        """
+        course_id = str(course_id)
+        with self._lock:
+            generations = self.generations(course_id)
+            dropped = generations['previous'][keep:]
+            generations['previous'] = generations['previous'][:keep]
+            if abandoned and generations.get('building'):
+                dropped.append(generations['building'])
+                generations['building'] = None
+            if dropped:
+                self._write_generations(course_id, generations)
+        for name in dropped:
+            if self._collection(name) is not None:
+                self.client.delete_collection(name)
+        return dropped
+
+    def _stored_backend(self, course_id, name):
+        collection = self._collection(name)
+        if collection is not None:
+            return (collection.metadata or {}).get('embedding_backend') or resolve_backend('openai')
+        if name == collection_name(course_id) and os.path.isdir(self.legacy_dir(course_id)):
+            return resolve_backend('openai')
+        return None
+
+    def _open_store(self, course_id, name, backend_id, metadata=None):
+        embedding_function = get_embedding_backend(backend_id)
+        legacy_dir = self.legacy_dir(course_id)
+        if name == collection_name(course_id) and os.path.isdir(legacy_dir) and self._collection(name) is None:
+            return Chroma(embedding_function=embedding_function, persist_directory=legacy_dir)
+        # The metadata only applies if the collection is created
+        return Chroma(client=self.client, collection_name=name, embedding_function=embedding_function,
+                      collection_metadata={**(metadata or {}), **COLLECTION_SPACE, 'embedding_backend': backend_id})
+
+    def has_vectors(self, course_id):
+        """Whether the active collection of a course, or its legacy directory, holds any vector."""
+        course_id = str(course_id)
+        name = self.active(course_id)
+        collection = self._collection(name)
+        if collection is not None:
+            return collection.count() > 0
+        legacy_dir = self.legacy_dir(course_id)
+        if name != collection_name(course_id) or not os.path.isdir(legacy_dir):
+            return False
+        return self._open_store(course_id, name, resolve_backend('openai'))._collection.count() > 0
+
+    def _collection(self, name):
+        try:
+            return self.client.get_collection(name)
+        except Exception:
+            return None
+
+    def close(self, course_id):
+        with self._lock:
+            self._open.pop(str(course_id), None)
+            self._restores.pop(str(course_id), None)
+
+    def delete(self, course_id):
+        """Drops the collections of all generations of a course."""
+        self.close(course_id)
+        generations = self.generations(course_id)
+        for name in [generations['active']] + generations['previous'] + [generations.get('building')]:
+            if name and self._collection(name) is not None:
+                self.client.delete_collection(name)
+        if os.path.exists(self._generations_path(course_id)):
+            os.remove(self._generations_path(course_id))
+        self.mark_changed(course_id)
+
+    def _migrate_if_legacy(self, course_id, name):
+        with self._migrate_lock:
+            if os.path.isdir(self.legacy_dir(course_id)) and self._collection(name) is None:
+                self.migrate_legacy_course(course_id)
+
+    def migrate_legacy_course(self, course_id, batch_size=500):
+        """
+        Copies the vectors of a course's legacy directory into its collection of
+        the shared client. The legacy directory is left in place but no longer used.
+
+        Returns:
+            int: The number of vectors copied.
+        """
+        legacy_dir = self.legacy_dir(course_id)
+        if not os.path.isdir(legacy_dir):
+            return 0
+        self.close(course_id)
+        backend_id = resolve_backend('openai')
+        source = Chroma(embedding_function=get_embedding_backend(backend_id), persist_directory=legacy_dir)._collection
+        target = self.client.get_or_create_collection(collection_name(course_id),
+                                                      metadata={**COLLECTION_SPACE, 'embedding_backend': backend_id})
+        results = source.get(include=["documents", "metadatas", "embeddings"])
+        for start in range(0, len(results['ids']), batch_size):
+            end = start + batch_size
+            target.upsert(
+                ids=results['ids'][start:end],
+                embeddings=results['embeddings'][start:end],
+                documents=results['documents'][start:end],
+                metadatas=results['metadatas'][start:end]
+            )
+        self.mark_changed(course_id)
+        print(f"Migrated {len(results['ids'])} vectors of course {course_id} to the shared client.")
+        return len(results['ids'])
+
+    def stats(self):
+        """
+        Open/evict counters and, per open collection, its number of vectors and
+        estimated resident size (the float32 vectors an HNSW index holds).
+        """
+        with self._lock:
+            open_stores = list(self._open.items())
+        collections = {}
+        for course_id, (store, backend_id, name) in open_stores:
+            try:
+                count = store._collection.count()
+                sample = store._collection.peek(1)
+                embeddings = sample.get('embeddings')
+                dimensions = len(embeddings[0]) if embeddings is not None and len(embeddings) else 0
+                collections[course_id] = {'backend': backend_id, 'collection': name, 'vectors': count,
+                                          'resident_bytes': count * dimensions * 4}
+            except Exception as e:
+                collections[course_id] = {'error': str(e)}
+        return {
+            'open': len(open_stores),
+            'max_open': self.max_open,
+            'opens': self.opens,
+            'hits': self.hits,
+            'evictions': self.evictions,
+            'restoring': self.pending_restores(),
+            'collections': collections
+        }
+
+
+vector_stores = None
+_vector_stores_lock = threading.Lock()
+
+
+def get_vector_stores():
+    """Returns the course vector stores shared by all sessions of this process."""
+    global vector_stores
+    with _vector_stores_lock:
+        if vector_stores is None:
+            vector_stores = CourseVectorStores()
+    return vector_stores
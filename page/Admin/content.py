@@ -6,8 +6,10 @@ import io
 
 
 service = st.session_state.service
-fields = ["File Name", "Available To Assistant", "Preview", 'RAG Status', "Action"]
+fields = ["File Name", "Available To Assistant", "Preview", 'RAG Status', "Progress", "Action"]
 selected_course_id = None
+# Refresh interval of the progress column while a file is processed
+PROGRESS_REFRESH_SECONDS = 2
 
 
 @st.fragment
@@ -22,7 +24,10 @@ def retrieve_files():
                 "available": file['available'],
                 "file_id": file['_id'],
                 "status": file['status'],
-                "summary": file['summary']
+                "summary": file['summary'],
+                "progress": file.get('progress', {}),
+                "progress_percent": file.get('progress_percent', 0),
+                "progress_stage": file.get('progress_stage')
             })
 
 
@@ -83,7 +88,8 @@ def show_content():
                         wrapped_file = StreamlitFileWrapper(uploaded_file)
 
                         # Process each file individually
-                        service.save_file(wrapped_file)
+                        if not service.save_file(wrapped_file):
+                            st.info(uploaded_file.name + " was already uploaded to this course.")
 
                     # Append file details to session state after processing is complete
                     st.session_state['uploader_key'] += 1
@@ -93,6 +99,44 @@ def show_content():
                 st.error("Please upload valid files.")
     show_table()
 
+def format_stage_times(stages):
+    """One line per ingestion stage with its working time and counts"""
+    lines = []
+    for stage, record in stages.items():
+        counts = ", ".join(f"{value} {name}" for name, value in record.items()
+                           if isinstance(value, int) and not isinstance(value, bool) and value)
+        line = f"{stage}: {record.get('seconds', 0):.1f}s ({record.get('status')})"
+        lines.append(f"{line}, {counts}" if counts else line)
+    return "  \n".join(lines)
+
+
+def show_stage_summary(stages):
+    """Shows the slowest ingestion stage, with all stage timings on hover"""
+    if not stages:
+        st.write("-")
+        return
+    slowest = max(stages, key=lambda stage: stages[stage].get('seconds', 0))
+    total = sum(record.get('seconds', 0) for record in stages.values())
+    st.caption(f"{slowest}: {stages[slowest].get('seconds', 0):.1f}s of {total:.1f}s",
+               help=format_stage_times(stages))
+
+
+@st.fragment(run_every=PROGRESS_REFRESH_SECONDS)
+def show_live_progress(file_data):
+    """Progress bar of a file being processed, refreshed until ingestion ends"""
+    file = service.get_file_progress(file_data['file_id'])
+    if file is None:
+        return
+    if file['status'] != 'Processing':
+        # Reload the table once the file is done
+        st.rerun()
+    stages = file.get('progress', {})
+    stage = file.get('progress_stage') or 'queued'
+    st.progress(min(100, file.get('progress_percent', 0)) / 100, text=stage)
+    if stages:
+        st.caption("Stage times", help=format_stage_times(stages))
+
+
 def set_course_after_update():
     courses_cursor = service.get_courses(st.session_state.user['_id'])
     courses = {}
@@ -103,12 +147,30 @@ def set_course_after_update():
             st.session_state['selected_course'] = course
     service.set_course_details(st.session_state['selected_course'])
 
+def show_bulk_access():
+    """Grant or revoke assistant access to all completed files at once"""
+    completed = [file_data for file_data in st.session_state['uploaded_files'] if file_data['status'] == 'Completed']
+    bulk_cols = st.columns([1.5, 0.6, 0.6, 1.2])
+    for col, value, label in [(bulk_cols[1], True, "Grant Access to All"), (bulk_cols[2], False, "Revoke Access to All")]:
+        file_ids = [file_data['file_id'] for file_data in completed if file_data['available'] != value]
+        if col.button(label, key="bulk_access_" + str(value), disabled=not file_ids):
+            if service.set_files_available(file_ids, value):
+                st.toast('Availability updated for ' + str(len(file_ids)) + ' files')
+                set_course_after_update()
+                time.sleep(0.5)
+                st.rerun()
+            else:
+                st.toast('Something went wrong.')
+
+
 @st.fragment
 def show_table():
+    if st.session_state['uploaded_files']:
+        show_bulk_access()
     container = st.container(border=True)
     with container:
         # Create table header
-        cols = st.columns([1.5, 0.5, 0.5, 0.5, 0.5])
+        cols = st.columns([1.5, 0.5, 0.5, 0.5, 0.7, 0.5])
         for col, field in zip(cols, fields):
             html_content = f"<span style='font-weight: bold; font-size: 18px;'>{field}</span>"
             col.markdown(html_content, unsafe_allow_html=True)
@@ -121,14 +183,18 @@ def show_table():
                 file_name = file_data['file_name']
                 file_id = file_data['file_id']
                 file_status = file_data['status']
-                document_summary = file_data['summary']
                 status_flag = True if file_status == 'Processing' or file_status == 'Failed' else False
                 delete_flag = True if file_status == 'Processing' else False
 
-                col1, col2, col3, col4, col5 = st.columns([1.5, 0.5, 0.5, 0.5, 0.5])
+                col1, col2, col3, col4, col6, col5 = st.columns([1.5, 0.5, 0.5, 0.5, 0.7, 0.5])
 
                 col1.write(file_name)
                 col4.write(file_status)
+                with col6:
+                    if file_status == 'Processing':
+                        show_live_progress(file_data)
+                    else:
+                        show_stage_summary(file_data['progress'])
                 preview_placeholder = col3.empty()
                 show_preview = preview_placeholder.button(
                     "Preview", key="Preview" + str(file_id), disabled=True)
@@ -156,7 +222,7 @@ def show_table():
                         value = file_data['available'] = not file_data['available']
                         file_id = file_data['file_id']
                         file_name = file_data['file_name']
-                        if service.set_assistant_available(file_id, document_summary, value):
+                        if service.set_assistant_available(file_id, value):
                             st.toast(
                                 'Availability updated for file: ' + file_name)
                             set_course_after_update()
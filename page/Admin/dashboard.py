@@ -23,13 +23,19 @@ def create_new_assistant():
     course_id = st.text_input("Course Id", placeholder="e.g. CS5900")
     professor_name = st.text_input("Professor Name", "")
     description = st.text_area("Description","")
+    embedding_backend = st.selectbox(
+        "Embeddings", ["openai", "local", "local-int8"],
+        format_func=lambda backend: {"openai": "OpenAI", "local": "Local (CPU)", "local-int8": "Local (CPU, int8)"}[backend],
+        help="Local embeddings run on this server, without network access or per-token cost."
+    )
     if st.button("Submit"):
         if course_name == "" or course_id == "" or professor_name == "" or description == "":
             st.error("Please fill all the fields!")
             return
         with st.spinner("Creating new course..."):
             try:
-                course_id = service.create_course(course_id, course_name, professor_name, description, st.session_state.user['_id'])
+                course_id = service.create_course(course_id, course_name, professor_name, description, st.session_state.user['_id'],
+                                                  embedding_backend=embedding_backend)
                 st.success("Course created successfully!")
                 get_courses()
                 st.rerun()
@@ -0,0 +1,166 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from data.embedding_backends import get_embedding_backend, resolve_backend
+
+# Documents re-embedded at the same time by one rebuild
+INDEX_REBUILD_CONCURRENCY = int(os.getenv('INDEX_REBUILD_CONCURRENCY', 2))
+# Extracted texts loaded from MongoDB at once
+INDEX_REBUILD_BATCH = int(os.getenv('INDEX_REBUILD_BATCH', 16))
+# Passes over the files ingested or deleted while the rebuild ran, before the swap
+INDEX_REBUILD_CATCH_UP_PASSES = int(os.getenv('INDEX_REBUILD_CATCH_UP_PASSES', 3))
+
+
+class IndexRebuild:
+    """
+    Rebuilds the vector index of a course into a new generation, e.g. after
+    switching its embedding backend or the chunking parameters.
+
+    Every completed file is chunked and embedded again from the extracted
+    text stored in MongoDB, so nothing is read or OCRed again. The active
+    generation keeps serving searches meanwhile. Files ingested or deleted
+    during the rebuild are caught up, then the new generation is activated
+    in one step (see CourseVectorStores.activate) and files completed during
+    the swap are added to it. The replaced generation is kept for rollback
+    until it is garbage-collected.
+    """
+
+    def __init__(self, service, course_id, backend=None, concurrency=INDEX_REBUILD_CONCURRENCY):
+        self.mongodb = service.mongodb
+        self.chroma_db_manager = service.chroma_db_manager
+        self.vector_stores = self.chroma_db_manager.vector_stores
+        self.course_id = str(course_id)
+        self.backend_id = resolve_backend(backend) if backend else self.vector_stores.backend_of(self.course_id)
+        self.concurrency = concurrency
+        self.generation = None
+        self.status = 'pending'
+        self.error = None
+        self.stats = {'documents': 0, 'chunks': 0, 'seconds': 0.0}
+        self._stats_lock = threading.Lock()
+
+    def run(self):
+        """Builds and activates the new generation. Returns its collection name."""
+        started = time.perf_counter()
+        self.status = 'running'
+        embeddings_model = get_embedding_backend(self.backend_id)
+        self.generation, store = self.vector_stores.new_generation(
+            self.course_id, self.backend_id, {'chunker': self.chroma_db_manager.chunker_config()})
+        print(f"Rebuilding the index of course {self.course_id} into {self.generation} ({self.backend_id}).")
+        try:
+            for _ in range(INDEX_REBUILD_CATCH_UP_PASSES + 1):
+                if not self._catch_up(store, embeddings_model):
+                    break
+            self.vector_stores.activate(self.course_id, self.generation)
+            # Files completed while the generation was activated were written to the old one
+            if self._catch_up(store, embeddings_model, active=True):
+                self.chroma_db_manager.index_changed(self.course_id)
+            self.vector_stores.collect_garbage(self.course_id)
+        except Exception as e:
+            self.status = 'failed'
+            self.error = str(e)
+            if self.vector_stores.active(self.course_id) != self.generation:
+                self.vector_stores.collect_garbage(self.course_id, abandoned=True)
+            raise RuntimeError(f"Error rebuilding the index of course {self.course_id}: {e}")
+        finally:
+            self.stats['seconds'] = round(time.perf_counter() - started, 3)
+        self.status = 'completed'
+        print(f"Index of course {self.course_id} rebuilt: {self.stats}")
+        return self.generation
+
+    def _catch_up(self, store, embeddings_model, active=False):
+        """
+        Adds the completed files that have no chunks in store and removes the
+        others. Once store is active, files being ingested write their chunks
+        to it, so only the chunks of deleted files are removed. Returns whether
+        anything changed.
+        """
+        completed = self.mongodb.get_completed_file_ids(self.course_id)
+        stored = self.chroma_db_manager.stored_document_ids(store)
+        removed = stored - (self.mongodb.get_course_file_ids(self.course_id) if active else completed)
+        for document_id in removed:
+            self.chroma_db_manager.remove_stored_document(store, document_id)
+        missing = sorted(completed - stored)
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='index-rebuild') as executor:
+            for start in range(0, len(missing), INDEX_REBUILD_BATCH):
+                texts = self.mongodb.get_extracted_texts(self.course_id, missing[start:start + INDEX_REBUILD_BATCH])
+                list(executor.map(lambda item: self._rebuild_document(store, embeddings_model, *item), texts.items()))
+        return bool(missing) or bool(removed)
+
+    def _rebuild_document(self, store, embeddings_model, document_id, text_and_pages):
+        extracted_text, extracted_pages = text_and_pages
+        chunks = self.chroma_db_manager.rebuild_document(store, embeddings_model, document_id, extracted_text,
+                                                         extracted_pages)
+        with self._stats_lock:
+            self.stats['documents'] += 1
+            self.stats['chunks'] += chunks
+
+
+_rebuilds = {}
+_rebuilds_lock = threading.Lock()
+
+
+def start_index_rebuild(service, course_id, backend=None):
+    """
+    Rebuilds the index of a course in a background thread of this process.
+    Returns the running IndexRebuild; a course is rebuilt once at a time.
+    """
+    course_id = str(course_id)
+    with _rebuilds_lock:
+        rebuild = _rebuilds.get(course_id)
+        if rebuild is not None and rebuild.status in ('pending', 'running'):
+            return rebuild
+        rebuild = IndexRebuild(service, course_id, backend)
+        _rebuilds[course_id] = rebuild
+
+    def run():
+        try:
+            rebuild.run()
+        except Exception as e:
+            print(e)
+
+    threading.Thread(target=run, name=f'index-rebuild-{course_id}', daemon=True).start()
+    return rebuild
+
+
+def index_rebuilds():
+    """Status of the index rebuilds started by this process, by course."""
+    with _rebuilds_lock:
+        rebuilds = dict(_rebuilds)
+    return {course_id: {'status': rebuild.status, 'generation': rebuild.generation, 'backend': rebuild.backend_id,
+                        'error': rebuild.error, **rebuild.stats}
+            for course_id, rebuild in rebuilds.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuilds, rolls back or cleans up the vector index of a course.")
+    parser.add_argument('course_id')
+    parser.add_argument('--backend', help="Embedding backend of the new index (\"openai\", \"local\" or "
+                                          "\"local-int8\"), the course's current one by default.")
+    parser.add_argument('--rollback', action='store_true', help="Make the replaced index active again.")
+    parser.add_argument('--gc', action='store_true', help="Drop replaced indexes beyond INDEX_KEEP_PREVIOUS.")
+    parser.add_argument('--unfinished', action='store_true',
+                        help="With --gc, also drop the index of a rebuild that did not finish.")
+    parser.add_argument('--status', action='store_true', help="Show the index generations of the course.")
+    args = parser.parse_args()
+
+    from service.service import Service
+    service = Service(start_worker=False)
+    vector_stores = service.chroma_db_manager.vector_stores
+    if args.rollback:
+        print(f"Active index: {vector_stores.rollback(args.course_id)}")
+    elif args.gc:
+        print(f"Dropped: {vector_stores.collect_garbage(args.course_id, abandoned=args.unfinished)}")
+    elif not args.status:
+        IndexRebuild(service, args.course_id, args.backend).run()
+    print(json.dumps(service.chroma_db_manager.index_status(args.course_id), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+import argparse
+import gzip
+import io
+import json
+import os
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from data.vector_index import QuantizedVectorIndex
+from data.vector_store import collection_name
+
+# Version of the snapshot layout below; snapshots of another version are refused
+SNAPSHOT_FORMAT = 1
+# Directory of course snapshots imported when the process starts, for courses without a local index
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', '')
+SNAPSHOT_SUFFIX = '.snapshot'
+# Vectors written to Chroma at once when a snapshot is restored
+SNAPSHOT_RESTORE_BATCH = int(os.getenv('SNAPSHOT_RESTORE_BATCH', 1000))
+
+INDEX_PREFIX = 'index/'
+
+
+def _add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _read_json(tar, name):
+    try:
+        member = tar.getmember(name)
+    except KeyError:
+        return None
+    data = tar.extractfile(member).read()
+    return json.loads(gzip.decompress(data) if name.endswith('.gz') else data)
+
+
+def snapshot_path(course_id, directory=None):
+    return os.path.join(directory or SNAPSHOT_DIR or '.', collection_name(course_id) + SNAPSHOT_SUFFIX)
+
+
+def export_snapshot(service, course_id, path=None):
+    """
+    Packs the active index of a course into one snapshot file and returns its path.
+
+    A snapshot is an uncompressed tar file of:
+        manifest.json: format, course id, vector version, collection metadata
+            (embedding backend, chunker) and counts.
+        index/*: the course's quantized vector index (see QuantizedVectorIndex),
+            stored as it is so that it is memory-mapped once copied out.
+        embeddings.npy.gz, records.json.gz: the full vectors and the chunk ids
+            and metadatas, to restore the Chroma collection; the chunk texts
+            are those of the index.
+        lexical.json.gz: the chunks of the course's BM25 index, by document id.
+        availability.json.gz: the course's available documents and their version.
+    """
+    course_id = str(course_id)
+    chroma_db_manager = service.chroma_db_manager
+    vector_stores = chroma_db_manager.vector_stores
+    if not vector_stores.version(course_id):
+        vector_stores.mark_changed(course_id)
+    # Read before the vectors, like the vector index does, so that a concurrent write is not hidden
+    version = vector_stores.version(course_id)
+    name = vector_stores.active(course_id)
+    metadata = vector_stores.generation_metadata(name) or {'embedding_backend': vector_stores.backend_of(course_id)}
+    results = chroma_db_manager.get_course_db(course_id)._collection.get(
+        include=["documents", "embeddings", "metadatas"])
+    embeddings = np.asarray(results['embeddings'], dtype=np.float32)
+    if not len(results['ids']):
+        embeddings = np.zeros((0, 0), dtype=np.float32)
+    lexical = chroma_db_manager.lexical_index.documents(course_id) \
+        if chroma_db_manager.lexical_index is not None else None
+    document_ids, availability_version = service.mongodb.get_course_availability(course_id)
+
+    path = path or snapshot_path(course_id)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        generation = QuantizedVectorIndex(path=tmp_dir).get(
+            course_id, version, lambda: (results['documents'], embeddings, results['metadatas']))
+        manifest = {
+            'format': SNAPSHOT_FORMAT,
+            'course_id': course_id,
+            'version': version,
+            'created': time.time(),
+            'collection': {'name': name, 'metadata': metadata},
+            'vectors': len(results['ids']),
+            'dimensions': int(embeddings.shape[1]) if embeddings.ndim == 2 else 0,
+            'index': generation.meta
+        }
+        vectors = io.BytesIO()
+        np.save(vectors, embeddings)
+        with tarfile.open(tmp_path, 'w') as tar:
+            # First, so that an import reads it without scanning the file
+            _add_bytes(tar, 'manifest.json', json.dumps(manifest).encode())
+            for file_name in sorted(os.listdir(generation.path)):
+                tar.add(os.path.join(generation.path, file_name), arcname=INDEX_PREFIX + file_name)
+            _add_bytes(tar, 'embeddings.npy.gz', gzip.compress(vectors.getvalue()))
+            _add_bytes(tar, 'records.json.gz', gzip.compress(json.dumps(
+                {'ids': results['ids'], 'metadatas': results['metadatas']}).encode()))
+            if lexical is not None:
+                _add_bytes(tar, 'lexical.json.gz', gzip.compress(json.dumps(lexical).encode()))
+            _add_bytes(tar, 'availability.json.gz', gzip.compress(json.dumps(
+                {'document_ids': sorted(document_ids), 'version': availability_version}).encode()))
+    os.replace(tmp_path, path)
+    print(f"Exported {manifest['vectors']} vectors of course {course_id} to {path}.")
+    return path
+
+
+def _restorer(path):
+    """fill(store) writing the vectors of a snapshot into an empty Chroma store."""
+
+    def fill(store):
+        started = time.perf_counter()
+        with tarfile.open(path, 'r') as tar:
+            records = _read_json(tar, 'records.json.gz')
+            embeddings = np.load(io.BytesIO(gzip.decompress(tar.extractfile('embeddings.npy.gz').read())))
+            offsets = np.load(io.BytesIO(tar.extractfile(INDEX_PREFIX + 'offsets.npy').read()))
+            texts = tar.extractfile(INDEX_PREFIX + 'texts.bin').read()
+        ids = records['ids']
+        for start in range(0, len(ids), SNAPSHOT_RESTORE_BATCH):
+            end = min(start + SNAPSHOT_RESTORE_BATCH, len(ids))
+            store._collection.upsert(
+                ids=ids[start:end],
+                embeddings=embeddings[start:end],
+                documents=[texts[offsets[row]:offsets[row + 1]].decode('utf-8') for row in range(start, end)],
+                metadatas=records['metadatas'][start:end]
+            )
+        print(f"Restored {len(ids)} vectors from {path} in {time.perf_counter() - started:.2f}s.")
+
+    return fill
+
+
+def import_snapshot(service, path, lazy=False, replace=True):
+    """
+    Makes a snapshot the active index of its course. Returns the course id,
+    or None if replace is False and the course already has an index here.
+
+    The quantized index, BM25 chunks and available set are installed right
+    away, so that searches through the memory-mapped index (VECTOR_INDEX_BACKEND
+    "mmap") are served at once. The vectors are written to a new Chroma
+    generation, now or, if lazy, by the first use of the course's collection
+    (see CourseVectorStores.restore_lazily). The replaced generation is kept
+    for rollback. The available set is saved to MongoDB only if the course
+    has none there yet, e.g. in a fresh database.
+    """
+    chroma_db_manager = service.chroma_db_manager
+    vector_stores = chroma_db_manager.vector_stores
+    with tarfile.open(path, 'r') as tar:
+        manifest = _read_json(tar, 'manifest.json')
+        if manifest.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError(f"Unsupported snapshot format {manifest.get('format')} in {path}")
+        course_id = manifest['course_id']
+        version = manifest['version']
+        # A course imported from this snapshot by another process may still be restoring its vectors
+        if not replace and (vector_stores.has_vectors(course_id) or vector_stores.version(course_id) == version):
+            return None
+
+        metadata = manifest['collection']['metadata']
+        name, store = vector_stores.new_generation(course_id, metadata['embedding_backend'], metadata)
+        if chroma_db_manager.vector_index is not None:
+            chroma_db_manager.vector_index.install(course_id, version, [
+                (member.name[len(INDEX_PREFIX):], tar.extractfile(member))
+                for member in tar.getmembers() if member.name.startswith(INDEX_PREFIX)])
+        lexical = _read_json(tar, 'lexical.json.gz')
+        availability = _read_json(tar, 'availability.json.gz')
+
+    fill = _restorer(path)
+    if lazy:
+        vector_stores.restore_lazily(course_id, name, fill)
+    else:
+        fill(store)
+    # The index and the vectors keep the version the snapshot was taken at
+    vector_stores.activate(course_id, name, version)
+    if lexical is not None and chroma_db_manager.lexical_index is not None:
+        chroma_db_manager.lexical_index.restore(course_id, lexical)
+    if availability is not None:
+        service.availability.restore(course_id, availability['document_ids'], availability['version'])
+    print(f"Imported snapshot of course {course_id} ({manifest['vectors']} vectors) from {path}.")
+    return course_id
+
+
+_snapshots_restored = False
+_snapshots_lock = threading.Lock()
+
+
+def restore_snapshots(service, directory=SNAPSHOT_DIR):
+    """
+    Imports the snapshots of directory whose course has no index here yet,
+    once per process, e.g. on a fresh instance. Their Chroma collections are
+    then written in a background thread, or first by the search that needs them.
+    """
+    global _snapshots_restored
+    if not directory or not os.path.isdir(directory):
+        return
+    with _snapshots_lock:
+        if _snapshots_restored:
+            return
+        _snapshots_restored = True
+    for file_name in sorted(os.listdir(directory)):
+        if file_name.endswith(SNAPSHOT_SUFFIX):
+            try:
+                import_snapshot(service, os.path.join(directory, file_name), lazy=True, replace=False)
+            except Exception as e:
+                print(f"Error importing snapshot {file_name}: {e}")
+
+    vector_stores = service.chroma_db_manager.vector_stores
+
+    def restore():
+        for course_id in vector_stores.pending_restores():
+            try:
+                vector_stores.get(course_id)
+            except Exception as e:
+                print(f"Error restoring the index of course {course_id}: {e}")
+
+    threading.Thread(target=restore, name='snapshot-restore', daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exports or imports course index snapshots.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help="Write the snapshot of a course's index.")
+    export_parser.add_argument('course_id')
+    export_parser.add_argument('--output', help="Snapshot file, <SNAPSHOT_DIR>/course_<id>.snapshot by default.")
+    import_parser = subparsers.add_parser('import', help="Make a snapshot the active index of its course.")
+    import_parser.add_argument('path')
+    import_parser.add_argument('--keep', action='store_true', help="Skip the snapshot if its course has an index.")
+    args = parser.parse_args()
+
+    from service.service import Service
+    service = Service(start_worker=False)
+    if args.command == 'export':
+        export_snapshot(service, args.course_id, args.output)
+        course_id = args.course_id
+    else:
+        course_id = import_snapshot(service, args.path, replace=not args.keep)
+        if course_id is None:
+            print("The course already has an index; snapshot skipped.")
+            return
+    print(json.dumps(service.chroma_db_manager.index_status(course_id), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import os
+import queue
+from collections import deque
+import threading
+import time
+
+from utils.file_processor import iter_text_and_images, clean_extracted_text, OCR_COUNTERS
+from utils.text_normalizer import BoilerplateFilter, DEFAULT_STOPWORDS, split_pages
+
+# Maximum number of items (pages or chunk batches) waiting between two stages
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', 8))
+# Number of chunks sent to the embedding stage at once
+PIPELINE_EMBED_BATCH = int(os.getenv('PIPELINE_EMBED_BATCH', 64))
+# Chunk batches of one document being embedded at the same time
+PIPELINE_EMBED_IN_FLIGHT = int(os.getenv('PIPELINE_EMBED_IN_FLIGHT', 4))
+# Pages held back at the start of a document to learn its headers/footers
+BOILERPLATE_WINDOW = int(os.getenv('BOILERPLATE_WINDOW', 20))
+
+_DONE = object()
+
+
+class IngestionPipeline:
+    """
+    Streams one uploaded file through extract -> clean -> chunk -> embed -> write.
+
+    Every stage runs in its own thread and hands its output to the next stage
+    through a bounded queue, so embedding requests for the first pages overlap
+    with the OCR of later pages and only a few pages/chunk batches are held in
+    memory at any time, independent of the document length.
+    """
+
+    def __init__(self, chroma_db_manager, course_id, document_id, stopwords=None, queue_size=PIPELINE_QUEUE_SIZE,
+                 embed_batch_size=PIPELINE_EMBED_BATCH, workers=None, on_extracted=None, progress=None,
+                 cancelled=None):
+        self.chroma_db_manager = chroma_db_manager
+        self.course_id = course_id
+        self.document_id = document_id
+        self.queue_size = queue_size
+        self.embed_batch_size = embed_batch_size
+        self.workers = workers
+        self.on_extracted = on_extracted
+        self.progress = progress
+        # Event that stops the pipeline with an error once set, e.g. when the job's lease was lost
+        self.cancelled = cancelled
+        self.stopwords = DEFAULT_STOPWORDS + list(stopwords or [])
+        self.extracted_text = []
+        # [page_number, line_count] of the pages in extracted_text, see split_pages
+        self.extracted_pages = []
+        # chunks: written; duplicates: written with the embedding of a chunk of another document;
+        # repeated: dropped as near-duplicates of an earlier chunk of the document
+        self.stats = {'pages': 0, 'chunks': 0, 'duplicates': 0, 'repeated': 0}
+        self._stop = threading.Event()
+        self._errors = []
+        self._started = {}
+        self._waited = {}
+        self._deduplicated = False
+
+    def run(self, file_content=None, pages=None, extracted_pages=None):
+        """
+        Runs the pipeline to completion.
+
+        Args:
+            file_content: The uploaded file to extract the text from.
+            pages (list): Already extracted and cleaned text; skips extraction and cleaning.
+            extracted_pages (list): The page boundaries of pages, as recorded in self.extracted_pages.
+
+        Returns:
+            list: The cleaned text of the document, as extract_text_and_images would.
+        """
+        course_db = self.chroma_db_manager.get_course_db(self.course_id)
+        if pages is not None:
+            source = [('clean', lambda _: self._replay(split_pages(pages, extracted_pages)))]
+            for stage in ('read', 'ocr'):
+                self._progress('finish', stage, status='reused')
+        else:
+            source = [
+                ('extract', lambda _: self._extract(file_content)),
+                ('clean', self._clean),
+            ]
+        stages = source + [
+            ('chunk', self._chunk),
+            ('embed', self._embed),
+            ('write', lambda batches: self._write(batches, course_db)),
+        ]
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in stages[:-1]]
+        threads = []
+        for index, (name, stage) in enumerate(stages):
+            inbox = queues[index - 1] if index > 0 else None
+            outbox = queues[index] if index < len(queues) else None
+            thread = threading.Thread(target=self._run_stage, args=(name, stage, inbox, outbox), daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if self._errors:
+            if self.stats['chunks'] or self._deduplicated:
+                # Do not leave a partial document in the vector store, nor its chunks in the near-duplicate index
+                self.chroma_db_manager.remove_vector(self.course_id, self.document_id)
+            raise RuntimeError(self._errors[0])
+        produced = self.stats['chunks'] + self.stats['repeated']
+        self.stats['dedup_ratio'] = round((self.stats['duplicates'] + self.stats['repeated']) / produced, 3) \
+            if produced else 0.0
+        print(f"Pipeline finished for document {self.document_id}: {self.stats}")
+        return self.extracted_text
+
+    def _run_stage(self, name, stage, inbox, outbox):
+        """
+        Feeds the items of inbox through stage and puts its output on outbox.
+        The time spent waiting on the neighbouring stages is tracked in
+        self._waited, so only the working time of the stage is reported.
+        """
+        self._waited[name] = 0.0
+        self._started[name] = time.perf_counter()
+        if name != 'extract':
+            self._progress('start', name)
+        status = 'completed'
+        try:
+            for item in stage(self._drain(inbox, name)):
+                if self.cancelled is not None and self.cancelled.is_set():
+                    raise RuntimeError("Ingestion cancelled.")
+                if outbox is not None and not self._put(outbox, item, name):
+                    break
+        except Exception as e:
+            status = 'failed'
+            self._errors.append(e)
+            self._stop.set()
+        finally:
+            if outbox is not None:
+                self._put(outbox, _DONE, name, force=True)
+            if self._stop.is_set() and status == 'completed':
+                status = 'cancelled'
+            if name == 'extract':
+                ocr_seconds = self.stats.get('ocr_seconds', 0.0)
+                self._progress('finish', 'read', seconds=self._busy(name) - ocr_seconds, status=status)
+                self._progress('finish', 'ocr', seconds=ocr_seconds, status=status,
+                               **{counter: self.stats.get(counter, 0) for counter in OCR_COUNTERS})
+            else:
+                self._progress('finish', name, seconds=self._busy(name), status=status)
+
+    def _busy(self, name):
+        return time.perf_counter() - self._started[name] - self._waited[name]
+
+    def _progress(self, method, stage, **kwargs):
+        if self.progress is not None:
+            getattr(self.progress, method)(stage, **kwargs)
+
+    def _drain(self, inbox, name):
+        """Yields the items of a stage queue until the previous stage is done."""
+        if inbox is None:
+            return
+        while not self._stop.is_set():
+            waiting = time.perf_counter()
+            try:
+                item = inbox.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            finally:
+                self._waited[name] += time.perf_counter() - waiting
+            if item is _DONE:
+                return
+            yield item
+
+    def _put(self, outbox, item, name, force=False):
+        """Blocks until there is room in outbox; gives up when the pipeline stops, unless forced."""
+        waiting = time.perf_counter()
+        try:
+            while True:
+                if self._stop.is_set() and not force:
+                    return False
+                try:
+                    outbox.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    if force and self._stop.is_set():
+                        return False
+        finally:
+            self._waited[name] += time.perf_counter() - waiting
+
+    def _extract(self, file_content):
+        """Reads and OCRs the file, reporting the read and OCR stages separately."""
+        self._progress('start', 'read')
+        self._progress('start', 'ocr')
+        for page in iter_text_and_images(file_content, workers=self.workers, stats=self.stats):
+            ocr_seconds = self.stats.get('ocr_seconds', 0.0)
+            self._progress('update', 'read', seconds=self._busy('extract') - ocr_seconds, pages=1,
+                           total_pages=self.stats.get('total_pages'))
+            self._progress('update', 'ocr', seconds=ocr_seconds)
+            yield page
+
+    def _clean(self, pages):
+        """
+        Removes stopwords and repeated headers/footers. The first
+        BOILERPLATE_WINDOW pages are held back until the filter has seen enough
+        of the document; later pages are observed and cleaned one at a time.
+        """
+        boilerplate = BoilerplateFilter()
+        pending = []
+        for page_number, page in enumerate(pages, start=1):
+            self.stats['pages'] += 1
+            self._progress('update', 'clean', seconds=self._busy('clean'), pages=1)
+            boilerplate.observe(page)
+            pending.append((page_number, page))
+            if boilerplate.page_count >= BOILERPLATE_WINDOW:
+                yield from self._clean_pages(pending, boilerplate)
+                pending = []
+        yield from self._clean_pages(pending, boilerplate)
+        self.stats['boilerplate_lines'] = boilerplate.removed_lines
+        if self.on_extracted is not None and self.extracted_text:
+            self.on_extracted(self.extracted_text, self.extracted_pages)
+
+    def _replay(self, pages):
+        self._progress('update', 'clean', total_pages=len(pages))
+        for page_number, lines in pages:
+            self.stats['pages'] += 1
+            self._progress('update', 'clean', seconds=self._busy('clean'), pages=1)
+            self._add_page(page_number, lines)
+            yield page_number, lines
+
+    def _clean_pages(self, pages, boilerplate):
+        for page_number, page in pages:
+            cleaned = clean_extracted_text(page, stopwords=self.stopwords, boilerplate=boilerplate)
+            if cleaned:
+                self._add_page(page_number, cleaned)
+                yield page_number, cleaned
+
+    def _add_page(self, page_number, lines):
+        self.extracted_text.extend(lines)
+        if page_number is not None:
+            self.extracted_pages.append([page_number, len(lines)])
+
+    def _chunk(self, pages):
+        batches = self.chroma_db_manager.iter_chunks(pages, self.document_id, course_id=self.course_id,
+                                                     batch_size=self.embed_batch_size)
+        for chunks, metadatas in batches:
+            tokens = self.chroma_db_manager.count_tokens(chunks)
+            self.stats['tokens'] = self.stats.get('tokens', 0) + tokens
+            self._progress('update', 'chunk', seconds=self._busy('chunk'), chunks=len(chunks), tokens=tokens)
+            yield chunks, metadatas
+
+    def _embed(self, batches):
+        """
+        Submits up to PIPELINE_EMBED_IN_FLIGHT chunk batches to the embedding
+        batcher before waiting for the oldest one, so requests run concurrently
+        while the batches stay in document order. Near-duplicates of chunks
+        already in the course are not embedded, see ChromaDBManager.deduplicate.
+        """
+        in_flight = deque()
+        for chunks, metadatas in batches:
+            chunks, metadatas, ids, repeated = self.chroma_db_manager.deduplicate(self.course_id, self.document_id,
+                                                                                  chunks, metadatas)
+            duplicates = sum('duplicate_of' in metadata for metadata in metadatas)
+            self._deduplicated = self._deduplicated or ids is not None
+            self.stats['repeated'] += repeated
+            self.stats['duplicates'] += duplicates
+            self._progress('update', 'embed', duplicates=duplicates, repeated=repeated)
+            if not chunks:
+                continue
+            future = self.chroma_db_manager.embed_unique_chunks_async(chunks, metadatas, self.course_id)
+            in_flight.append((chunks, metadatas, ids, future))
+            if len(in_flight) >= PIPELINE_EMBED_IN_FLIGHT:
+                yield self._embedded(*in_flight.popleft())
+        while in_flight:
+            yield self._embedded(*in_flight.popleft())
+
+    def _embedded(self, chunks, metadatas, ids, future):
+        embeddings = future.result()
+        self._progress('update', 'embed', seconds=self._busy('embed'), chunks=len(chunks))
+        return chunks, metadatas, ids, embeddings
+
+    def _write(self, batches, course_db):
+        for chunks, metadatas, ids, embeddings in batches:
+            embeddings = self.chroma_db_manager.linked_embeddings(self.course_id, course_db, chunks, metadatas,
+                                                                  embeddings, ids)
+            self.chroma_db_manager.add_embeddings(course_db, chunks, metadatas, embeddings, ids)
+            self.chroma_db_manager.chunks_written(self.course_id, ids)
+            self.stats['chunks'] += len(chunks)
+            self._progress('update', 'write', seconds=self._busy('write'), chunks=len(chunks))
+            yield len(chunks)
+        # Searches see the document once all of its chunks are written
+        self.chroma_db_manager.index_changed(self.course_id, [self.document_id])
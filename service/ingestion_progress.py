@@ -0,0 +1,127 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Ingestion stages in order, with their share of the progress percentage
+STAGE_WEIGHTS = {
+    'read': 10,
+    'ocr': 25,
+    'clean': 5,
+    'chunk': 5,
+    'embed': 35,
+    'write': 5,
+    'summarize': 10,
+    'classify': 5,
+}
+STAGES = list(STAGE_WEIGHTS)
+# Minimum time between two progress writes to MongoDB for one file
+PROGRESS_UPDATE_SECONDS = float(os.getenv('PROGRESS_UPDATE_SECONDS', 2))
+
+
+class IngestionProgress:
+    """
+    Per-stage progress of one file, stored on its course_material_metadata document.
+
+    Every stage records when it started and finished, the time it spent working
+    (without waiting on other stages), and its item counts. Stages of the
+    streaming pipeline run concurrently, so updates are thread-safe and written
+    to MongoDB at most every PROGRESS_UPDATE_SECONDS.
+    """
+
+    def __init__(self, mongodb, file_id, min_interval=PROGRESS_UPDATE_SECONDS):
+        self.mongodb = mongodb
+        self.file_id = file_id
+        self.min_interval = min_interval
+        self.stages = {}
+        self.total_pages = None
+        self._lock = threading.Lock()
+        self._last_write = 0.0
+
+    def start(self, stage):
+        with self._lock:
+            self.stages[stage] = {
+                'status': 'running',
+                'started_at': datetime.now(timezone.utc),
+                'finished_at': None,
+                'seconds': 0.0,
+            }
+        self.flush(force=True)
+
+    def update(self, stage, seconds=None, total_pages=None, **counts):
+        """
+        Adds counts (pages, images, chunks, tokens, ...) to a running stage.
+
+        Args:
+            seconds (float): Working time of the stage so far, replaces the previous value.
+            total_pages (int): Number of pages of the document, once known.
+        """
+        with self._lock:
+            record = self.stages.setdefault(stage, {'status': 'running', 'started_at': datetime.now(timezone.utc),
+                                                    'finished_at': None, 'seconds': 0.0})
+            for name, count in counts.items():
+                record[name] = record.get(name, 0) + count
+            if seconds is not None:
+                record['seconds'] = round(seconds, 3)
+            if total_pages:
+                self.total_pages = total_pages
+        self.flush()
+
+    def finish(self, stage, seconds=None, status='completed', **counts):
+        self.update(stage, seconds=seconds, **counts)
+        with self._lock:
+            record = self.stages[stage]
+            record['status'] = status
+            record['finished_at'] = datetime.now(timezone.utc)
+            if seconds is None:
+                record['seconds'] = round((record['finished_at'] - record['started_at']).total_seconds(), 3)
+        self.flush(force=True)
+
+    @contextmanager
+    def stage(self, stage):
+        """Records a stage that runs as one step, e.g. summarize."""
+        self.start(stage)
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.finish(stage, seconds=time.perf_counter() - started, status='failed')
+            raise
+        self.finish(stage, seconds=time.perf_counter() - started)
+
+    def percent(self):
+        """
+        Overall progress from the stage weights. Streaming stages advance with
+        the share of pages that went through them; chunking and embedding also
+        with the share of the chunks produced so far that went through them.
+        """
+        with self._lock:
+            done = 0.0
+            pages = self.stages.get('clean', {}).get('pages', 0)
+            page_share = min(1.0, pages / self.total_pages) if self.total_pages else 0.0
+            chunks = self.stages.get('chunk', {}).get('chunks', 0)
+            for stage, weight in STAGE_WEIGHTS.items():
+                record = self.stages.get(stage)
+                if record is None or record['status'] == 'failed':
+                    continue
+                if record['status'] != 'running':
+                    done += weight
+                elif stage == 'read' and self.total_pages:
+                    done += weight * min(1.0, record.get('pages', 0) / self.total_pages)
+                elif stage in ('ocr', 'clean', 'chunk'):
+                    done += weight * page_share
+                elif stage in ('embed', 'write') and chunks:
+                    done += weight * page_share * min(1.0, record.get('chunks', 0) / chunks)
+            return int(done)
+
+    def flush(self, force=False):
+        """Writes the progress to MongoDB, unless the last write was less than min_interval ago."""
+        now = time.monotonic()
+        if not force and now - self._last_write < self.min_interval:
+            return
+        self._last_write = now
+        with self._lock:
+            stages = {stage: dict(record) for stage, record in self.stages.items()}
+            current = next((stage for stage in STAGES if stages.get(stage, {}).get('status') == 'running'), None)
+        self.mongodb.update_ingestion_progress(self.file_id, stages, self.percent(), current)
@@ -0,0 +1,196 @@
+import argparse
+import os
+import socket
+import sys
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Files processed at the same time by one worker process
+INGESTION_CONCURRENCY = int(os.getenv('INGESTION_CONCURRENCY', 2))
+# A job whose worker stops renewing its lease for this long is picked up again
+INGESTION_LEASE_SECONDS = int(os.getenv('INGESTION_LEASE_SECONDS', 300))
+# Attempts per file, retried after INGESTION_RETRY_SECONDS * 2^(attempt - 1)
+INGESTION_MAX_ATTEMPTS = int(os.getenv('INGESTION_MAX_ATTEMPTS', 3))
+INGESTION_RETRY_SECONDS = int(os.getenv('INGESTION_RETRY_SECONDS', 30))
+INGESTION_POLL_SECONDS = float(os.getenv('INGESTION_POLL_SECONDS', 5))
+# Whether the Streamlit process runs a worker itself; set to false when
+# uploads are processed only by standalone workers
+INGESTION_IN_PROCESS = os.getenv('INGESTION_IN_PROCESS', 'true').lower() == 'true'
+
+MIME_TYPES = {
+    '.pdf': "application/pdf",
+    '.pptx': "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    '.txt': "text/plain",
+    '.docx': "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+}
+
+
+class StoredFile:
+    """File-like view of an uploaded file stored in course_material_metadata."""
+
+    def __init__(self, file):
+        self.name = file['file_name']
+        self.type = file.get('file_type') or MIME_TYPES.get(os.path.splitext(self.name)[1].lower())
+        self.value = bytes(file['actual_file'])
+
+    def read(self, size=-1):
+        """Read the file content."""
+        if size == -1:
+            return self.value
+        return self.value[:size]
+
+    def getvalue(self):
+        """Return the file content as bytes."""
+        return self.value
+
+
+class IngestionWorker:
+    """
+    Leases ingestion jobs from MongoDB and processes them on a bounded pool of
+    threads. Jobs are leased for INGESTION_LEASE_SECONDS and the lease is renewed
+    while the file is processed, so jobs of a crashed worker are picked up by
+    another one. Failed jobs are retried with exponential backoff.
+    """
+
+    def __init__(self, service, concurrency=INGESTION_CONCURRENCY, worker_id=None):
+        self.service = service
+        self.mongodb = service.mongodb
+        self.concurrency = concurrency
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._slots = threading.Semaphore(concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='ingestion')
+        self._active = 0
+        self._active_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Runs the worker loop in a background thread."""
+        if self._thread is not None and self._thread.is_alive():
+            self.notify()
+            return self
+        self.mongodb.enqueue_unfinished_files()
+        self._thread = threading.Thread(target=self.run, name='ingestion-worker', daemon=True)
+        self._thread.start()
+        print(f"Ingestion worker {self.worker_id} started.")
+        return self
+
+    def notify(self):
+        """Wakes the worker up after a new job was queued."""
+        self._wakeup.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def run(self, once=False):
+        """
+        Leases and processes jobs until stopped.
+
+        Args:
+            once (bool): Return once the queue is empty and all jobs are done.
+        """
+        while not self._stop.is_set():
+            self._slots.acquire()
+            try:
+                job = self.mongodb.lease_ingestion_job(self.worker_id, INGESTION_LEASE_SECONDS)
+            except Exception as e:
+                print(e)
+                job = None
+
+            if job is None:
+                self._slots.release()
+                with self._active_lock:
+                    idle = self._active == 0
+                if once and idle:
+                    break
+                self._wakeup.wait(INGESTION_POLL_SECONDS)
+                self._wakeup.clear()
+                continue
+
+            with self._active_lock:
+                self._active += 1
+            self._executor.submit(self._process, job)
+
+        self._executor.shutdown(wait=True)
+
+    def _process(self, job):
+        print(f"__**Ingestion job {job['_id']} (attempt {job['attempts']}): file {job['file_id']}**__")
+        done = threading.Event()
+        # Set once another worker may have taken the job over; processing is then abandoned
+        lost = threading.Event()
+        heartbeat = threading.Thread(target=self._renew_lease, args=(job, done, lost), daemon=True)
+        heartbeat.start()
+        try:
+            self.service.process_ingestion_job(job, cancelled=lost)
+            if not self.mongodb.complete_ingestion_job(job['_id'], self.worker_id):
+                print(f"Ingestion job {job['_id']} was taken over by another worker.")
+        except Exception as e:
+            print(f"Error processing ingestion job {job['_id']}: {e}")
+            if not lost.is_set():
+                self._fail(job, e)
+        finally:
+            done.set()
+            with self._active_lock:
+                self._active -= 1
+            self._slots.release()
+            self._wakeup.set()
+
+    def _renew_lease(self, job, done, lost):
+        while not done.wait(INGESTION_LEASE_SECONDS / 3):
+            if not self.mongodb.renew_ingestion_lease(job['_id'], self.worker_id, INGESTION_LEASE_SECONDS):
+                print(f"Lost the lease of ingestion job {job['_id']}, abandoning it.")
+                lost.set()
+                return
+
+    def _fail(self, job, error):
+        try:
+            if job['attempts'] < INGESTION_MAX_ATTEMPTS:
+                retry_in = INGESTION_RETRY_SECONDS * 2 ** (job['attempts'] - 1)
+                print(f"Retrying ingestion job {job['_id']} in {retry_in} seconds.")
+                self.mongodb.fail_ingestion_job(job['_id'], self.worker_id, error, retry_in_seconds=retry_in)
+            elif self.mongodb.fail_ingestion_job(job['_id'], self.worker_id, error):
+                self.service.mark_file_failed(job['file_id'])
+        except Exception as e:
+            print(e)
+
+
+_shared_worker = None
+_shared_worker_lock = threading.Lock()
+
+
+def start_ingestion_worker(service):
+    """Starts the in-process worker of this process, once. Returns None when it is disabled."""
+    global _shared_worker
+    if not INGESTION_IN_PROCESS:
+        return None
+    with _shared_worker_lock:
+        if _shared_worker is None:
+            _shared_worker = IngestionWorker(service).start()
+    return _shared_worker
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Processes queued course material uploads.")
+    parser.add_argument('--concurrency', type=int, default=INGESTION_CONCURRENCY,
+                        help="Number of files processed at the same time.")
+    parser.add_argument('--once', action='store_true', help="Exit when the queue is empty.")
+    args = parser.parse_args()
+
+    from service.service import Service
+    service = Service(start_worker=False)
+    worker = IngestionWorker(service, concurrency=args.concurrency)
+    service.mongodb.enqueue_unfinished_files()
+    print(f"Ingestion worker {worker.worker_id} running with concurrency {args.concurrency}.")
+    try:
+        worker.run(once=args.once)
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import argparse
+import json
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+def best_threshold(samples):
+    """
+    Relevance threshold that best separates related from unrelated questions.
+
+    Args:
+        samples: (score, related) pairs: the score of a question's best chunk
+            and whether it is about the course.
+
+    Returns:
+        tuple: (threshold, accuracy). The threshold lies halfway between two
+        neighbouring scores; of equally good ones the lowest is taken, so that
+        borderline questions are rather answered. accuracy is the mean of the
+        shares of related and of unrelated questions decided right.
+    """
+    related = sorted(score for score, is_related in samples if is_related)
+    unrelated = sorted(score for score, is_related in samples if not is_related)
+    if not related or not unrelated:
+        raise ValueError("Calibration needs both related and unrelated questions")
+    scores = sorted(set(related + unrelated))
+    candidates = [scores[0] - 0.01] + [(low + high) / 2 for low, high in zip(scores, scores[1:])] + [scores[-1] + 0.01]
+
+    best = None
+    for threshold in candidates:
+        accuracy = accuracy_at(threshold, related, unrelated)
+        if best is None or accuracy > best[1]:
+            best = (round(threshold, 4), accuracy)
+    return best
+
+
+def accuracy_at(threshold, related, unrelated):
+    """Mean of the shares of related scores at or above threshold and of unrelated scores below it."""
+    answered = sum(score >= threshold for score in related) / len(related)
+    refused = sum(score < threshold for score in unrelated) / len(unrelated)
+    return round((answered + refused) / 2, 4)
+
+
+def calibrate(chroma_db_manager, course_id, labelled):
+    """
+    Scores labelled questions against the available documents of a course and
+    returns the best threshold for its embedding model, next to the current one.
+
+    Args:
+        labelled: (question, related) pairs.
+    """
+    course_id = str(course_id)
+    document_ids = chroma_db_manager.available_documents(course_id)
+    samples = []
+    for question, related in labelled:
+        hits = chroma_db_manager.scored_search(course_id, question, 1, document_ids=document_ids)
+        # Without any chunk to compare with, no threshold makes a question related
+        samples.append((hits[0].metadata['score'] if hits else -1.0, bool(related)))
+    threshold, accuracy = best_threshold(samples)
+    current = chroma_db_manager.relevance_threshold(course_id)
+    return {
+        'model': chroma_db_manager.vector_stores.backend_of(course_id).partition(':')[2],
+        'questions': len(samples),
+        'related': sum(related for _, related in samples),
+        'threshold': threshold,
+        'accuracy': accuracy,
+        'current_threshold': current,
+        'current_accuracy': accuracy_at(current, [score for score, related in samples if related],
+                                        [score for score, related in samples if not related]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the relevance threshold of a course's embedding model "
+                                                 "on labelled questions.")
+    parser.add_argument('course_id')
+    parser.add_argument('questions', help="JSON lines file of {\"question\": ..., \"related\": true|false}.")
+    args = parser.parse_args()
+
+    with open(args.questions, 'r', encoding='utf-8') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    labelled = [(record['question'], record['related']) for record in records]
+
+    from service.service import Service
+    service = Service(start_worker=False)
+    result = calibrate(service.chroma_db_manager, args.course_id, labelled)
+    print(json.dumps(result, indent=2))
+    print(f"RELEVANCE_THRESHOLDS='{json.dumps({result['model']: result['threshold']})}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,39 @@
 import os
 import sys
-import threading
+import hashlib
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from utils.file_processor import extract_text_and_images
+from service.ingestion_pipeline import IngestionPipeline
+from service.ingestion_progress import IngestionProgress
+from service.ingestion_worker import StoredFile, start_ingestion_worker
+from service.index_rebuild import start_index_rebuild, index_rebuilds
+from service.index_snapshot import restore_snapshots
 from data.mongodb_handler import MongoDBHandler
-from data.embedding_handler import ChromaDBManager
+from data.embedding_handler import ChromaDBManager, retrieval_stats
+from data.embedding_cache import embedding_cache_stats
+from data.embedding_batcher import embedding_batcher_stats
+from data.query_cache import query_cache_stats
+from data.availability_index import get_availability_index
+from data.federated_search import get_federated_search
+from utils.file_processor import ocr_cache_stats
 from utils import groq_util_module as groq_model
 
 class Service:
 
-    def __init__(self):
+    def __init__(self, start_worker=True):
         self.mongodb = MongoDBHandler()
-        self.chroma_db_manager = ChromaDBManager()
+        self.chroma_db_manager = ChromaDBManager(self.mongodb)
         self.summarizer = groq_model.GroqCorseSummarizer(self.mongodb)
         self.quiz_generator = groq_model.GroqQuizGenerator()
+        self.availability = get_availability_index(self.mongodb)
+        # Searches of all the courses of a student at once
+        self.federated_search = get_federated_search(self.mongodb, self.chroma_db_manager, self.availability)
+        if start_worker:
+            # A fresh instance serves the courses of SNAPSHOT_DIR before their Chroma collections are written
+            restore_snapshots(self)
+        # Uploads are processed by the ingestion worker, shared by all sessions of this process
+        self.ingestion_worker = start_ingestion_worker(self) if start_worker else None
         print('Service initialized')
     
     def set_course_details(self, course_details):
@@ -26,43 +44,160 @@ class Service:
 
     #Embedding Creation
     def save_file(self, file_content):
-        # Saves the file content and starts a thread to create embeddings
-        file_id = self.save_file_db(file_content, self.course_id)
+        """
+        Saves the file content and queues it for the ingestion worker.
+        Returns False without saving if the same file is already in the course.
+        """
+        content_hash = hashlib.sha256(file_content.getvalue()).hexdigest()
+        duplicate = self.mongodb.find_file_by_hash(content_hash, course_id=self.course_id,
+                                                   statuses=['Processing', 'Completed'])
+        if duplicate is not None:
+            print(f"{file_content.name} is a duplicate of {duplicate['file_name']}, skipping upload.")
+            return False
 
-        # Start thread to complete remaining process
-        threading.Thread(target=self.create_embedding, args=(file_id, file_content)).start()
-    
-    def create_embedding(self, file_id, file_content):
+        file_id = self.save_file_db(file_content, self.course_id, content_hash)
+        self.mongodb.enqueue_ingestion_job(file_id, self.course_id)
+        if self.ingestion_worker is not None:
+            self.ingestion_worker.notify()
+        return True
+
+    def process_ingestion_job(self, job, cancelled=None):
         """
         Generates embeddings for different file types like PDF, text, pptx, etc.
-        After extracting text from the document, the text is stored in MongoDB.
-        Then, embeddings are created and stored in Chroma.
+        Pages are extracted, chunked, embedded and stored in Chroma as a
+        streaming pipeline, then the document is summarized. Every finished
+        step is checkpointed on the job, so a retried job resumes after it:
+        the extracted text is reused instead of running OCR again.
+
+        Processing stops with an error once cancelled (a threading.Event) is
+        set, e.g. when the worker lost the job's lease to another one.
         """
-        extracted_text = ''
-        try:
-            print('__**In thread: Create Embeddings...**__')
-            extracted_text = extract_text_and_images(file_content)
+        def check_cancelled():
+            if cancelled is not None and cancelled.is_set():
+                raise RuntimeError(f"Ingestion job {job['_id']} was cancelled.")
+
+        file_id = job['file_id']
+        course_id = job['course_id']
+        document_id = str(file_id)
+        checkpoints = job.get('checkpoints', {})
+        file = self.mongodb.get_file(file_id)
+        if file is None:
+            print(f"File {file_id} was deleted, skipping ingestion.")
+            return
+
+        progress = IngestionProgress(self.mongodb, file_id)
+        source = None if checkpoints.get('embedded') else self.find_reusable_file(job, file)
+        if source is not None and self.reuse_ingested_file(job, file, source, progress):
+            return
+
+        extracted_text = file.get('extracted_text') if checkpoints.get('extracted') else None
+        extracted_pages = file.get('extracted_pages')
+        summarized = checkpoints.get('summarized')
+        if source is not None and not extracted_text:
+            # Its chunks could not be copied, e.g. the courses use different embedding
+            # backends: only embed its text again, without extracting or summarizing it
+            self.mongodb.copy_ingested_file(file_id, source)
+            self.mongodb.checkpoint_ingestion_job(job['_id'], 'reused_from', source['_id'])
+            self.mongodb.checkpoint_ingestion_job(job['_id'], 'extracted')
+            extracted_text = source['extracted_text']
+            extracted_pages = source.get('extracted_pages')
+            summarized = summarized or source.get('summary') not in (None, 'None')
+        generation = self.chroma_db_manager.index_generation(course_id)
+        if not checkpoints.get('embedded'):
+            # Drop the vectors of an earlier, interrupted attempt
+            self.chroma_db_manager.remove_vector(course_id=course_id, document_id=document_id)
+
+            def save_extracted(text, pages):
+                self.mongodb.save_extracted_text(file_id, text, pages)
+                self.mongodb.checkpoint_ingestion_job(job['_id'], 'extracted')
+
+            stopwords = self.mongodb.get_course_stopwords(course_id)
+            pipeline = IngestionPipeline(self.chroma_db_manager, course_id, document_id, stopwords=stopwords,
+                                         on_extracted=save_extracted, progress=progress, cancelled=cancelled)
+            if extracted_text:
+                extracted_text = pipeline.run(pages=extracted_text, extracted_pages=extracted_pages)
+            else:
+                extracted_text = pipeline.run(StoredFile(file))
+            extracted_pages = pipeline.extracted_pages
             if not extracted_text:
                 raise ValueError("Failed to extract text from the given file.")
+            self.mongodb.checkpoint_ingestion_job(job['_id'], 'chunks', pipeline.stats['chunks'])
+            self.mongodb.checkpoint_ingestion_job(job['_id'], 'dedup_ratio', pipeline.stats['dedup_ratio'])
+            self.mongodb.checkpoint_ingestion_job(job['_id'], 'embedded')
+            print("**Extracted Text and Embeddings Created: "+document_id+"**")
 
-            print("**Extracted Text: "+str(file_id)+"**")
-            
-            # After saving to DB, create embeddings in Chroma
-            self.store_vector(course_id=self.course_id, document_id=str(file_id), extracted_text=extracted_text)
-            print("**Embeddings Created: "+str(file_id)+"**")
-            
+        if not summarized:
+            check_cancelled()
             # Create document summary
-            self.summarizer.save_document_summary(file_id, extracted_text)
-            print("**Document Summary Created: "+str(file_id)+"**")
+            with progress.stage('summarize'):
+                self.summarizer.save_document_summary(file_id, extracted_text)
+            self.mongodb.checkpoint_ingestion_job(job['_id'], 'summarized')
+            print("**Document Summary Created: "+document_id+"**")
 
-            # Save extracted text to MongoDB
+        check_cancelled()
+        # Classify the file and save extracted text to MongoDB
+        with progress.stage('classify'):
             self.update_file_db(file_id, extracted_text, 'Completed')
-            print('__**In thread: Completed...**__')
+        self.chroma_db_manager.add_lexical_document(course_id, document_id, extracted_text, extracted_pages)
+        if not checkpoints.get('embedded') and self.chroma_db_manager.index_generation(course_id) != generation:
+            # The course index was rebuilt meanwhile and the chunks went to the replaced one
+            self.chroma_db_manager.reindex_document(course_id, document_id, extracted_text, extracted_pages)
+        print('__**Ingestion: Completed...**__')
+
+    def find_reusable_file(self, job, file):
+        """
+        Returns the same file ingested in another course, whose extracted text
+        can be reused, or None.
+
+        The text is only reused when both courses have the same stopwords,
+        since it is stored cleaned.
+        """
+        content_hash = file.get('content_hash')
+        if not content_hash:
+            return None
+        source = self.mongodb.find_file_by_hash(content_hash, exclude_course_id=job['course_id'],
+                                                statuses=['Completed'])
+        if source is None or not source.get('extracted_text'):
+            return None
+        if self.mongodb.get_course_stopwords(source['course_id']) != self.mongodb.get_course_stopwords(job['course_id']):
+            return None
+        return source
+
+    def reuse_ingested_file(self, job, file, source, progress):
+        """
+        Completes the ingestion of a file already ingested in another course by
+        copying its extracted text, summary, chunks and embeddings. Returns
+        False if the chunks could not be copied, e.g. when the courses use
+        different embedding backends.
+        """
+        document_id = str(file['_id'])
+        try:
+            self.chroma_db_manager.remove_vector(course_id=job['course_id'], document_id=document_id)
+            with progress.stage('write'):
+                chunks = self.chroma_db_manager.copy_document(source['course_id'], str(source['_id']),
+                                                              job['course_id'], document_id)
         except Exception as e:
-            print(f"Error creating embeddings: {e}")
-            # Save status failed
-            self.update_file_db(file_id, extracted_text if extracted_text else '', 'Failed')
-        
+            print(f"Could not reuse embeddings of file {source['_id']}: {e}")
+            return False
+        if not chunks:
+            return False
+
+        self.mongodb.copy_ingested_file(file['_id'], source)
+        self.mongodb.checkpoint_ingestion_job(job['_id'], 'reused_from', source['_id'])
+        self.mongodb.checkpoint_ingestion_job(job['_id'], 'chunks', chunks)
+        with progress.stage('classify'):
+            self.update_file_db(file['_id'], source['extracted_text'], 'Completed')
+        self.chroma_db_manager.add_lexical_document(job['course_id'], document_id, source['extracted_text'],
+                                                    source.get('extracted_pages'))
+        print(f"**Reused {chunks} chunks of file {source['_id']} for file {document_id}**")
+        return True
+
+    def mark_file_failed(self, file_id):
+        """Sets the status of a file whose ingestion ran out of attempts"""
+        file = self.mongodb.get_file(file_id)
+        if file is not None:
+            self.update_file_db(file_id, file.get('extracted_text') or '', 'Failed')
+
     #Save to MongoDB (Abstract Layer)
     def initialize_collections(self):
         """
@@ -70,11 +205,11 @@ class Service:
         """
         self.mongodb.initialize_collections()
 
-    def save_file_db(self, file_content, course_id):
+    def save_file_db(self, file_content, course_id, content_hash=None):
         """
         Saves the file and their extracted text to MongoDB.
         """
-        return self.mongodb.save_file(file_content, course_id)
+        return self.mongodb.save_file(file_content, course_id, content_hash)
 
     def update_file_db(self, file_id, extracted_text, status):
         """Updates the file status and extracted text in MongoDB"""
@@ -83,23 +218,44 @@ class Service:
         contents['extracted_text'] = extracted_text
         self.mongodb.update_file(file_id, contents)
 
+    def get_file_progress(self, file_id):
+        """Retrieves the status and ingestion progress of a file"""
+        return self.mongodb.get_file_progress(file_id)
+
     def get_file_db(self, course_id):
         """
         Retrieves the file and extracted text from the specified MongoDB collection.
         """
         return self.mongodb.get_files(course_id)
 
-    def create_course(self, course_id, course_name, professor_name, description, professor_id):
+    def create_course(self, course_id, course_name, professor_name, description, professor_id, embedding_backend=None):
         """
-        Creates a new course in MongoDB.
+        Creates a new course in MongoDB, with a vector index embedded by
+        embedding_backend ("openai", "local" or "local-int8", EMBEDDING_BACKEND by default).
         """
         course_id = self.mongodb.create_course(
             course_id, course_name, professor_name, description, professor_id)
         if course_id:
-            self.chroma_db_manager.create_course_db(course_id=course_id)
-            self.chroma_db_manager._initialize_course_db_map()
+            self.chroma_db_manager.create_course_db(course_id=course_id, embedding_backend=embedding_backend)
         return course_id
 
+    def rebuild_course_index(self, course_id, embedding_backend=None):
+        """
+        Rebuilds the vector index of a course in the background, with
+        embedding_backend (the course's current one by default) and the
+        current chunking parameters. Searches use the old index until the
+        new one is complete.
+        """
+        return start_index_rebuild(self, course_id, embedding_backend)
+
+    def rollback_course_index(self, course_id):
+        """Makes the index a rebuild replaced active again; returns its name, or None if there is none."""
+        return self.chroma_db_manager.vector_stores.rollback(course_id)
+
+    def get_course_index_status(self, course_id):
+        """Index generations of a course, with their embedding backend and chunker"""
+        return self.chroma_db_manager.index_status(course_id)
+
     def get_courses(self, professor_id):
         """
         Retrieves all courses from MongoDB.
@@ -121,7 +277,9 @@ class Service:
         Deletes the file and extracted text from the specified MongoDB collection.
         """
         self.remove_vector(file_id=file_id)
-        return self.mongodb.remove_file(file_id)
+        removed = self.mongodb.remove_file(file_id)
+        self.availability.forget(self.course_id)
+        return removed
 
     def login(self, username, hashed_password):
         """
@@ -151,13 +309,19 @@ class Service:
         """
         Removes course and metadata from MongoDB.
         """
-        return self.mongodb.remove_course(self.course_id)
+        self.availability.forget(self.course_id)
+        removed = self.mongodb.remove_course(self.course_id)
+        if removed:
+            self.chroma_db_manager.remove_course_db(self.course_id)
+        return removed
 
-    def set_assistant_available(self, file_id, document_summary, value):
+    def set_assistant_available(self, file_id, value):
         """Sets the availability of the assistant for a document"""
-        self.chroma_db_manager.change_availability(
-            course_id=self.course_id, document_id=str(file_id), available=value)
-        return self.mongodb.set_assistant_available(self.course_id, self.course_summary, file_id, document_summary, value)
+        return self.set_files_available([file_id], value)
+
+    def set_files_available(self, file_ids, value):
+        """Grants or revokes assistant access to several documents of the course at once"""
+        return self.availability.set_available(self.course_id, self.course_summary, file_ids, value)
 
     def create_student_course(self, user_id, course_id):
         """Creates a student-course association in MongoDB"""
@@ -176,7 +340,18 @@ class Service:
         Searches for similar vectors in the Chroma vector store based on the query vector.
         """
         print(f"Searching vector for {query_text}...")
-        return self.chroma_db_manager.search_vector(course_id=self.course_id, query_text=query_text, k=top_k)
+        return self.chroma_db_manager.search_vector(course_id=self.course_id, query_text=query_text, k=top_k,
+                                                    document_ids=self.availability.get(self.course_id))
+
+    def search_enrolled_courses(self, student_id, query_text, top_k=5):
+        """
+        Searches all courses the student is enrolled in for a query, each within
+        its available documents. Returns the hits, with metadata['course_id'],
+        and a report of the courses searched (see FederatedSearch.search).
+        """
+        if self.federated_search is None:
+            raise RuntimeError("Federated search is disabled (FEDERATED_CONCURRENCY=0).")
+        return self.federated_search.search_enrolled(student_id, query_text, top_k)
 
     def remove_vector(self, file_id):
         """Removes a vector from ChromaDB"""
@@ -193,3 +368,24 @@ class Service:
         """Retrieves homework file IDs for the course"""
         return self.mongodb.get_homework_file_ids(self.course_id)
 
+    def get_cache_stats(self):
+        """Hit ratios, sizes and savings of the OCR, embedding and query caches, and open vector stores of this process"""
+        return {
+            'ocr': ocr_cache_stats(),
+            'embedding': embedding_cache_stats(),
+            'embedding_requests': embedding_batcher_stats(),
+            'queries': query_cache_stats(),
+            'retrieval': retrieval_stats(),
+            'lexical_index': self.chroma_db_manager.lexical_index.stats()
+            if self.chroma_db_manager.lexical_index is not None else None,
+            'near_duplicates': self.chroma_db_manager.near_duplicates.stats()
+            if self.chroma_db_manager.near_duplicates is not None else None,
+            'document_router': self.chroma_db_manager.document_router.stats()
+            if self.chroma_db_manager.document_router is not None else None,
+            'vector_stores': self.chroma_db_manager.vector_stores.stats(),
+            'index_rebuilds': index_rebuilds(),
+            'federated_search': self.federated_search.search_stats() if self.federated_search is not None else None,
+            'vector_index': self.chroma_db_manager.vector_index.index_stats()
+            if self.chroma_db_manager.vector_index is not None else None
+        }
+
@@ -0,0 +1,39 @@
+import itertools
+
+import pytest
+
+import utils.disk_cache as disk_cache
+from utils.disk_cache import DiskCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    ticks = itertools.count(1000)
+    monkeypatch.setattr(disk_cache.time, 'time', lambda: float(next(ticks)))
+
+
+def test_values_are_stored_and_counted(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache' / 'values.sqlite'), max_bytes=1000)
+    cache.set_many({'a': b'one', 'b': b'two'})
+    assert cache.get('a') == b'one'
+    assert cache.get_many(['a', 'b', 'missing', 'a']) == {'a': b'one', 'b': b'two'}
+    assert cache.get('missing') is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries'], stats['bytes']) == (3, 2, 2, 6)
+
+
+def test_values_outlive_the_connection(tmp_path):
+    path = str(tmp_path / 'values.sqlite')
+    DiskCache(path, max_bytes=1000).set('a', b'one')
+    assert DiskCache(path, max_bytes=1000).get('a') == b'one'
+
+
+def test_least_recently_used_values_are_evicted(tmp_path, clock):
+    cache = DiskCache(str(tmp_path / 'values.sqlite'), max_bytes=30)
+    for key in 'abc':
+        cache.set(key, b'x' * 10)
+    cache.get('a')
+    # 40 bytes: evicted down to 90% of max_bytes, least recently used first
+    cache.set('d', b'x' * 10)
+    assert set(cache.get_many('abcd')) == {'a', 'd'}
+    assert cache.stats()['bytes'] == 20
@@ -0,0 +1,129 @@
+import threading
+import time
+
+from langchain_core.documents import Document
+
+from data.federated_search import FederatedSearch
+
+
+class FakeVectorStores:
+    def backend_of(self, course_id):
+        return 'openai:text-embedding-3-small'
+
+
+class FakeChromaDBManager:
+    """Courses answering with their hits after a delay, all with the threshold 0.5."""
+
+    def __init__(self, hits, delays=None):
+        self.hits = hits
+        self.delays = delays or {}
+        self.vector_stores = FakeVectorStores()
+        self.embedded = []
+        self.searched = []
+
+    def is_question(self, query_text):
+        return True
+
+    def embed_query(self, course_id, query_text):
+        self.embedded.append(course_id)
+
+    def relevance_threshold(self, course_id):
+        return 0.5
+
+    def retrieve(self, course_id, query_text, k=3, document_ids=None, threshold=None):
+        self.searched.append(course_id)
+        delay = self.delays.get(course_id, 0)
+        if isinstance(delay, threading.Event):
+            delay.wait(5)
+        else:
+            time.sleep(delay)
+        hits = [Document(page_content=f"{course_id} {score}", metadata={'score': score})
+                for score in self.hits.get(course_id, [])]
+        return hits[:k], bool(hits)
+
+
+class FakeAvailability:
+    def get(self, course_id):
+        return {f"{course_id}-doc"}
+
+
+class FakeMongoDB:
+    def get_student_course_ids(self, student_id):
+        return ['a', 'b', 'c'] if student_id == 'student' else []
+
+
+def _search(chroma_db_manager, concurrency=4):
+    return FederatedSearch(FakeMongoDB(), chroma_db_manager, FakeAvailability(), concurrency=concurrency)
+
+
+def test_hits_are_interleaved_by_rank_within_the_quota():
+    chroma_db_manager = FakeChromaDBManager({'a': [0.7, 0.6, 0.55], 'b': [0.9, 0.8], 'c': []})
+    hits, report = _search(chroma_db_manager).search(['a', 'b', 'c', 'a'], "what is a gradient?", k=5, quota=2)
+    assert [(hit.metadata['course_id'], hit.metadata['score']) for hit in hits] == \
+           [('b', 0.9), ('a', 0.7), ('b', 0.8), ('a', 0.6)]
+    assert report['searched'] == ['a', 'b', 'c']
+    assert report['related'] == ['b', 'a']
+    assert report['timed_out'] == [] and report['failed'] == {}
+    # One embedding per backend
+    assert chroma_db_manager.embedded == ['a']
+
+
+def test_slow_courses_are_reported_and_do_not_hold_up_later_searches():
+    release = threading.Event()
+    chroma_db_manager = FakeChromaDBManager({'a': [0.9], 'slow': [0.9], 'queued': [0.9]},
+                                            {'slow': release})
+    federated = _search(chroma_db_manager, concurrency=2)
+    try:
+        hits, report = federated.search(['slow', 'a'], "what is a gradient?", budget=0.5)
+        assert report['timed_out'] == ['slow']
+        assert [hit.metadata['course_id'] for hit in hits] == ['a']
+        threads = threading.active_count()
+
+        # The slow course is still being searched: it is reported at once instead of taking another thread
+        for _ in range(5):
+            started = time.perf_counter()
+            hits, report = federated.search(['slow', 'a'], "what is a gradient?", budget=0.5)
+            assert time.perf_counter() - started < 0.4
+            assert report['timed_out'] == ['slow']
+            assert [hit.metadata['course_id'] for hit in hits] == ['a']
+        assert chroma_db_manager.searched.count('slow') == 1
+        assert threading.active_count() <= threads
+    finally:
+        release.set()
+    time.sleep(0.1)
+    hits, report = federated.search(['slow'], "what is a gradient?", budget=0.5)
+    assert report['timed_out'] == [] and [hit.metadata['course_id'] for hit in hits] == ['slow']
+    assert federated.search_stats()['timed_out'] == 6
+
+
+def test_courses_not_started_before_the_timeout_are_dropped():
+    release = threading.Event()
+    chroma_db_manager = FakeChromaDBManager({'slow': [0.9], 'queued': [0.9]}, {'slow': release})
+    federated = _search(chroma_db_manager, concurrency=1)
+    try:
+        hits, report = federated.search(['slow', 'queued'], "what is a gradient?", budget=0.3)
+        assert report['timed_out'] == ['queued', 'slow']
+    finally:
+        release.set()
+    time.sleep(0.1)
+    assert 'queued' not in chroma_db_manager.searched
+    # Neither is left busy
+    hits, report = federated.search(['slow', 'queued'], "what is a gradient?", budget=0.5)
+    assert report['timed_out'] == [] and len(hits) == 2
+
+
+def test_failed_courses_are_reported():
+    chroma_db_manager = FakeChromaDBManager({'a': [0.9]})
+    chroma_db_manager.delays['b'] = 'not a delay'
+    hits, report = _search(chroma_db_manager).search(['a', 'b'], "what is a gradient?")
+    assert [hit.metadata['course_id'] for hit in hits] == ['a']
+    assert list(report['failed']) == ['b']
+
+
+def test_search_enrolled_searches_the_courses_of_the_student():
+    chroma_db_manager = FakeChromaDBManager({'a': [0.9], 'c': [0.6]})
+    hits, report = _search(chroma_db_manager).search_enrolled('student', "what is a gradient?", k=5)
+    assert report['searched'] == ['a', 'b', 'c']
+    assert [hit.metadata['course_id'] for hit in hits] == ['a', 'c']
+    hits, report = _search(chroma_db_manager).search_enrolled('nobody', "what is a gradient?")
+    assert hits == [] and report['searched'] == []
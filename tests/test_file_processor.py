@@ -0,0 +1,18 @@
+import pytest
+
+pytest.importorskip("easyocr")
+pytest.importorskip("fitz")
+
+from utils.file_processor import clean_extracted_text
+from utils.text_normalizer import BoilerplateFilter
+
+
+def test_flat_text_keeps_repeated_lines():
+    lines = ["Example", "x = 1", "Solution:", "x = 2", "Example", "y = 1", "Solution:", "y = 2", "Example", "Solution:"]
+    assert clean_extracted_text(lines, stopwords=[]) == lines
+
+
+def test_page_boilerplate_and_stopwords_are_removed():
+    slides = [f"Purdue University\nLecture 3\nSlide body {slide} about convolutions and pooling" for slide in range(6)]
+    cleaned = clean_extracted_text(slides, boilerplate=BoilerplateFilter.from_pages(slides))
+    assert cleaned == [f"Slide body {slide} about convolutions and pooling" for slide in range(6)]
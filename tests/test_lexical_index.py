@@ -0,0 +1,52 @@
+from langchain_core.documents import Document
+
+from data.lexical_index import BM25Index, query_terms, reciprocal_rank_fusion, tokenize
+
+
+def test_tokenize_keeps_dotted_names_and_their_parts():
+    assert tokenize("Use np.linalg.norm on the Vectors") == \
+        ['use', 'np.linalg.norm', 'np', 'linalg', 'norm', 'on', 'the', 'vector']
+    assert query_terms("What is the k-means loss?") == ['k-means', 'k', 'mean', 'loss']
+
+
+def course_index():
+    index = BM25Index()
+    index.add_document('hw', ["Homework 3 is due Friday", "Homework 3 covers k-means clustering"])
+    index.add_document('notes', ["Gradient descent minimizes the loss", "The loss of k-means is the inertia"])
+    return index
+
+
+def test_bm25_ranks_chunks_with_rare_terms_first():
+    index = course_index()
+    results = index.search(query_terms("k-means inertia"), 3)
+    assert index.chunks[results[0][0]] == ('notes', "The loss of k-means is the inertia")
+    # Coverage is the share of the query terms a chunk contains
+    assert results[0][2] == 1.0
+    assert [score for _, score, _ in results] == sorted((score for _, score, _ in results), reverse=True)
+
+
+def test_bm25_document_filter_and_removal():
+    index = course_index()
+    results = index.search(query_terms("k-means"), 5, document_ids={'hw'})
+    assert {index.chunks[row][0] for row, _, _ in results} == {'hw'}
+    index.remove_document('hw')
+    assert index.search(query_terms("homework"), 5) == []
+    assert index.live_chunks == 2
+    # Re-adding a document replaces its chunks
+    index.add_document('notes', ["Backpropagation computes the gradient"])
+    assert index.live_chunks == 1
+    assert index.search(query_terms("loss"), 5) == []
+
+
+def test_reciprocal_rank_fusion_favours_hits_in_both_rankings():
+    def hit(document_id, text, **metadata):
+        return Document(page_content=text, metadata={'document_id': document_id, **metadata})
+
+    vector = [hit('a', "alpha", score=0.9), hit('b', "beta", score=0.8)]
+    lexical = [hit('b', "beta", bm25=3.0), hit('c', "gamma", bm25=1.0)]
+    fused = reciprocal_rank_fusion([vector, lexical])
+    assert [document.page_content for document in fused] == ["beta", "alpha", "gamma"]
+    assert fused[0].metadata['score'] == 0.8 and fused[0].metadata['bm25'] == 3.0
+    assert fused[0].metadata['rrf'] == 1 / 62 + 1 / 61
+    # The input Documents are left unchanged
+    assert 'rrf' not in vector[1].metadata
@@ -0,0 +1,120 @@
+import numpy as np
+from langchain_core.documents import Document
+
+from data.near_duplicates import CourseDuplicates, NearDuplicateIndex, collapse, signature, similarity
+
+LECTURE = ("Gradient descent moves the weights a small step against the gradient of the loss, "
+           "with a learning rate that controls the size of each step until the loss stops improving")
+
+
+def test_signature_of_identical_and_unrelated_texts():
+    assert np.array_equal(signature(LECTURE), signature(LECTURE.upper()))
+    assert similarity(signature(LECTURE), signature(LECTURE)) == 1.0
+    unrelated = signature("Binary search trees keep their keys ordered so lookups take logarithmic time")
+    assert similarity(signature(LECTURE), unrelated) < 0.1
+    assert signature("...") is None
+
+
+def test_similarity_estimates_the_jaccard_similarity_of_shingles():
+    revised = LECTURE.replace("until the loss stops improving", "until the loss stops going down")
+    words = LECTURE.lower().split()
+    revised_words = revised.lower().split()
+    shingles = {" ".join(words[i:i + 3]) for i in range(len(words) - 2)}
+    revised_shingles = {" ".join(revised_words[i:i + 3]) for i in range(len(revised_words) - 2)}
+    jaccard = len(shingles & revised_shingles) / len(shingles | revised_shingles)
+    assert abs(similarity(signature(LECTURE), signature(revised)) - jaccard) < 0.15
+
+
+def test_collapse_keeps_the_best_of_near_duplicates():
+    hits = [Document(page_content=LECTURE, metadata={'document_id': 'v2'}),
+            Document(page_content="Binary search trees keep their keys ordered", metadata={'document_id': 'b'}),
+            Document(page_content=LECTURE + " ", metadata={'document_id': 'v1'})]
+    assert [hit.metadata['document_id'] for hit in collapse(hits)] == ['v2', 'b']
+
+
+def test_lsh_finds_and_forgets_chunks():
+    course = CourseDuplicates()
+    course.add('c1', 'd1', signature(LECTURE))
+    course.add('c2', 'd2', signature(LECTURE))
+    course.add('c3', 'd2', signature("Binary search trees keep their keys ordered so lookups take logarithmic time"))
+    # Chunks of the same document come first
+    assert course.find(signature(LECTURE), 'd2') == 'c2'
+    assert course.find(signature("Hash maps trade memory for constant time lookups of their keys"), 'd1') is None
+    course.remove_document('d2')
+    assert course.find(signature(LECTURE), 'd2') == 'c1'
+    assert set(course.chunks) == {'c1'} and set(course.documents) == {'d1'}
+    course.remove('c1')
+    assert course.chunks == {} and course.buckets == {} and course.documents == {}
+
+
+class FakeCollection:
+    def __init__(self):
+        self.records = {}
+        self.reads = []
+
+    def get(self, ids=None, where=None, include=None):
+        self.reads.append({'ids': ids, 'where': where})
+        matches = [chunk_id for chunk_id, (_, metadata) in self.records.items()
+                   if (ids is None or chunk_id in ids)
+                   and (where is None or metadata['document_id'] == where['document_id'])]
+        return {'ids': matches, 'documents': [self.records[chunk_id][0] for chunk_id in matches],
+                'metadatas': [self.records[chunk_id][1] for chunk_id in matches]}
+
+
+class FakeVectorStores:
+    def __init__(self):
+        self.log = [('v0', set())]
+
+    def version(self, course_id):
+        return self.log[-1][0]
+
+    def mark_changed(self, document_ids=None):
+        self.log.append((f"v{len(self.log)}", document_ids))
+
+    def changed_documents(self, course_id, since, until):
+        versions = [version for version, _ in self.log]
+        changes = [documents for _, documents in self.log[versions.index(since) + 1:versions.index(until) + 1]]
+        return None if None in changes else set().union(*changes)
+
+
+class FakeManager:
+    def __init__(self):
+        self.collection = FakeCollection()
+        self.vector_stores = FakeVectorStores()
+        self._ids = iter(range(1000))
+
+    def get_course_db(self, course_id):
+        return type('Store', (), {'_collection': self.collection})
+
+    def new_chunk_id(self):
+        return f"new{next(self._ids)}"
+
+
+def test_sync_reads_only_the_changed_documents():
+    manager = FakeManager()
+    manager.collection.records = {'a1': (LECTURE, {'document_id': 'a'}),
+                                  'b1': ("Binary search trees keep their keys ordered", {'document_id': 'b'})}
+    index = NearDuplicateIndex(manager)
+    # First use loads the whole course
+    _, metadatas, _, dropped = index.deduplicate('c', 'new', [LECTURE], [{'document_id': 'new'}])
+    assert metadatas[0]['duplicate_of'] == 'a1' and dropped == 0
+
+    # Another process deletes document a and ingests document c
+    del manager.collection.records['a1']
+    manager.collection.records['c1'] = ("Hash maps trade memory for constant time lookups", {'document_id': 'c'})
+    manager.vector_stores.mark_changed({'a', 'c'})
+    manager.collection.reads.clear()
+    _, metadatas, _, _ = index.deduplicate('c', 'other', ["Hash maps trade memory for constant time lookups"],
+                                           [{'document_id': 'other'}])
+    assert metadatas[0]['duplicate_of'] == 'c1'
+    assert all(read['where'] is not None or read['ids'] == ['c1'] for read in manager.collection.reads)
+    assert not any(read['where'] == {'document_id': 'b'} for read in manager.collection.reads)
+    # The chunks registered by this process but not written yet are kept
+    course = index._course('c')
+    assert 'a1' not in course.chunks and {'b1', 'c1'} <= set(course.chunks) and len(course.pending) == 2
+
+    # Unknown changes load the whole course again
+    manager.vector_stores.mark_changed(None)
+    manager.collection.reads.clear()
+    index.deduplicate('c', 'third', ["Nothing like the others at all here"], [{'document_id': 'third'}])
+    assert manager.collection.reads[0] == {'ids': None, 'where': None}
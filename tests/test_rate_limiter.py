@@ -0,0 +1,62 @@
+import pytest
+
+import utils.rate_limiter as rate_limiter
+from utils.rate_limiter import RateLimiter, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter, 'time', clock)
+    return clock
+
+
+@pytest.mark.parametrize('rate', [0, -1])
+def test_non_positive_rates_are_rejected(rate):
+    with pytest.raises(ValueError):
+        TokenBucket(rate)
+    with pytest.raises(ValueError):
+        RateLimiter(rate * 60, 1000)
+
+
+def test_non_positive_capacity_is_rejected():
+    with pytest.raises(ValueError):
+        TokenBucket(1, capacity=-1)
+
+
+def test_full_bucket_does_not_wait(clock):
+    bucket = TokenBucket(10, capacity=5)
+    for _ in range(5):
+        bucket.acquire()
+    assert clock.slept == []
+
+
+def test_empty_bucket_waits_for_the_refill(clock):
+    bucket = TokenBucket(10, capacity=5)
+    bucket.acquire(5)
+    bucket.acquire(2)
+    assert clock.slept == [pytest.approx(0.2)]
+    assert bucket.tokens == pytest.approx(0)
+
+
+def test_requests_larger_than_the_capacity_go_through_in_debt(clock):
+    bucket = TokenBucket(10, capacity=5)
+    bucket.acquire(15)
+    assert clock.slept == []
+    assert bucket.tokens == pytest.approx(-10)
+    # The debt is paid back before the next request
+    bucket.acquire(1)
+    assert sum(clock.slept) == pytest.approx(1.1)
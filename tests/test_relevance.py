@@ -0,0 +1,93 @@
+import math
+
+import pytest
+
+pytest.importorskip('langchain_openai')
+chromadb = pytest.importorskip('chromadb')
+from langchain_chroma import Chroma
+from langchain_core.embeddings import Embeddings
+
+import data.embedding_handler as embedding_handler
+from data.embedding_handler import ChromaDBManager, similarity
+from data.query_cache import QueryCache
+
+
+def unit(cosine):
+    """Unit vector at the given cosine similarity to (1, 0, 0)."""
+    return [cosine, math.sqrt(1 - cosine ** 2), 0.0]
+
+
+class FakeEmbeddings(Embeddings):
+    """ada-002 embeddings of a course about gradient descent, at known similarities."""
+
+    model = 'text-embedding-ada-002'
+    vectors = {
+        'gradient descent updates the weights against the gradient': unit(1.0),
+        'how does gradient descent update the weights?': unit(0.86),
+        'what is the capital of france?': unit(0.72),
+    }
+
+    def embed_documents(self, texts):
+        return [self.vectors[text] for text in texts]
+
+    def embed_query(self, text):
+        return self.vectors[text]
+
+
+class FakeVectorStores:
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, course_id):
+        return self.store
+
+    def version(self, course_id):
+        return f"{id(self.store)}"
+
+    def backend_of(self, course_id):
+        return 'openai:text-embedding-ada-002'
+
+
+@pytest.fixture(params=[None, 'cosine'])
+def manager(request, monkeypatch):
+    metadata = {'hnsw:space': request.param} if request.param else None
+    store = Chroma(client=chromadb.EphemeralClient(), collection_name=f"course_relevance_{request.param}",
+                   embedding_function=FakeEmbeddings(), collection_metadata=metadata)
+    store.add_texts(['gradient descent updates the weights against the gradient'], metadatas=[{'document_id': 'd1'}])
+    monkeypatch.setattr(embedding_handler, 'get_embedding_backend', lambda backend=None: FakeEmbeddings())
+    monkeypatch.setattr(embedding_handler, 'RELEVANCE_THRESHOLD', None)
+    monkeypatch.setattr(embedding_handler, 'get_vector_stores', lambda: FakeVectorStores(store))
+    monkeypatch.setattr(embedding_handler, 'get_vector_index', lambda: None)
+    monkeypatch.setattr(embedding_handler, 'get_query_cache', QueryCache)
+    manager = ChromaDBManager()
+    manager.lexical_index = None
+    manager.document_router = None
+    yield manager
+    store.delete_collection()
+
+
+def test_scores_are_cosine_similarities(manager):
+    hits = manager.scored_search('c1', 'how does gradient descent update the weights?', 1)
+    assert hits[0].metadata['score'] == pytest.approx(0.86, abs=1e-4)
+
+
+def test_related_decision_of_ada_002(manager):
+    assert manager.relevance_threshold('c1') == 0.78
+    assert manager.is_question_related('how does gradient descent update the weights?', 'c1')
+    assert not manager.is_question_related('what is the capital of france?', 'c1')
+
+
+def test_l2_distances_are_squared():
+    # Unit vectors at cosine 0.6: squared L2 distance 0.8, cosine distance 0.4
+    assert similarity(0.8, 'l2') == pytest.approx(0.6)
+    assert similarity(0.4, 'cosine') == pytest.approx(0.6)
+
+
+
+def test_queries_are_embedded_as_written(manager, monkeypatch):
+    embedded = []
+    monkeypatch.setattr(FakeEmbeddings, 'embed_query', lambda self, text: embedded.append(text) or unit(0.9))
+    manager.embed_query('c1', 'What does  Adam add to SGD?')
+    # Case and spacing variants share the cached embedding
+    manager.embed_query('c1', 'what does adam add to sgd?')
+    assert embedded == ['What does  Adam add to SGD?']
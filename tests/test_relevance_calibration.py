@@ -0,0 +1,13 @@
+import pytest
+
+from service.relevance_calibration import best_threshold
+
+
+def test_best_threshold_separates_the_labels():
+    samples = [(0.9, True), (0.84, True), (0.8, True), (0.76, False), (0.72, False), (0.7, False)]
+    assert best_threshold(samples) == (0.78, 1.0)
+    # An outlier costs accuracy but does not move the threshold below the unrelated bulk
+    threshold, accuracy = best_threshold(samples + [(0.71, True)])
+    assert threshold == 0.78 and accuracy == pytest.approx(0.875)
+    with pytest.raises(ValueError):
+        best_threshold([(0.9, True)])
@@ -0,0 +1,35 @@
+from utils.text_normalizer import BoilerplateFilter, split_pages
+
+
+def lecture_pages(count=10):
+    return [[f"CS 590 Deep Learning\nTopic {page} covers the chain rule\nExample\nSlide {page + 1}"]
+            for page in range(count)]
+
+
+def test_repeated_lines_of_pages_are_boilerplate():
+    boilerplate = BoilerplateFilter.from_pages(lecture_pages())
+    assert boilerplate.is_boilerplate("CS 590 Deep Learning")
+    # Short lines match whatever their numbers
+    assert boilerplate.is_boilerplate("Slide 42")
+    assert not boilerplate.is_boilerplate("Topic 3 covers the chain rule")
+    assert boilerplate.strip("CS 590 Deep Learning\nTopic 3 covers the chain rule\nSlide 4") == "Topic 3 covers the chain rule"
+    assert boilerplate.removed_lines == 2
+
+
+def test_short_documents_are_left_alone():
+    boilerplate = BoilerplateFilter.from_pages(lecture_pages(4))
+    assert not boilerplate.is_boilerplate("CS 590 Deep Learning")
+    assert boilerplate.strip("CS 590 Deep Learning") == "CS 590 Deep Learning"
+
+
+def test_lines_below_the_share_of_pages_are_kept():
+    pages = [f"Header\nBody {page}" if page < 3 else f"Body {page}" for page in range(10)]
+    boilerplate = BoilerplateFilter.from_pages(pages)
+    assert not boilerplate.is_boilerplate("Header")
+
+
+def test_split_pages():
+    lines = ["a", "b", "c"]
+    assert split_pages(lines, [[1, 2], [3, 1]]) == [(1, ["a", "b"]), (3, ["c"])]
+    assert split_pages(lines) == [(None, lines)]
+    assert split_pages([]) == []
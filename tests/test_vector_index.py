@@ -0,0 +1,83 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from data.vector_index import QuantizedVectorIndex
+
+
+def course_vectors(count=2000, dimensions=64, documents=20, seed=0):
+    rng = np.random.default_rng(seed)
+    embeddings = rng.normal(size=(count, dimensions)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    texts = [f"chunk {row}" for row in range(count)]
+    metadatas = [{'document_id': f"doc{row % documents}"} for row in range(count)]
+    return texts, embeddings, metadatas
+
+
+def exact_top(embeddings, query, k, rows=None):
+    rows = np.arange(len(embeddings)) if rows is None else np.asarray(rows)
+    scores = embeddings[rows] @ (query / np.linalg.norm(query))
+    return set(rows[np.argsort(-scores)[:k]].tolist())
+
+
+@pytest.mark.parametrize('dtype', ['int8', 'float16'])
+def test_recall_against_exact_search(tmp_path, dtype):
+    texts, embeddings, metadatas = course_vectors()
+    index = QuantizedVectorIndex(path=str(tmp_path), dtype=dtype)
+    generation = index.get('c1', 'v1', lambda: (texts, embeddings, metadatas))
+    queries = np.random.default_rng(1).normal(size=(50, embeddings.shape[1])).astype(np.float32)
+
+    found = 0
+    for query in queries:
+        hits = index.search(generation, query, 10)
+        assert [score for _, _, score in hits] == sorted((score for _, _, score in hits), reverse=True)
+        found += len(exact_top(embeddings, query, 10) & {int(text.split()[1]) for text, _, _ in hits})
+    assert found / (10 * len(queries)) >= 0.9
+
+
+def test_document_filter(tmp_path):
+    texts, embeddings, metadatas = course_vectors()
+    index = QuantizedVectorIndex(path=str(tmp_path))
+    generation = index.get('c1', 'v1', lambda: (texts, embeddings, metadatas))
+    hits = index.search(generation, embeddings[3], 5, document_ids={'doc3', 'unknown'})
+    assert hits[0][0] == 'chunk 3'
+    assert {document_id for _, document_id, _ in hits} == {'doc3'}
+    assert index.search(generation, embeddings[3], 5, document_ids={'unknown'}) == []
+
+
+def test_empty_index(tmp_path):
+    index = QuantizedVectorIndex(path=str(tmp_path))
+    generation = index.get('c1', 'v1', lambda: ([], [], []))
+    assert generation.version == 'v1'
+    assert index.search(generation, np.ones(8, dtype=np.float32), 5) == []
+    assert index.search(generation, np.ones(8, dtype=np.float32), 5, document_ids={'doc1'}) == []
+
+
+def test_previous_generation_is_served_while_rebuilding(tmp_path):
+    texts, embeddings, metadatas = course_vectors(count=100)
+    index = QuantizedVectorIndex(path=str(tmp_path))
+    index.get('c1', 'v1', lambda: (texts[:50], embeddings[:50], metadatas[:50]))
+
+    loading = threading.Event()
+    release = threading.Event()
+
+    def load_vectors():
+        loading.set()
+        release.wait(10)
+        return texts, embeddings, metadatas
+
+    stale = index.get('c1', 'v2', load_vectors)
+    assert stale.version == 'v1' and len(stale.vectors) == 50
+    assert loading.wait(10)
+    # Further searches neither wait for the build nor start another one
+    assert index.get('c1', 'v2', load_vectors) is stale
+    release.set()
+    for _ in range(100):
+        if not index.index_stats()['building']:
+            break
+        time.sleep(0.05)
+    fresh = index.get('c1', 'v2', load_vectors)
+    assert fresh.version == 'v2' and len(fresh.vectors) == 100
+    assert index.stats['builds'] == 2
@@ -0,0 +1,39 @@
+import pytest
+
+pytest.importorskip('langchain_openai')
+
+import data.vector_store as vector_store
+from data.vector_store import CourseVectorStores
+
+
+@pytest.fixture
+def vector_stores(tmp_path):
+    return CourseVectorStores(path=str(tmp_path / 'shared'), base_dir=str(tmp_path),
+                              versions_dir=str(tmp_path / 'versions'))
+
+
+def test_changed_documents_between_versions(vector_stores):
+    assert vector_stores.version('c') == ''
+    vector_stores.mark_changed('c', document_ids=['a'])
+    first = vector_stores.version('c')
+    vector_stores.mark_changed('c', document_ids=['b'])
+    vector_stores.mark_changed('c', document_ids=['c', 'b'])
+    last = vector_stores.version('c')
+    assert vector_stores.changed_documents('c', first, last) == {'b', 'c'}
+    # Never logged, or a change of the whole index
+    assert vector_stores.changed_documents('c', '', last) is None
+    vector_stores.mark_changed('c')
+    assert vector_stores.changed_documents('c', first, vector_stores.version('c')) is None
+    assert vector_stores.changed_documents('other', first, last) is None
+
+
+def test_changelog_is_cut_once_too_large(vector_stores, monkeypatch):
+    monkeypatch.setattr(vector_store, 'CHROMA_CHANGELOG_BYTES', 2000)
+    for number in range(100):
+        vector_stores.mark_changed('c', document_ids=[f"document{number}"])
+        if number == 10:
+            old = vector_stores.version('c')
+        if number == 98:
+            recent = vector_stores.version('c')
+    assert vector_stores.changed_documents('c', old, vector_stores.version('c')) is None
+    assert vector_stores.changed_documents('c', recent, vector_stores.version('c')) == {'document99'}
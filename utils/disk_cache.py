@@ -0,0 +1,101 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class DiskCache:
+    """
+    Key/value store in a local SQLite file, bounded by the total size of the
+    stored values. Least recently used entries are evicted first.
+    """
+
+    def __init__(self, path, max_bytes):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)")
+        self.conn.commit()
+
+    def get_many(self, keys):
+        """Returns {key: value} for the keys present in the cache and counts hits/misses."""
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            # Stay well below SQLite's limit on host parameters
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.conn.execute(
+                    f"SELECT key, value FROM cache WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                found.update(rows)
+                if rows:
+                    self.conn.execute(
+                        f"UPDATE cache SET last_access = ? WHERE key IN ({','.join('?' * len(rows))})",
+                        [time.time()] + [key for key, _ in rows]
+                    )
+            self.conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def get(self, key):
+        """Returns the value stored under key, or None."""
+        return self.get_many([key]).get(key)
+
+    def set_many(self, items):
+        """Stores {key: value} and evicts old entries if the cache grew past max_bytes."""
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                [(key, value, len(value), now) for key, value in items.items()]
+            )
+            self._evict()
+            self.conn.commit()
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def _evict(self):
+        """Drops least recently used entries until the cache is back under 90% of max_bytes."""
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = self.max_bytes * 0.9
+        evicted = 0
+        for key, size in self.conn.execute("SELECT key, size FROM cache ORDER BY last_access").fetchall():
+            if total <= target:
+                break
+            self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+        print(f"Evicted {evicted} entries from {os.path.basename(self.path)}.")
+
+    def stats(self):
+        """Returns hit/miss counters of this process and the current size of the cache."""
+        with self._lock:
+            entries, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+            'bytes': size,
+            'max_bytes': self.max_bytes
+        }
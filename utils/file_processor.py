@@ -1,4 +1,5 @@
-import re
+import os
+import hashlib
 import fitz  # PyMuPDF for PDF processing
 from pdf2image import convert_from_bytes
 from PIL import Image
@@ -9,134 +10,682 @@ import numpy as np
 import ssl
 from pptx import Presentation
 from docx import Document
-from multiprocessing import Pool, cpu_count
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from multiprocessing import get_context, cpu_count
+import atexit
+import tempfile
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from utils.disk_cache import DiskCache
+from utils.text_normalizer import BoilerplateFilter, DEFAULT_STOPWORDS, compile_stopwords
 
 # Create an unverified SSL context
 ssl._create_default_https_context = ssl._create_unverified_context
 
-# Initialize EasyOCR reader (English as the language)
-reader = easyocr.Reader(['en'], gpu=True)
-
-
-def extract_text_and_images(file):
+# Number of worker processes of the extraction pool shared by all documents (1 keeps extraction serial)
+EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', max(cpu_count() - 1, 1)))
+# Number of pages/slides read and OCR'd together while streaming a document
+EXTRACTION_WINDOW = int(os.getenv('EXTRACTION_WINDOW', 32))
+# Number of distinct images handed to one OCR task
+OCR_BATCH_SIZE = int(os.getenv('OCR_BATCH_SIZE', 16))
+# 'spawn' avoids forking a process that already runs torch and Streamlit threads
+EXTRACTION_START_METHOD = os.getenv('EXTRACTION_START_METHOD', 'spawn')
+
+# Languages of the EasyOCR reader, also part of every OCR cache key
+OCR_LANGUAGES = ['en']
+# Run EasyOCR on the GPU when one is present. OCR then stays in this process,
+# which holds the only copy of the model, and only page reading uses the pool
+OCR_GPU = os.getenv('OCR_GPU', 'true').lower() == 'true'
+# On-disk cache of OCR results keyed by image content hash (0 disables it)
+OCR_CACHE_PATH = os.getenv('OCR_CACHE_PATH', os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..', 'data', 'ocr_cache', 'ocr_cache.sqlite3')))
+OCR_CACHE_MAX_MB = int(os.getenv('OCR_CACHE_MAX_MB', 256))
+
+# Pre-OCR admission filter: icons below OCR_MIN_PIXELS (width * height) and
+# images the text probe finds empty are skipped, images with a side longer
+# than OCR_MAX_SIDE are downscaled
+OCR_MIN_PIXELS = int(os.getenv('OCR_MIN_PIXELS', 48 * 48))
+OCR_MAX_SIDE = int(os.getenv('OCR_MAX_SIDE', 2048))
+OCR_GRAYSCALE = os.getenv('OCR_GRAYSCALE', 'true').lower() == 'true'
+OCR_TEXT_PROBE = os.getenv('OCR_TEXT_PROBE', 'true').lower() == 'true'
+OCR_MIN_EDGE_DENSITY = float(os.getenv('OCR_MIN_EDGE_DENSITY', 0.004))
+OCR_MIN_CONTRAST = 8
+OCR_PROBE_SIDE = 1024
+
+# Scanned-PDF fallback: pages without a text layer or readable images are
+# rendered at OCR_RASTER_DPI, OCR_RASTER_WINDOW pages at a time
+OCR_SCANNED_PAGES = os.getenv('OCR_SCANNED_PAGES', 'true').lower() == 'true'
+OCR_RASTER_DPI = int(os.getenv('OCR_RASTER_DPI', 200))
+OCR_RASTER_WINDOW = int(os.getenv('OCR_RASTER_WINDOW', 8))
+
+# Per-document image counts reported by ocr_images
+OCR_COUNTERS = ['images', 'cached', 'ocr', 'downscaled', 'skipped_small', 'skipped_no_text', 'skipped_invalid']
+
+# EasyOCR reader of this process, created on first use, so that workers and
+# documents that never OCR (text-only or fully cached) do not load the model
+reader = None
+# Whether OCR runs on the GPU, see _ocr_on_gpu
+_gpu_ocr = None
+ocr_cache = None
+_ocr_cache_lock = threading.Lock()
+
+# Extraction pool shared by all documents of this process, started on first use
+_extraction_pool = None
+_extraction_pool_failed = False
+_extraction_pool_lock = threading.Lock()
+
+# Spooled document opened by this process for extraction tasks, as (path, document)
+_task_document = (None, None)
+
+
+def get_reader():
+    """Returns the EasyOCR reader of the current process."""
+    global reader
+    if reader is None:
+        reader = easyocr.Reader(OCR_LANGUAGES, gpu=_ocr_on_gpu())
+    return reader
+
+
+def _ocr_on_gpu():
+    """Whether OCR runs on the GPU: OCR_GPU is set and CUDA is available."""
+    global _gpu_ocr
+    if _gpu_ocr is None:
+        try:
+            import torch  # Installed with easyocr
+            _gpu_ocr = OCR_GPU and torch.cuda.is_available()
+        except ImportError:
+            _gpu_ocr = False
+    return _gpu_ocr
+
+
+def get_ocr_cache():
+    """Returns the shared OCR result cache, or None when it is disabled."""
+    global ocr_cache
+    with _ocr_cache_lock:
+        if ocr_cache is None and OCR_CACHE_MAX_MB > 0:
+            ocr_cache = DiskCache(OCR_CACHE_PATH, OCR_CACHE_MAX_MB * 1024 * 1024)
+    return ocr_cache
+
+
+def ocr_cache_stats():
+    """Returns the hit/miss counters and size of the OCR cache."""
+    cache = get_ocr_cache()
+    return cache.stats() if cache else {}
+
+
+def extract_text_and_images(file, workers=None, stats=None):
     file_type = file.type  # Updated: Get type from the UploadedFile object
     try:
         file_content = file.read()
         if file_type == "application/pdf":
-            return extract_text_from_pdf(file_content)
+            return extract_text_from_pdf(file_content, workers=workers, stats=stats)
         elif file_type == "application/vnd.openxmlformats-officedocument.presentationml.presentation":
-            return extract_text_from_ppt(file_content)
+            return extract_text_from_ppt(file_content, workers=workers, stats=stats)
         elif file_type == "text/plain":
             return extract_text_from_text(file_content)
         elif file_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-            return extract_text_from_doc(file_content)
+            return extract_text_from_doc(file_content, workers=workers, stats=stats)
+    except Exception as e:
+        print(f"Error processing file: {e}")
+        raise RuntimeError(f"Failed to process file: {e}")
+
+
+def iter_text_and_images(file, workers=None, stats=None):
+    """
+    Streaming variant of extract_text_and_images.
+
+    Yields the raw (uncleaned) text of one page or slide at a time as a list of
+    strings. PDFs and PPTX files are read and OCR'd EXTRACTION_WINDOW pages at a
+    time; text and Word files are yielded as a single unit.
+    """
+    file_type = file.type
+    try:
+        file_content = file.read()
+        if file_type in ("text/plain", "application/vnd.openxmlformats-officedocument.wordprocessingml.document") \
+                and stats is not None:
+            stats['total_pages'] = 1
+        if file_type == "application/pdf":
+            yield from iter_pdf_pages(file_content, workers=workers, stats=stats)
+        elif file_type == "application/vnd.openxmlformats-officedocument.presentationml.presentation":
+            for slide_content in iter_ppt_slides(file_content, workers=workers, stats=stats):
+                yield [slide_content]
+        elif file_type == "text/plain":
+            yield extract_text_from_text(file_content)
+        elif file_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
+            yield extract_text_from_doc(file_content, workers=workers, stats=stats)
     except Exception as e:
         print(f"Error processing file: {e}")
         raise RuntimeError(f"Failed to process file: {e}")
 
 
-def extract_text_from_pdf(file):
+def _resolve_workers(workers, task_count):
+    """Returns how many processes to use for task_count OCR batches."""
+    if workers is None:
+        workers = EXTRACTION_WORKERS
+    return max(1, min(workers, task_count))
+
+
+def get_extraction_pool():
+    """
+    Returns the process pool of EXTRACTION_WORKERS workers shared by all
+    extractions of this process, starting it on first use. Returns None when
+    extraction is serial (EXTRACTION_WORKERS=1) or the pool cannot start.
+    """
+    global _extraction_pool, _extraction_pool_failed
+    if EXTRACTION_WORKERS <= 1:
+        return None
+    with _extraction_pool_lock:
+        if _extraction_pool is None and not _extraction_pool_failed:
+            try:
+                _extraction_pool = get_context(EXTRACTION_START_METHOD).Pool(processes=EXTRACTION_WORKERS)
+                atexit.register(_extraction_pool.terminate)
+            except Exception as e:
+                print(f"Parallel extraction failed, falling back to serial: {e}")
+                _extraction_pool_failed = True
+    return _extraction_pool
+
+
+def _pool_for(workers, task_count):
+    """The shared extraction pool for task_count tasks, or None to run them serially (workers=1)."""
+    if _resolve_workers(workers, task_count) <= 1:
+        return None
+    return get_extraction_pool()
+
+
+def _map_batches(batch_fn, batches, pool=None):
+    """
+    Runs batch_fn over every batch and returns the results in batch order.
+
+    Batches are spread over the pool when there is more than one of them.
+    Without a pool, or if the pool fails, they run serially in this process.
+    """
+    if pool is not None and len(batches) > 1:
+        try:
+            return pool.map(batch_fn, batches, chunksize=1)
+        except Exception as e:
+            print(f"Parallel extraction failed, falling back to serial: {e}")
+
+    return [batch_fn(batch) for batch in batches]
+
+
+def _slices(numbers, workers):
+    """Splits page/slide numbers into at most workers contiguous runs, in order."""
+    size = max(1, -(-len(numbers) // max(1, workers)))
+    return [numbers[start:start + size] for start in range(0, len(numbers), size)]
+
+
+@contextmanager
+def _spooled(file_content, suffix):
+    """Writes a document to a temporary file, which pool workers open by path."""
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+        f.write(file_content)
+    try:
+        yield f.name
+    finally:
+        os.remove(f.name)
+
+
+def _open_task_document(path, opener):
+    """Opens a spooled document once per process, for all the tasks of that document it runs."""
+    global _task_document
+    document = _task_document
+    if document[0] != path:
+        document = (path, opener(path))
+        _task_document = document
+    return document[1]
+
+
+def _image_key(image_bytes):
+    """Returns the content hash used to deduplicate images of a document."""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def _prepare_image(image_bytes, text_probe=True):
+    """
+    Decides whether an image is worth OCR and prepares it for EasyOCR.
+
+    Icons below OCR_MIN_PIXELS and images whose text probe finds no text are
+    skipped; the rest are converted to grayscale (OCR_GRAYSCALE) and downscaled
+    so that their longest side is at most OCR_MAX_SIDE.
+
+    Returns:
+        tuple: (numpy array or None, outcome) where outcome is one of 'ocr',
+        'downscaled', 'skipped_invalid', 'skipped_small' or 'skipped_no_text'.
+    """
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        image.load()
+    except Exception:
+        return None, 'skipped_invalid'
+
+    width, height = image.size
+    # Skip if the image dimensions are invalid
+    if width == 0 or height == 0:
+        return None, 'skipped_invalid'
+    if width * height < OCR_MIN_PIXELS:
+        return None, 'skipped_small'
+
+    gray = image.convert('L')
+    if text_probe and not _has_text_signal(gray):
+        return None, 'skipped_no_text'
+
+    outcome = 'ocr'
+    if OCR_GRAYSCALE:
+        image = gray
+    elif image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    if max(width, height) > OCR_MAX_SIDE:
+        image.thumbnail((OCR_MAX_SIDE, OCR_MAX_SIDE))
+        outcome = 'downscaled'
+    return np.array(image), outcome  # Convert to numpy array
+
+
+def _has_text_signal(gray):
+    """
+    Cheap text-density probe on a thumbnail: text needs some contrast and a
+    minimum share of sharp horizontal intensity changes (glyph edges).
+    """
+    probe = gray.copy()
+    probe.thumbnail((OCR_PROBE_SIDE, OCR_PROBE_SIDE))
+    pixels = np.asarray(probe, dtype=np.int16)
+    if pixels.shape[1] < 2 or pixels.std() < OCR_MIN_CONTRAST:
+        return False
+    edges = np.abs(np.diff(pixels, axis=1)) > 32
+    return edges.mean() >= OCR_MIN_EDGE_DENSITY
+
+
+def _ocr_cache_key(image_key, text_probe):
+    """Returns the OCR cache key of an image for the current OCR engine and settings."""
+    settings = f"{OCR_MIN_PIXELS}-{OCR_MAX_SIDE}-{int(OCR_GRAYSCALE)}-{int(text_probe)}-{OCR_MIN_EDGE_DENSITY}"
+    return f"easyocr:{'+'.join(OCR_LANGUAGES)}:{settings}:{image_key}"
+
+
+def ocr_images(images, workers=None, stats=None, pool=None, batch_size=None, text_probe=None):
+    """
+    Runs OCR once per distinct image of a document.
+
+    Images already in the OCR cache are not read again. Images rejected by
+    _prepare_image are cached with empty text so later uploads skip them too.
+
+    Args:
+        images (dict): Image bytes keyed by content hash, see _image_key.
+        workers (int): 1 runs OCR in this process, otherwise on the shared extraction pool.
+            OCR on the GPU always runs in this process.
+        stats (dict): Optional dict that receives the per-document image counts and 'ocr_seconds'.
+        pool: Process pool to use, the shared extraction pool by default.
+        batch_size (int): Number of images per OCR task, OCR_BATCH_SIZE by default.
+        text_probe (bool): Whether to skip images without text, OCR_TEXT_PROBE by default.
+
+    Returns:
+        dict: OCR text keyed by the same content hash.
+    """
+    started = time.perf_counter()
+    counts = dict.fromkeys(OCR_COUNTERS, 0)
+    counts['images'] = len(images)
+
+    if text_probe is None:
+        text_probe = OCR_TEXT_PROBE
+    cache_keys = {key: _ocr_cache_key(key, text_probe) for key in images}
+
+    ocr_text = {}
+    cache = get_ocr_cache()
+    if cache:
+        cached = cache.get_many(cache_keys.values())
+        for key in images:
+            if cache_keys[key] in cached:
+                ocr_text[key] = cached[cache_keys[key]].decode('utf-8')
+        counts['cached'] = len(ocr_text)
+
+    keys = [key for key in images if key not in ocr_text]
+    batch_size = batch_size or OCR_BATCH_SIZE
+    batches = [
+        [(key, images[key]) for key in keys[start:start + batch_size]]
+        for start in range(0, len(keys), batch_size)
+    ]
+    if _ocr_on_gpu():
+        # Batches queue up on the one GPU model of this process instead of loading it in every worker
+        pool = None
+    elif pool is None:
+        pool = _pool_for(workers, len(batches))
+    batch_results = _map_batches(partial(_ocr_batch, text_probe=text_probe), batches, pool)
+
+    new_text = {}
+    for batch_text, batch_counts in batch_results:
+        new_text.update(batch_text)
+        for name, count in batch_counts.items():
+            counts[name] += count
+
+    if cache:
+        cache.set_many({cache_keys[key]: text.encode('utf-8') for key, text in new_text.items()})
+    ocr_text.update(new_text)
+
+    if images:
+        print("OCR: " + ", ".join(f"{count} {name}" for name, count in counts.items()) + ".")
+    if stats is not None:
+        for name, count in counts.items():
+            stats[name] = stats.get(name, 0) + count
+        stats['ocr_seconds'] = stats.get('ocr_seconds', 0.0) + time.perf_counter() - started
+    return ocr_text
+
+
+def _ocr_batch(batch, text_probe=True):
+    """
+    OCRs a list of (key, image_bytes), reading same-sized images in one
+    EasyOCR call. Returns the OCR text by key and the admission counts.
+    """
+    counts = {}
+    arrays = {}
+    ocr_text = {}
+    for key, image_bytes in batch:
+        image_np, outcome = _prepare_image(image_bytes, text_probe)
+        counts[outcome] = counts.get(outcome, 0) + 1
+        if outcome == 'downscaled':
+            counts['ocr'] = counts.get('ocr', 0) + 1
+        if image_np is None:
+            if outcome != 'skipped_invalid':
+                ocr_text[key] = ""
+            continue
+        arrays[key] = image_np
+
+    keys_by_shape = {}
+    for key, image_np in arrays.items():
+        keys_by_shape.setdefault(image_np.shape, []).append(key)
+
+    for shape_keys in keys_by_shape.values():
+        shape_images = [arrays[key] for key in shape_keys]
+        try:
+            if len(shape_images) == 1:
+                ocr_results = [get_reader().readtext(shape_images[0])]
+            else:
+                ocr_results = get_reader().readtext_batched(shape_images, batch_size=len(shape_images))
+        except Exception as e:
+            # Skip these images if any error occurs during OCR
+            print(f"Error running OCR on a batch of {len(shape_images)} images: {e}")
+            continue
+
+        for key, results in zip(shape_keys, ocr_results):
+            ocr_text[key] = "\n".join([res[1] for res in results])
+    return ocr_text, counts
+
+
+def extract_text_from_pdf(file, workers=None, stats=None):
     """Extracts text and images from an uploaded PDF using EasyOCR."""
-    text_content = []
+    pages = list(iter_pdf_pages(file, workers, stats))
+    boilerplate = BoilerplateFilter.from_pages(pages)
+
+    text_content = [text for page_content in pages for text in page_content]
+    text_content = clean_extracted_text(text_content, boilerplate=boilerplate)
+    return text_content
+
 
+def iter_pdf_pages(file, workers=None, stats=None):
+    """
+    Yields the text layer and image OCR text of each PDF page, in page order.
+
+    Pages are read EXTRACTION_WINDOW at a time: the text layers and images of
+    a window are read on the extraction pool, one run of pages per worker,
+    then its images are OCR'd together (each distinct image once per
+    document) and only that window's image bytes are held in memory. Pages
+    left without any text after that are rasterized and OCR'd as a whole
+    (scanned PDFs), see ocr_scanned_pages.
+    """
+    ocr_text = {}
+    xref_keys = {}
+    pool = _pool_for(workers, EXTRACTION_WINDOW)
     # Open the PDF from the uploaded file-like object
-    with fitz.open(stream=file, filetype="pdf") as pdf:
-        for page_num in range(pdf.page_count):
-            page = pdf.load_page(page_num)
+    with fitz.open(stream=file, filetype="pdf") as pdf, \
+            (_spooled(file, '.pdf') if pool is not None else nullcontext()) as path:
+        if stats is not None:
+            stats['total_pages'] = pdf.page_count
+        for start in range(0, pdf.page_count, EXTRACTION_WINDOW):
+            page_nums = list(range(start, min(start + EXTRACTION_WINDOW, pdf.page_count)))
+            if path is None:
+                pages, images = _collect_pdf(pdf, page_nums, xref_keys)
+            else:
+                pages, images = _collect_parallel(_collect_pdf_task, path, page_nums, xref_keys, pool, workers)
+            new_images = {key: image for key, image in images.items() if key not in ocr_text}
+            ocr_text.update(ocr_images(new_images, workers, stats, pool=pool))
+            del images, new_images
+
+            scanned_text = {}
+            if OCR_SCANNED_PAGES:
+                textless_pages = [
+                    page_num for page_num, (text, image_keys) in zip(page_nums, pages)
+                    if not text.strip() and not any(ocr_text.get(key, "").strip() for key in image_keys)
+                ]
+                scanned_text = ocr_scanned_pages(file, textless_pages, workers, stats, pool=pool)
+
+            for page_num, (text, image_keys) in zip(page_nums, pages):
+                page_content = [text]
+                page_content.extend(ocr_text[key] for key in image_keys if key in ocr_text)
+                if page_num in scanned_text:
+                    page_content.append(scanned_text[page_num])
+                yield page_content
+
+
+def ocr_scanned_pages(file, page_nums, workers=None, stats=None, pool=None):
+    """
+    Rasterizes the given PDF pages and OCRs them on the extraction pool.
 
-            # Extract text from the PDF page
-            text = page.get_text()
-            text_content.append(text)
+    Only OCR_RASTER_WINDOW consecutive pages are rendered at a time, so memory
+    stays bounded by the window instead of the whole document.
 
-            # Extract images from the PDF page
-            for img_index, img in enumerate(page.get_images(full=True)):
-                xref = img[0]
-                base_image = pdf.extract_image(xref)
-                image_bytes = base_image.get("image")
+    Args:
+        file (bytes): The PDF content.
+        page_nums (list): 0-based numbers of the pages to rasterize.
+        workers (int): 1 runs OCR in this process, otherwise on the shared extraction pool.
+        stats (dict): Optional dict that receives the image counts and 'rasterized_pages'.
+        pool: Process pool to use, the shared extraction pool by default.
 
-                # Skip if image data is missing or corrupted
-                if not image_bytes:
-                    continue
+    Returns:
+        dict: OCR text keyed by page number.
+    """
+    if not page_nums:
+        return {}
+
+    windows = _page_windows(page_nums, OCR_RASTER_WINDOW)
+    print(f"Rasterizing {len(page_nums)} pages without text in {len(windows)} windows.")
+    page_text = {}
+    if pool is None:
+        pool = _pool_for(workers, min(len(page_nums), OCR_RASTER_WINDOW))
+    batch_size = max(1, -(-OCR_RASTER_WINDOW // _resolve_workers(workers, OCR_RASTER_WINDOW)))
+    for window in windows:
+        try:
+            rendered = convert_from_bytes(
+                file, dpi=OCR_RASTER_DPI, first_page=window[0] + 1, last_page=window[-1] + 1, grayscale=True
+            )
+        except Exception as e:
+            print(f"Error rasterizing pages {window[0] + 1}-{window[-1] + 1}: {e}")
+            continue
+
+        page_keys = {}
+        images = {}
+        for page_num, page_image in zip(window, rendered):
+            buffer = io.BytesIO()
+            page_image.save(buffer, format="PNG")
+            page_keys[page_num] = _image_key(buffer.getvalue())
+            images[page_keys[page_num]] = buffer.getvalue()
+        del rendered
+
+        # A page is rasterized because it has no text layer, so OCR it even if it looks empty
+        ocr_text = ocr_images(images, workers, stats, pool=pool, batch_size=batch_size, text_probe=False)
+        for page_num, key in page_keys.items():
+            page_text[page_num] = ocr_text.get(key, "")
+
+    if stats is not None:
+        stats['rasterized_pages'] = stats.get('rasterized_pages', 0) + len(page_text)
+    return page_text
+
+
+def _page_windows(page_nums, window_size):
+    """Splits sorted page numbers into runs of consecutive pages of at most window_size."""
+    windows = []
+    for page_num in sorted(page_nums):
+        if windows and page_num == windows[-1][-1] + 1 and len(windows[-1]) < window_size:
+            windows[-1].append(page_num)
+        else:
+            windows.append([page_num])
+    return windows
+
+
+def _collect_parallel(task_fn, path, numbers, known, pool, workers=None):
+    """
+    Collects the given pages/slides of a spooled document on the pool, one
+    contiguous run per worker. known maps image references (PDF xrefs) to
+    content hashes and is updated, so a shared image is only read once.
 
-                # Convert image bytes to a PIL Image and validate
-                try:
-                    image = Image.open(io.BytesIO(image_bytes))
-                    image_np = np.array(image)  # Convert to numpy array
+    Returns:
+        tuple: The per-page results in page order and the image bytes by content hash.
+    """
+    runs = _slices(numbers, _resolve_workers(workers, len(numbers)))
+    results = _map_batches(task_fn, [(path, run, dict(known)) for run in runs], pool)
+    collected = []
+    images = {}
+    for run_collected, run_images, run_known in results:
+        collected.extend(run_collected)
+        for key, image_bytes in run_images.items():
+            images.setdefault(key, image_bytes)
+        known.update(run_known)
+    return collected, images
+
+
+def _collect_pdf_task(task):
+    path, page_nums, xref_keys = task
+    pdf = _open_task_document(path, fitz.open)
+    pages, images = _collect_pdf(pdf, page_nums, xref_keys)
+    return pages, images, xref_keys
+
+
+def _collect_pdf(pdf, page_nums, xref_keys):
+    """
+    Reads the text layer of the given PDF pages and the images they reference.
 
-                    # Ensure the image is valid (non-empty)
-                    if image_np.size == 0:
-                        continue  # Ignoring empty images , no need for raising error
+    xref_keys maps image xrefs to content hashes across calls, so an image
+    shared by many pages is extracted from the PDF only once.
 
-                    # Skip if the image dimensions are invalid
-                    if image_np.size == 0 or image_np.shape[0] == 0 or image_np.shape[1] == 0:
-                        continue
+    Returns:
+        tuple: A list of (page_text, image_keys) per page and the image bytes
+        first seen on these pages, keyed by content hash.
+    """
+    pages = []
+    images = {}
+    for page_num in page_nums:
+        page = pdf.load_page(page_num)
+
+        image_keys = []
+        for img in page.get_images(full=True):
+            xref = img[0]
+            if xref not in xref_keys:
+                image_bytes = pdf.extract_image(xref).get("image")
+                # Skip if image data is missing or corrupted
+                xref_keys[xref] = _image_key(image_bytes) if image_bytes else None
+                if image_bytes:
+                    images.setdefault(xref_keys[xref], image_bytes)
+            if xref_keys[xref]:
+                image_keys.append(xref_keys[xref])
 
-                    # Apply OCR on the image using EasyOCR
-                    ocr_results = reader.readtext(image_np)
+        pages.append((page.get_text(), image_keys))
+    return pages, images
 
-                    # Collect OCR results
-                    extracted_text = "\n".join([res[1] for res in ocr_results])
-                    text_content.append(extracted_text)
 
-                except Exception:
-                    # Skip this image if any error occurs during processing
-                    continue
+def extract_text_from_ppt(file_content, workers=None, stats=None):
+    """Extracts text from an uploaded PPTX file."""
+    text_content = list(iter_ppt_slides(file_content, workers, stats))
 
-    text_content = clean_extracted_text(text_content)
+    text_content = clean_extracted_text(text_content, boilerplate=BoilerplateFilter.from_pages(text_content))
     return text_content
 
 
-def extract_text_from_ppt(file_content):
-    """Extracts text from an uploaded PPTX file."""
-    text_content = []
+def iter_ppt_slides(file_content, workers=None, stats=None):
+    """
+    Yields the text and image OCR text of each slide as one string, in slide
+    order. Slides are read and OCR'd EXTRACTION_WINDOW at a time on the
+    extraction pool, like iter_pdf_pages.
+    """
     try:
         # Wrap bytes in BytesIO
         ppt_stream = BytesIO(file_content)
-        prs = Presentation(ppt_stream)
+        slides = list(Presentation(ppt_stream).slides)
+    except Exception as e:
+        raise RuntimeError(f"Error processing PPTX file: {e}")
 
-        for slide_num, slide in enumerate(prs.slides):
-            slide_content = []  # Temporary list for content from this slide
-            try:
-                for shape in slide.shapes:
-                    if hasattr(shape, "text_frame") and shape.text_frame:
-                        for paragraph in shape.text_frame.paragraphs:
-                            for run in paragraph.runs:
-                                slide_content.append(run.text)
-
-                    # Process images in the slide
-                    if shape.shape_type == 13:  # Check if the shape is an image
-                        try:
-                            image_bytes = shape.image_blob
-                            image = Image.open(io.BytesIO(image_bytes))
-                            image_np_array = np.array(image)
-
-                            if image_np_array.size > 0:
-                                ocr_response = reader.readtext(image_np_array)
-                                for img in ocr_response:
-                                    slide_content.append(img[1])
-                        except Exception as e:
-                            print(
-                                f"Error processing image on slide {slide_num + 1}: {e}"
-                            )
-            except Exception as e:
-                print(
-                    f"Error occurred while processing slide {slide_num + 1}: {e}")
+    if stats is not None:
+        stats['total_pages'] = len(slides)
 
-            # Add slide content to the final list
-            text_content.append("\n".join(slide_content))
+    ocr_text = {}
+    pool = _pool_for(workers, EXTRACTION_WINDOW)
+    with _spooled(file_content, '.pptx') if pool is not None else nullcontext() as path:
+        for start in range(0, len(slides), EXTRACTION_WINDOW):
+            if path is None:
+                window, images = _collect_ppt(slides[start:start + EXTRACTION_WINDOW], start)
+            else:
+                slide_nums = list(range(start, min(start + EXTRACTION_WINDOW, len(slides))))
+                window, images = _collect_parallel(_collect_ppt_task, path, slide_nums, {}, pool, workers)
+            new_images = {key: image for key, image in images.items() if key not in ocr_text}
+            ocr_text.update(ocr_images(new_images, workers, stats, pool=pool))
+            del images, new_images
 
-    except Exception as e:
-        raise RuntimeError(f"Error processing PPTX file: {e}")
+            for slide_content, image_keys in window:
+                slide_content.extend(ocr_text[key] for key in image_keys if ocr_text.get(key))
+                # Add slide content to the final list
+                yield "\n".join(slide_content)
+
+
+def _collect_ppt_task(task):
+    path, slide_nums, _ = task
+    slides = _open_task_document(path, lambda slides_path: list(Presentation(slides_path).slides))
+    collected, images = _collect_ppt([slides[slide_num] for slide_num in slide_nums], slide_nums[0])
+    return collected, images, {}
 
-    text_content = clean_extracted_text(text_content)
-    return text_content
 
+def _collect_ppt(slides, first_slide_num=0):
+    """
+    Reads the text runs of the given slides and the pictures placed on them.
 
-def extract_text_from_doc(file):
+    Returns:
+        tuple: A list of (slide_lines, image_keys) per slide and the distinct
+        image bytes keyed by content hash.
+    """
+    collected = []
+    images = {}
+
+    for slide_num, slide in enumerate(slides, start=first_slide_num):
+        slide_content = []  # Temporary list for content from this slide
+        image_keys = []
+        try:
+            for shape in slide.shapes:
+                if hasattr(shape, "text_frame") and shape.text_frame:
+                    for paragraph in shape.text_frame.paragraphs:
+                        for run in paragraph.runs:
+                            slide_content.append(run.text)
+
+                # Process images in the slide
+                if shape.shape_type == 13:  # Check if the shape is an image
+                    try:
+                        image_bytes = shape.image.blob
+                        key = _image_key(image_bytes)
+                        images.setdefault(key, image_bytes)
+                        image_keys.append(key)
+                    except Exception as e:
+                        print(
+                            f"Error processing image on slide {slide_num + 1}: {e}"
+                        )
+        except Exception as e:
+            print(
+                f"Error occurred while processing slide {slide_num + 1}: {e}")
+
+        collected.append((slide_content, image_keys))
+    return collected, images
+
+
+def extract_text_from_doc(file, workers=None, stats=None):
     """Extracts text form an uploaded document file. """
     text_content = []
+    images = {}
     try:
-        doc = Document(file)
+        doc = Document(BytesIO(file))
         for para in doc.paragraphs:
             text_content.append(para.text)
 
@@ -145,21 +694,16 @@ def extract_text_from_doc(file):
                 for col in row.cells:
                     text_content.append(col.text)
 
-        for i in doc.part.rels.values():
-            if i.reltype == 13:
-                image_data = doc.part.get_blob(i.target)
-                image = Image.open(io.BytesIO(image_data))
-                image_np_array = np.array(image)
-
-                if image_np_array.size == 0:
-                    continue  # Ignoring empty images , no need for raising error
-
-                ocr_response = reader.readtext(image_np_array)
-                text_extracted = "\n".join([i[1] for i in ocr_response])
-                text_content.append(text_extracted)
+        for rel in doc.part.rels.values():
+            if rel.reltype == RT.IMAGE and not rel.is_external:
+                image_bytes = rel.target_part.blob
+                images.setdefault(_image_key(image_bytes), image_bytes)
     except Exception as e:
         raise RuntimeError(f"Error processing text file: {e}")
 
+    ocr_text = ocr_images(images, workers, stats)
+    text_content.extend(ocr_text[key] for key in images if key in ocr_text)
+
     text_content = clean_extracted_text(text_content)
     return text_content
 
@@ -178,27 +722,34 @@ def extract_text_from_text(file):
     return text_content
 
 
-def clean_extracted_text(text):
+def clean_extracted_text(text, stopwords=None, boilerplate=None):
     """
-    Cleans the extracted text by removing irrelevant words/phrases (stopwords).
+    Cleans the extracted text by removing repeated headers/footers and
+    irrelevant words/phrases (stopwords).
 
     Args:
         text (list): List of text lines extracted from the document.
-        stopwords (list): List of words/phrases to exclude.
+        stopwords (list): List of words/phrases to exclude, DEFAULT_STOPWORDS by default.
+        boilerplate (BoilerplateFilter): Header/footer lines of the document,
+            detected from its pages or slides. Flat text (text files, Word
+            documents) has no pages, so nothing is removed as boilerplate
+            when it is not given.
 
     Returns:
-        list: Cleaned text content with stopwords removed.
+        list: Cleaned text content with boilerplate and stopwords removed.
     """
-    stopwords = ["Purdue", "Outline", "Chapter", "University", "Fort Wayne", "CONTD", "DEMO", "Q & A", "Have Fun",
-                 "PURDUE", "purdue", "UNIVERSITY", "U N [ V E R $ [ T Y", "FORT WAYNE", "U N I V E R $ I T Y", "U N I V E R S I T Y"]
+    pattern = compile_stopwords(DEFAULT_STOPWORDS if stopwords is None else stopwords)
 
     cleaned_text = []
     for line in text:
-        # Remove each stopword from the line
-        for stopword in stopwords:
-            line = line.replace(stopword, "").strip()
+        if boilerplate is not None:
+            line = boilerplate.strip(line)
+        # Remove all stopwords from the line in one pass
+        if pattern is not None:
+            line = pattern.sub("", line)
 
         # Remove extra whitespace and skip empty lines
+        line = line.strip()
         if line:
             cleaned_text.append(line)
 
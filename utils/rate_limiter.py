@@ -0,0 +1,55 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at `rate` tokens per second, holding at most `capacity`.
+    acquire() blocks until enough tokens are available.
+    """
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError(f"Token bucket rate must be positive, got {rate}")
+        if capacity is not None and capacity <= 0:
+            raise ValueError(f"Token bucket capacity must be positive, got {capacity}")
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        """
+        Takes amount tokens, waiting for the bucket to refill if needed. A
+        request larger than the capacity waits for a full bucket and leaves
+        it in debt, so it still goes through.
+        """
+        amount = max(0, amount)
+        while True:
+            with self._lock:
+                self._refill()
+                needed = min(amount, self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    return
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute limits of an API, as two token buckets."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute / 60, capacity=max(1, requests_per_minute / 60))
+        self.tokens = TokenBucket(tokens_per_minute / 60, capacity=tokens_per_minute / 6)
+
+    def acquire(self, tokens):
+        """Blocks until one request with this many tokens may be sent."""
+        self.requests.acquire(1)
+        self.tokens.acquire(tokens)
@@ -0,0 +1,116 @@
+import os
+import re
+from collections import Counter
+from functools import lru_cache
+
+# Words/phrases removed from every document, course stopwords are added to these
+DEFAULT_STOPWORDS = ["Purdue", "Outline", "Chapter", "University", "Fort Wayne", "CONTD", "DEMO", "Q & A", "Have Fun",
+                     "PURDUE", "purdue", "UNIVERSITY", "U N [ V E R $ [ T Y", "FORT WAYNE", "U N I V E R $ I T Y",
+                     "U N I V E R S I T Y"]
+
+# A line is a header/footer when it appears on at least BOILERPLATE_MIN_SHARE of
+# the pages of a document that has at least BOILERPLATE_MIN_PAGES pages
+BOILERPLATE_MIN_SHARE = float(os.getenv('BOILERPLATE_MIN_SHARE', 0.4))
+BOILERPLATE_MIN_PAGES = int(os.getenv('BOILERPLATE_MIN_PAGES', 5))
+
+
+@lru_cache(maxsize=64)
+def _compile_stopwords(stopwords):
+    if not stopwords:
+        return None
+    # Longest first, so "Fort Wayne" wins over a shorter overlapping phrase
+    alternatives = sorted(set(stopwords), key=len, reverse=True)
+    return re.compile("|".join(re.escape(stopword) for stopword in alternatives))
+
+
+def compile_stopwords(stopwords):
+    """Returns one compiled pattern matching any of the stopwords, or None for an empty list."""
+    return _compile_stopwords(tuple(stopwords or ()))
+
+
+def _normalize_line(line):
+    """
+    Key used to compare lines across pages: case and spacing are ignored, and
+    so are numbers in short lines ("Slide 12", "Page 3 of 40").
+    """
+    words = line.lower().split()
+    line = " ".join(words)
+    if len(words) <= 4:
+        line = re.sub(r"\d+", "#", line)
+    return line
+
+
+class BoilerplateFilter:
+    """
+    Frequency-based header/footer detection for one document.
+
+    Every page is observed once; lines that repeat on many pages of the document
+    (course banners, running titles, "Slide 12", "Page 3 of 40") are then
+    removed by strip(). Pages can be observed while streaming, in which case a
+    line counts as boilerplate as soon as it crosses the share of pages seen so far.
+    """
+
+    def __init__(self, min_share=BOILERPLATE_MIN_SHARE, min_pages=BOILERPLATE_MIN_PAGES):
+        self.min_share = min_share
+        self.min_pages = min_pages
+        self.page_count = 0
+        self.line_counts = Counter()
+        self.removed_lines = 0
+
+    @classmethod
+    def from_pages(cls, pages):
+        boilerplate = cls()
+        for page in pages:
+            boilerplate.observe(page)
+        return boilerplate
+
+    def observe(self, page):
+        """Counts the distinct lines of a page, given as a string or a list of strings."""
+        if isinstance(page, str):
+            page = [page]
+        lines = {_normalize_line(line) for text in page for line in text.splitlines()}
+        lines.discard("")
+        self.line_counts.update(lines)
+        self.page_count += 1
+
+    def is_boilerplate(self, line):
+        if self.page_count < self.min_pages:
+            return False
+        count = self.line_counts.get(_normalize_line(line), 0)
+        return count > 1 and count >= self.min_share * self.page_count
+
+    def strip(self, text):
+        """Removes the boilerplate lines from a (multi-line) string."""
+        if self.page_count < self.min_pages:
+            return text
+        kept = []
+        for line in text.splitlines():
+            if line.strip() and self.is_boilerplate(line):
+                self.removed_lines += 1
+            else:
+                kept.append(line)
+        return "\n".join(kept)
+
+
+def split_pages(extracted_text, extracted_pages=None):
+    """
+    Splits a stored extracted text back into its pages or slides.
+
+    Args:
+        extracted_text (list): Cleaned lines of the document.
+        extracted_pages (list): [page_number, line_count] of each page with text,
+            as recorded during ingestion.
+
+    Returns:
+        list: (page_number, lines) tuples. Texts stored without extracted_pages
+        are returned as a single unit without a page number.
+    """
+    lines = extracted_text if isinstance(extracted_text, list) else str(extracted_text or '').splitlines()
+    if not extracted_pages:
+        return [(None, lines)] if lines else []
+    pages = []
+    start = 0
+    for page_number, line_count in extracted_pages:
+        pages.append((page_number, lines[start:start + line_count]))
+        start += line_count
+    return pages